@@ -0,0 +1,104 @@
+import logging
+import re
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+# the number of candidates compared precisely after trigram filtering
+MAX_CANDIDATES = 8
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_tag(tag: str) -> str:
+    """Normalizes casing, underscores and whitespaces of a tag"""
+
+    return WHITESPACE_PATTERN.sub(" ", tag.lower().replace("_", " ")).strip()
+
+
+def get_trigrams(text: str) -> set[str]:
+    padded = f" {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TagAliasResolver:
+    """Resolves unknown tags to the closest known tags.
+
+    Tags are looked up by their normalized form, then by a character trigram index."""
+
+    def __init__(self, tags: Iterable[str], min_similarity: float = 0.8):
+        self.min_similarity = min_similarity
+
+        self.tags: list[str] = []
+        self.normalized_tags: dict[str, str] = {}
+        self.trigram_sizes: list[int] = []
+        # trigram -> indices of tags
+        self.postings: dict[str, list[int]] = {}
+
+        for tag in tags:
+            normalized = normalize_tag(tag)
+            if normalized in self.normalized_tags:
+                continue
+            self.normalized_tags[normalized] = tag
+
+            index = len(self.tags)
+            self.tags.append(tag)
+            trigrams = get_trigrams(normalized)
+            self.trigram_sizes.append(len(trigrams))
+            for trigram in trigrams:
+                self.postings.setdefault(trigram, []).append(index)
+
+    def resolve(self, tag: str) -> str | None:
+        """Returns the closest known tag, or None if nothing is similar enough"""
+
+        normalized = normalize_tag(tag)
+        if normalized == "":
+            return None
+        if normalized in self.normalized_tags:
+            return self.normalized_tags[normalized]
+
+        trigrams = get_trigrams(normalized)
+        counts: Counter[int] = Counter()
+        for trigram in trigrams:
+            counts.update(self.postings.get(trigram, []))
+
+        # dice coefficient of trigram sets
+        scores = [
+            (2 * count / (len(trigrams) + self.trigram_sizes[index]), index)
+            for index, count in counts.items()
+        ]
+        candidates = sorted(scores, reverse=True)[:MAX_CANDIDATES]
+
+        best_tag, best_similarity = None, self.min_similarity
+        for _score, index in candidates:
+            similarity = SequenceMatcher(
+                None, normalized, normalize_tag(self.tags[index])
+            ).ratio()
+            if similarity >= best_similarity:
+                best_tag, best_similarity = self.tags[index], similarity
+
+        return best_tag
+
+    def resolve_tags(self, tags: list[str], time_budget: float) -> dict[str, str]:
+        """Resolves tags until the time budget (seconds) runs out.
+
+        Returns the pairs of the unknown tag and the resolved tag."""
+
+        deadline = time.perf_counter() + time_budget
+        resolved: dict[str, str] = {}
+
+        for i, tag in enumerate(tags):
+            if time.perf_counter() > deadline:
+                logger.debug(
+                    f"Alias resolution exceeded the time budget, skipped {len(tags) - i} tags"
+                )
+                break
+
+            resolved_tag = self.resolve(tag)
+            if resolved_tag is not None:
+                resolved[tag] = resolved_tag
+
+        return resolved
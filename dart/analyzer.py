@@ -1,16 +1,25 @@
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Callable, Container, Iterator
 
 from modules.extra_networks import parse_prompt
 from modules.prompt_parser import parse_prompt_attention
 from modules.shared import opts
 
+from dart.alias_resolver import TagAliasResolver
 from dart.settings import parse_options
-from dart.utils import (
-    escape_webui_special_symbols,
-    unescape_webui_special_symbols,
+from dart.tag_index import (
+    TAG_CATEGORY,
+    TagIndex,
+    get_file_stamp,
+    load_tag_index,
 )
+from dart.token_budget import truncate_tags_to_budget
+from dart.utils import unescape_webui_special_symbols
 
 logger = logging.getLogger(__name__)
 
@@ -139,17 +148,6 @@ def normalize_rating_tags(tags: list[str]) -> tuple[str, str]:
     return get_rating_tag_pair(strongest_tag)
 
 
-def load_tags_in_file(path: Path):
-    if not path.exists():
-        logger.error(f"File not found: {path}")
-        return []
-
-    with open(path, "r", encoding="utf-8") as file:
-        tags = [tag.strip() for tag in file.readlines() if tag.strip() != ""]
-
-    return tags
-
-
 @dataclass
 class ImagePromptAnalyzingResult:
     """A class of the result of analyzing tags"""
@@ -161,6 +159,24 @@ class ImagePromptAnalyzingResult:
     general: str
     quality: str
     unknown: str
+    # unknown tag -> resolved tag
+    resolved: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class TagSnapshot:
+    """Tag lookup tables used by analyses. Replaced as a whole when their sources change"""
+
+    tag_index: TagIndex
+    alias_resolver: TagAliasResolver | None
+    vocab: list[str]
+    special_vocab: set[str]
+    # category -> (size, mtime) of the tag file
+    file_stamps: dict[str, tuple[int, int] | None]
+    # the number of analyses reading this snapshot
+    num_readers: int = 0
+    # replaced by a new snapshot, the tag index is closed after the last reader
+    replaced: bool = False
 
 
 class DartAnalyzer:
@@ -172,26 +188,204 @@ class DartAnalyzer:
             logger.setLevel(logging.DEBUG)
 
         self.tags_dir = Path(extension_dir) / "tags"
+        self.tag_files = {
+            "COPYRIGHT": self.tags_dir / "copyright.txt",
+            "CHARACTER": self.tags_dir / "character.txt",
+            "QUALITY": self.tags_dir / "quality.txt",
+        }
 
         self.rating_tags = ALL_INPUT_RATING_TAGS
 
-        self.copyright_tags = load_tags_in_file(self.tags_dir / "copyright.txt")
-        self.character_tags = load_tags_in_file(self.tags_dir / "character.txt")
-        self.quality_tags = load_tags_in_file(self.tags_dir / "quality.txt")
+        if self.options["escape_input_brackets"]:
+            logger.debug("Allows tags with escaped brackets")
 
+        # sources of the tag tables
         self.vocab = vocab
         self.special_vocab = special_vocab
 
-        if self.options["escape_input_brackets"]:
-            logger.debug("Allows tags with escaped brackets")
-            self.copyright_tags += escape_webui_special_symbols(self.copyright_tags)
-            self.character_tags += escape_webui_special_symbols(self.character_tags)
-            self.vocab += escape_webui_special_symbols(self.vocab)
+        # analyses read this once, so a reload never changes tables during an analysis
+        self.snapshot = self._build_snapshot(vocab, special_vocab)
+        self.snapshot_lock = threading.Lock()
+        self.reloading_thread: threading.Thread | None = None
+        # called once the snapshot of the requested sources is swapped in
+        self.reload_callbacks: list[Callable[[], None]] = []
+        # tag -> how often the model generates it, common tags are dropped from long prompts
+        self.tag_counts: dict[str, int] | None = None
+
+    def _get_file_stamps(self) -> dict[str, tuple[int, int] | None]:
+        return {
+            category: get_file_stamp(path) for category, path in self.tag_files.items()
+        }
+
+    def _build_snapshot(
+        self,
+        vocab: list[str],
+        special_vocab: list[str],
+        previous: TagSnapshot | None = None,
+    ) -> TagSnapshot:
+        file_stamps = self._get_file_stamps()
+        vocab_changed = previous is None or (
+            previous.vocab is not vocab and previous.vocab != vocab
+        )
+        changed = {
+            category
+            for category, stamp in file_stamps.items()
+            if previous is None or previous.file_stamps[category] != stamp
+        }
+
+        # copyright, character, quality tags and vocab are looked up in the memory-mapped index
+        tag_index = load_tag_index(
+            self.tags_dir / "index.bin",
+            vocab,
+            self.tag_files,
+            # tags of unchanged files are taken from the previous index
+            previous=previous.tag_index if previous is not None else None,
+            unchanged=set(self.tag_files.keys()) - changed,
+        )
+
+        alias_resolver = None
+        if self.options["resolve_unknown_tags"]:
+            if (
+                previous is not None
+                and previous.alias_resolver is not None
+                and not vocab_changed
+                and not changed & {"CHARACTER", "COPYRIGHT"}
+            ):
+                # quality tags are not resolved
+                alias_resolver = previous.alias_resolver
+            else:
+                alias_resolver = self._build_alias_resolver(
+                    tag_index, set(special_vocab)
+                )
+
+        return TagSnapshot(
+            tag_index=tag_index,
+            alias_resolver=alias_resolver,
+            vocab=vocab,
+            special_vocab=set(special_vocab),
+            file_stamps=file_stamps,
+        )
+
+    def _build_alias_resolver(
+        self, tag_index: TagIndex, special_vocab: set[str]
+    ) -> TagAliasResolver:
+        alias_resolver = TagAliasResolver(
+            (
+                tag
+                for tag in tag_index.iter_tags(
+                    include=TAG_CATEGORY["VOCAB"]
+                    | TAG_CATEGORY["CHARACTER"]
+                    | TAG_CATEGORY["COPYRIGHT"]
+                )
+                if tag not in special_vocab
+            ),
+            min_similarity=self.options["alias_min_similarity"],
+        )
+        logger.debug(f"Built alias index of {len(alias_resolver.tags)} tags")
+
+        return alias_resolver
+
+    @contextmanager
+    def use_snapshot(self) -> Iterator[TagSnapshot]:
+        """Keeps the current snapshot open while it is used"""
+
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            snapshot.num_readers += 1
+        try:
+            yield snapshot
+        finally:
+            with self.snapshot_lock:
+                snapshot.num_readers -= 1
+                if snapshot.replaced and snapshot.num_readers == 0:
+                    snapshot.tag_index.close()
+
+    def _swap_snapshot(self, snapshot: TagSnapshot):
+        with self.snapshot_lock:
+            previous = self.snapshot
+            self.snapshot = snapshot
+            previous.replaced = True
+            if previous.num_readers == 0:
+                previous.tag_index.close()
+
+    def _reload(self):
+        try:
+            while True:
+                start_time = time.time()
+                vocab = self.vocab
+                self._swap_snapshot(
+                    self._build_snapshot(vocab, self.special_vocab, self.snapshot)
+                )
+                logger.info(
+                    f"Reloaded tag lists in {time.time() - start_time:.2f} seconds"
+                )
+
+                with self.snapshot_lock:
+                    # the vocab may be changed again while reloading
+                    if self.vocab is vocab:
+                        callbacks = self.reload_callbacks
+                        self.reload_callbacks = []
+                        self.reloading_thread = None
+                        break
+
+            for callback in callbacks:
+                callback()
+        except Exception as e:
+            logger.error(f"Failed to reload tag lists: {e}")
+            with self.snapshot_lock:
+                self.reloading_thread = None
+
+    def reload_if_changed(
+        self,
+        vocab: list[str] | None = None,
+        special_vocab: list[str] | None = None,
+        on_reloaded: Callable[[], None] | None = None,
+    ):
+        """Rebuilds the tag tables in the background if the tag files or the vocab are changed.
+
+        `on_reloaded` is called after the new tables are swapped in"""
+
+        with self.snapshot_lock:
+            if vocab is not None:
+                self.vocab = vocab
+            if special_vocab is not None:
+                self.special_vocab = special_vocab
+
+            changed = (
+                self.snapshot.file_stamps != self._get_file_stamps()
+                or self.snapshot.vocab is not self.vocab
+            )
+            if changed:
+                if on_reloaded is not None:
+                    self.reload_callbacks.append(on_reloaded)
+                # a running reload picks up the new sources
+                if self.reloading_thread is None:
+                    logger.info("Tag lists are changed, reloading in background")
+                    self.reloading_thread = threading.Thread(
+                        target=self._reload, daemon=True
+                    )
+                    self.reloading_thread.start()
+
+        if not changed and on_reloaded is not None:
+            on_reloaded()
+
+    def get_general_vocab(self) -> list[str]:
+        """Returns tags in vocab which can appear in the general section"""
+
+        with self.use_snapshot() as snapshot:
+            return [
+                tag
+                for tag in snapshot.tag_index.iter_tags(
+                    include=TAG_CATEGORY["VOCAB"],
+                    exclude=TAG_CATEGORY["CHARACTER"] | TAG_CATEGORY["COPYRIGHT"],
+                )
+                if tag not in self.rating_tags
+            ]
 
     def split_tags(self, image_prompt: str) -> list[str]:
         return [tag.strip() for tag in image_prompt.split(",") if tag.strip() != ""]
 
-    def extract_tags(self, input_tags: list[str], extract_tag_list: list[str]):
+    def extract_tags(self, input_tags: list[str], extract_tag_list: Container[str]):
         matched: list[str] = []
         not_matched: list[str] = []
 
@@ -203,6 +397,84 @@ class DartAnalyzer:
 
         return matched, not_matched
 
+    def extract_tags_in_category(
+        self, input_tags: list[str], category: str, tag_index: TagIndex
+    ):
+        matched: list[str] = []
+        not_matched: list[str] = []
+
+        for input_tag in input_tags:
+            if tag_index.has(input_tag, category) or (
+                # \(\) is allowed as ()
+                self.options["escape_input_brackets"]
+                and tag_index.has(
+                    unescape_webui_special_symbols([input_tag])[0], category
+                )
+            ):
+                matched.append(input_tag)
+            else:
+                not_matched.append(input_tag)
+
+        return matched, not_matched
+
+    def is_known_tag(self, tag: str, snapshot: TagSnapshot) -> bool:
+        if tag in snapshot.special_vocab or snapshot.tag_index.get_category(tag) != 0:
+            return True
+        # \(\) is allowed as ()
+        return (
+            self.options["escape_input_brackets"]
+            and snapshot.tag_index.get_category(
+                unescape_webui_special_symbols([tag])[0]
+            )
+            != 0
+        )
+
+    def resolve_unknown_tags(
+        self, input_tags: list[str], snapshot: TagSnapshot
+    ) -> dict[str, str]:
+        """Maps unknown tags to the closest known tags within the time budget"""
+
+        if snapshot.alias_resolver is None:
+            return {}
+
+        unknown_tags = [
+            tag for tag in input_tags if not self.is_known_tag(tag, snapshot)
+        ]
+        if len(unknown_tags) == 0:
+            return {}
+
+        unescaped_tags = unescape_webui_special_symbols(unknown_tags)
+        resolved_unescaped = snapshot.alias_resolver.resolve_tags(
+            unescaped_tags,
+            time_budget=self.options["alias_resolution_budget"] / 1000,
+        )
+        resolved = {
+            unknown_tag: resolved_unescaped[unescaped_tag]
+            for unknown_tag, unescaped_tag in zip(unknown_tags, unescaped_tags)
+            if unescaped_tag in resolved_unescaped
+        }
+        if len(resolved) > 0:
+            logger.info(
+                "Resolved unknown tags: "
+                + ", ".join(f"{tag} -> {alias}" for tag, alias in resolved.items())
+            )
+
+        return resolved
+
+    def get_tag_counts(self, tags: list[str]) -> dict[str, int]:
+        tag_counts = self.tag_counts or {}
+
+        counts = {}
+        for tag in tags:
+            count = tag_counts.get(tag)
+            if count is None and self.options["escape_input_brackets"]:
+                # \(\) is allowed as ()
+                count = tag_counts.get(unescape_webui_special_symbols([tag])[0])
+            if count is not None:
+                counts[tag] = count
+
+        return counts
+
     def preprocess_tags(self, tags: list[str]) -> str:
         """Preprocess tags to pass to dart model."""
 
@@ -213,20 +485,59 @@ class DartAnalyzer:
         return ", ".join(tags)
 
     def analyze(self, image_prompt: str) -> ImagePromptAnalyzingResult:
+        with self.use_snapshot() as snapshot:
+            return self._analyze(image_prompt, snapshot)
+
+    def _analyze(
+        self, image_prompt: str, snapshot: TagSnapshot
+    ) -> ImagePromptAnalyzingResult:
         input_tags = self.split_tags(",".join([x[0] for x in parse_prompt_attention(parse_prompt(image_prompt)[0])]))
 
-        input_tags = list(set(input_tags))  # unique
+        input_tags = list(dict.fromkeys(input_tags))  # unique, in the input order
+
+        tag_index = snapshot.tag_index
 
         rating_tags, input_tags = self.extract_tags(input_tags, self.rating_tags)
-        copyright_tags, input_tags = self.extract_tags(input_tags, self.copyright_tags)
-        character_tags, input_tags = self.extract_tags(input_tags, self.character_tags)
-        quality_tags, input_tags = self.extract_tags(input_tags, self.quality_tags)
+
+        # e.g. Hatsune_Miku -> hatsune miku
+        resolved = self.resolve_unknown_tags(input_tags, snapshot)
+        input_tags = list(dict.fromkeys(resolved.get(tag, tag) for tag in input_tags))
+
+        copyright_tags, input_tags = self.extract_tags_in_category(
+            input_tags, "COPYRIGHT", tag_index
+        )
+        character_tags, input_tags = self.extract_tags_in_category(
+            input_tags, "CHARACTER", tag_index
+        )
+        quality_tags, input_tags = self.extract_tags_in_category(
+            input_tags, "QUALITY", tag_index
+        )
 
         # escape special tags
-        _special_tags, input_tags = self.extract_tags(input_tags, self.special_vocab)
+        _special_tags, input_tags = self.extract_tags(
+            input_tags, snapshot.special_vocab
+        )
 
         # general tags and unknown tags
-        other_tags, unknown_tags = self.extract_tags(input_tags, self.vocab)
+        other_tags, unknown_tags = self.extract_tags_in_category(
+            input_tags, "VOCAB", tag_index
+        )
+
+        max_input_tokens = int(self.options["max_input_tokens"])
+        if max_input_tokens > 0:
+            num_tags = len(character_tags) + len(copyright_tags) + len(other_tags)
+            character_tags, copyright_tags, other_tags = truncate_tags_to_budget(
+                character_tags,
+                copyright_tags,
+                other_tags,
+                max_input_tokens,
+                tag_counts=self.get_tag_counts(other_tags),
+            )
+            num_dropped = (
+                num_tags - len(character_tags) - len(copyright_tags) - len(other_tags)
+            )
+            if num_dropped > 0:
+                logger.debug(f"Dropped {num_dropped} tags to fit the input budget")
 
         rating_parent, rating_child = normalize_rating_tags(rating_tags)
 
@@ -238,4 +549,5 @@ class DartAnalyzer:
             general=self.preprocess_tags(other_tags),
             quality=self.preprocess_tags(quality_tags),
             unknown=self.preprocess_tags(unknown_tags),
+            resolved=resolved,
         )
@@ -0,0 +1,127 @@
+import logging
+from typing import Any
+
+import torch
+from transformers import LogitsProcessorList
+
+from dart.beam_search import _reorder_past_key_values
+from dart.speculative import _accepts_position_ids
+
+logger = logging.getLogger(__name__)
+
+
+@torch.no_grad()
+def batch_generate(
+    model,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    logits_processor: LogitsProcessorList,
+    eos_token_id: int,
+    max_new_tokens: list[int],
+    do_sample: bool = True,
+    generators: list[torch.Generator] | None = None,
+) -> list[list[int]]:
+    """Generates tags of left-padded prompts and returns the generated ids of each prompt.
+
+    A row is dropped from the batch and the cache as soon as it generates eos or reaches its own
+    `max_new_tokens`, so finished rows do not take compute until the longest one ends.
+    Each row is sampled with its generator if given, otherwise with the global generator.
+    """
+
+    num_rows = input_ids.shape[0]
+    assert len(max_new_tokens) == num_rows
+    assert generators is None or len(generators) == num_rows
+
+    pass_position_ids = _accepts_position_ids(model)
+    num_forwards = 0
+
+    def forward(ids: torch.Tensor, attention_mask: torch.Tensor, past_key_values: Any):
+        nonlocal num_forwards
+        num_forwards += 1
+
+        kwargs = {}
+        if pass_position_ids:
+            # the same positions as generate, padding is skipped
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            kwargs["position_ids"] = position_ids[:, -ids.shape[1] :]
+
+        return model(
+            ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+
+    generated_ids: list[list[int]] = [[] for _ in range(num_rows)]
+    # the prompt of each row of the batch
+    rows = list(range(num_rows))
+
+    def select_rows(keep: list[int], *tensors: torch.Tensor) -> list[torch.Tensor]:
+        nonlocal rows
+        rows = [rows[i] for i in keep]
+        index = torch.tensor(keep, device=input_ids.device)
+        return [tensor.index_select(0, index) for tensor in tensors]
+
+    sequences = input_ids
+    keep = [i for i in range(num_rows) if max_new_tokens[i] > 0]
+    if len(keep) < num_rows:
+        sequences, attention_mask = select_rows(keep, sequences, attention_mask)
+
+    next_ids = sequences
+    past_key_values = None
+    while len(rows) > 0:
+        out = forward(next_ids, attention_mask, past_key_values)
+        scores = logits_processor(sequences, out.logits[:, -1].float())
+
+        if do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            # each row consumes only its own generator, as if it were generated alone
+            next_ids = torch.cat(
+                [
+                    torch.multinomial(
+                        probs[i : i + 1],
+                        num_samples=1,
+                        generator=generators[row] if generators is not None else None,
+                    )
+                    for i, row in enumerate(rows)
+                ]
+            )
+        else:
+            next_ids = scores.argmax(dim=-1, keepdim=True)
+
+        sequences = torch.cat([sequences, next_ids], dim=1)
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))],
+            dim=1,
+        )
+
+        keep = []
+        for i, (row, token_id) in enumerate(zip(rows, next_ids[:, 0].tolist())):
+            generated_ids[row].append(token_id)
+            if (
+                token_id != eos_token_id
+                and len(generated_ids[row]) < max_new_tokens[row]
+            ):
+                keep.append(i)
+        if len(keep) == 0:
+            break
+
+        past_key_values = out.past_key_values
+        if len(keep) < len(rows):
+            # drops the finished rows and their states
+            past_key_values = _reorder_past_key_values(
+                past_key_values,
+                torch.tensor(keep, device=input_ids.device),
+                batch_size=len(rows),
+            )
+            sequences, attention_mask, next_ids = select_rows(
+                keep, sequences, attention_mask, next_ids
+            )
+
+    logger.debug(
+        f"Batched decoding generated {sum(len(ids) for ids in generated_ids)} tokens of {num_rows} prompts in {num_forwards} forwards"
+    )
+
+    return generated_ids
@@ -0,0 +1,204 @@
+import logging
+from typing import Any
+
+import torch
+from transformers import LogitsProcessorList
+
+from dart.speculative import _accepts_position_ids
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_kv_bytes_per_token(model) -> int:
+    """Returns the approximate size of the key and value states of a token in bytes"""
+
+    config = model.config
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+
+    dtype = getattr(model, "dtype", torch.float32)
+    element_size = torch.tensor([], dtype=dtype).element_size()
+
+    return 2 * num_layers * num_kv_heads * head_dim * element_size
+
+
+def get_max_num_beams(
+    model, sequence_length: int, memory_budget_mb: float, num_beams: int
+) -> int:
+    """Returns the number of beams whose states fit in the memory budget"""
+
+    if memory_budget_mb <= 0:
+        return num_beams
+
+    bytes_per_beam = estimate_kv_bytes_per_token(model) * sequence_length
+    return max(min(num_beams, int(memory_budget_mb * 1024 * 1024 // bytes_per_beam)), 1)
+
+
+def _reorder_past_key_values(
+    past_key_values: Any, beam_idx: torch.Tensor, batch_size: int
+) -> Any:
+    if hasattr(past_key_values, "reorder_cache"):
+        # Cache classes of newer transformers
+        past_key_values.reorder_cache(beam_idx)
+        return past_key_values
+
+    if isinstance(past_key_values, torch.Tensor):
+        if past_key_values.shape[0] != batch_size:
+            # e.g. (batch * heads, dim, length) of bloom
+            raise ValueError(
+                f"Beam search does not support states of shape {tuple(past_key_values.shape)}"
+            )
+        return past_key_values.index_select(0, beam_idx.to(past_key_values.device))
+
+    # tuple of (key, value) with shape (batch, heads, length, dim) of each layer, or a tuple of
+    # fused states of each layer of some ORT models
+    if isinstance(past_key_values, (tuple, list)):
+        return tuple(
+            _reorder_past_key_values(states, beam_idx, batch_size)
+            for states in past_key_values
+        )
+
+    raise TypeError(f"Unsupported cache format: {type(past_key_values).__name__}")
+
+
+@torch.no_grad()
+def beam_search_generate(
+    model,
+    input_ids: torch.Tensor,
+    logits_processor: LogitsProcessorList,
+    eos_token_id: int,
+    max_new_tokens: int = 128,
+    num_beams: int = 2,
+    do_sample: bool = True,
+    length_penalty: float = 1.0,
+    generator: torch.Generator | None = None,
+) -> torch.Tensor:
+    """Generates tags with beam search and returns the best sequence.
+
+    The prompt is forwarded once and its states are shared by all beams. Search stops as soon as
+    `num_beams` sequences have ended. Only a single prompt is supported."""
+
+    assert input_ids.shape[0] == 1, "Only a single sequence is supported"
+
+    pass_position_ids = _accepts_position_ids(model)
+
+    def forward(ids: torch.Tensor, past_key_values: Any, past_length: int):
+        kwargs = {}
+        if pass_position_ids:
+            kwargs["position_ids"] = (
+                torch.arange(past_length, past_length + ids.shape[1], device=ids.device)
+                .unsqueeze(0)
+                .expand(ids.shape[0], -1)
+            )
+
+        return model(
+            ids,
+            attention_mask=torch.ones(
+                (ids.shape[0], past_length + ids.shape[1]),
+                dtype=torch.long,
+                device=ids.device,
+            ),
+            past_key_values=past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+
+    # starts from a single beam and branches after the first token
+    out = forward(input_ids, None, 0)
+    past_key_values = out.past_key_values
+    logits = out.logits[:, -1]
+    sequences = input_ids
+    beam_scores = torch.zeros(1, device=input_ids.device)
+
+    # (score, sequence) of ended beams
+    finished: list[tuple[float, torch.Tensor]] = []
+
+    def add_finished(score: float, sequence: torch.Tensor):
+        num_generated = max(sequence.shape[0] - input_ids.shape[1], 1)
+        finished.append((score / (num_generated**length_penalty), sequence))
+        finished.sort(key=lambda item: item[0], reverse=True)
+        del finished[num_beams:]
+
+    for step in range(max_new_tokens):
+        scores = torch.log_softmax(logits.float(), dim=-1)
+        scores = logits_processor(sequences, scores)
+        vocab_size = scores.shape[-1]
+
+        # scores of all (beam, token) pairs at once
+        candidate_scores = (scores + beam_scores[:, None]).view(-1)
+        # twice the beams so that enough of them are not eos
+        num_candidates = min(
+            2 * num_beams, int(torch.isfinite(candidate_scores).sum().item())
+        )
+        if num_candidates == 0:
+            break
+
+        if do_sample:
+            probs = torch.softmax(candidate_scores, dim=-1)
+            indices = torch.multinomial(
+                probs, num_samples=num_candidates, generator=generator
+            )
+            top_scores, order = candidate_scores[indices].sort(descending=True)
+            indices = indices[order]
+        else:
+            top_scores, indices = candidate_scores.topk(num_candidates)
+
+        beam_ids = (indices // vocab_size).tolist()
+        token_ids = (indices % vocab_size).tolist()
+
+        next_beams: list[tuple[int, int, float]] = []
+        for rank, (score, beam_id, token_id) in enumerate(
+            zip(top_scores.tolist(), beam_ids, token_ids)
+        ):
+            if token_id == eos_token_id:
+                if rank < num_beams:
+                    add_finished(
+                        score,
+                        torch.cat([sequences[beam_id], indices.new_tensor([token_id])]),
+                    )
+                continue
+
+            next_beams.append((beam_id, token_id, score))
+            if len(next_beams) == num_beams:
+                break
+
+        if len(finished) >= num_beams or len(next_beams) == 0:
+            break
+
+        beam_idx = torch.tensor([beam_id for beam_id, _, _ in next_beams])
+        next_tokens = torch.tensor(
+            [[token_id] for _, token_id, _ in next_beams], dtype=sequences.dtype
+        ).to(sequences.device)
+        beam_scores = torch.tensor(
+            [score for _, _, score in next_beams], device=sequences.device
+        )
+        sequences = torch.cat(
+            [sequences.index_select(0, beam_idx.to(sequences.device)), next_tokens],
+            dim=1,
+        )
+
+        if step == max_new_tokens - 1:
+            break
+
+        past_key_values = _reorder_past_key_values(
+            past_key_values, beam_idx, batch_size=out.logits.shape[0]
+        )
+        out = forward(next_tokens, past_key_values, sequences.shape[1] - 1)
+        past_key_values = out.past_key_values
+        logits = out.logits[:, -1]
+
+    if (
+        len(finished) < num_beams
+        and sequences.shape[1] - input_ids.shape[1] == max_new_tokens
+    ) or len(finished) == 0:
+        # beams which have not ended within max_new_tokens
+        for score, sequence in zip(beam_scores.tolist(), sequences):
+            add_finished(score, sequence)
+
+    logger.debug(
+        f"Beam search finished {len(finished)} beams in {sequences.shape[1] - input_ids.shape[1]} steps"
+    )
+
+    return finished[0][1].unsqueeze(0)
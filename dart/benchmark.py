@@ -0,0 +1,379 @@
+"""Benchmarks the model backends on a locally generated model.
+
+Usage: python -m dart.benchmark [--checkpoint CHECKPOINT_DIR] [--output RESULTS_JSON]
+
+Each backend runs in its own process, so that the peak RSS is measured for each backend.
+The ONNX backends are exported with dart.onnx_export and need optimum."""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    LogitsProcessorList,
+)
+
+from dart.logits_processor import UnbatchedClassifierFreeGuidanceLogitsProcessor
+from dart.onnx_export import (
+    ONNX_BACKEND_FILE_NAMES,
+    ORIGINAL_BACKEND,
+    export_onnx,
+    quantize_onnx,
+)
+
+logger = logging.getLogger(__name__)
+
+# the values of MODEL_BACKEND_TYPE
+BACKENDS = [ORIGINAL_BACKEND, *ONNX_BACKEND_FILE_NAMES.keys()]
+
+# roughly the size of dart-v1-sft
+DEFAULT_VOCAB_SIZE = 30000
+DEFAULT_HIDDEN_SIZE = 768
+DEFAULT_NUM_LAYERS = 12
+
+DEFAULT_BATCH_SIZES = [1, 4]
+DEFAULT_LENGTHS = [32, 128]
+DEFAULT_NUM_BEAMS = [1, 4]
+DEFAULT_PROMPT_LENGTH = 16
+DEFAULT_NUM_REQUESTS = 10
+CFG_SCALE = 1.5
+# the CFG schedule of the scheduled cases
+CFG_MAX_GUIDANCE_STEPS = 8
+CFG_DIVERGENCE_THRESHOLD = 0.1
+# top-k/top-p sampling of the sampling cases, the "unvaried" variety preset
+SAMPLING_TEMPERATURE = 0.9
+SAMPLING_TOP_P = 0.95
+SAMPLING_TOP_K = 20
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    batch_size: int
+    # the number of generated tokens
+    length: int
+    cfg: bool
+    num_beams: int
+    # CFG is applied only while the guidance is effective
+    cfg_schedule: bool = False
+    # top-k/top-p sampling instead of greedy decoding
+    sampling: bool = False
+
+    @property
+    def cfg_name(self) -> str:
+        if not self.cfg:
+            return "off"
+        return "scheduled" if self.cfg_schedule else "on"
+
+
+@dataclass
+class CaseResult:
+    case: BenchmarkCase
+    first_token_latency_ms: float
+    tokens_per_second: float
+    p50_latency_ms: float
+    p95_latency_ms: float
+
+
+@dataclass
+class BackendResult:
+    backend: str
+    load_time_s: float | None = None
+    # the RSS after importing libraries, before the model is loaded
+    baseline_rss_mb: float | None = None
+    peak_rss_mb: float | None = None
+    cases: list[CaseResult] = field(default_factory=list)
+    error: str | None = None
+
+
+def get_benchmark_cases(
+    batch_sizes: list[int], lengths: list[int], num_beams: list[int]
+) -> list[BenchmarkCase]:
+    cases = []
+    for batch_size, length, (cfg, cfg_schedule), beams, sampling in product(
+        batch_sizes,
+        lengths,
+        [(False, False), (True, False), (True, True)],
+        num_beams,
+        [False, True],
+    ):
+        # the CFG logits processor of the generator is unbatched
+        if cfg and (batch_size > 1 or beams > 1):
+            continue
+        # the generator samples only without beams
+        if sampling and beams > 1:
+            continue
+        cases.append(
+            BenchmarkCase(batch_size, length, cfg, beams, cfg_schedule, sampling)
+        )
+
+    return cases
+
+
+def create_benchmark_model(
+    output_dir: Path,
+    vocab_size: int = DEFAULT_VOCAB_SIZE,
+    hidden_size: int = DEFAULT_HIDDEN_SIZE,
+    num_layers: int = DEFAULT_NUM_LAYERS,
+):
+    """Saves a randomly initialized model of the given size"""
+
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 4,
+            num_hidden_layers=num_layers,
+            num_attention_heads=hidden_size // 64,
+            max_position_embeddings=1024,
+            eos_token_id=2,
+        )
+    )
+    model.save_pretrained(output_dir)
+
+
+def _get_peak_rss_mb() -> float:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB on Linux
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def _load_model(backend: str, checkpoint_dir: Path, onnx_dir: Path | None):
+    if backend == ORIGINAL_BACKEND:
+        return AutoModelForCausalLM.from_pretrained(checkpoint_dir).eval()
+
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    if onnx_dir is None:
+        raise FileNotFoundError("The model is not exported to ONNX")
+
+    return ORTModelForCausalLM.from_pretrained(
+        onnx_dir, file_name=ONNX_BACKEND_FILE_NAMES[backend], use_cache=True
+    )
+
+
+@torch.no_grad()
+def run_case(
+    model,
+    case: BenchmarkCase,
+    prompt_length: int = DEFAULT_PROMPT_LENGTH,
+    num_requests: int = DEFAULT_NUM_REQUESTS,
+    seed: int = 0,
+) -> CaseResult:
+    generator = torch.Generator().manual_seed(seed)
+
+    def generate(max_new_tokens: int):
+        input_ids = torch.randint(
+            3,
+            model.config.vocab_size,
+            (case.batch_size, prompt_length),
+            generator=generator,
+        )
+        logits_processor = LogitsProcessorList()
+        if case.cfg:
+            logits_processor.append(
+                UnbatchedClassifierFreeGuidanceLogitsProcessor(
+                    guidance_scale=CFG_SCALE,
+                    model=model,
+                    unconditional_ids=torch.randint(
+                        3,
+                        model.config.vocab_size,
+                        (1, prompt_length),
+                        generator=generator,
+                    ),
+                    max_guidance_steps=(
+                        CFG_MAX_GUIDANCE_STEPS if case.cfg_schedule else None
+                    ),
+                    divergence_threshold=(
+                        CFG_DIVERGENCE_THRESHOLD if case.cfg_schedule else None
+                    ),
+                )
+            )
+
+        start_time = time.perf_counter()
+        model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            # all requests generate the same number of tokens
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=case.sampling,
+            **(
+                dict(
+                    temperature=SAMPLING_TEMPERATURE,
+                    top_p=SAMPLING_TOP_P,
+                    top_k=SAMPLING_TOP_K,
+                )
+                if case.sampling
+                else {}
+            ),
+            num_beams=case.num_beams,
+            logits_processor=logits_processor,
+            pad_token_id=model.config.eos_token_id,
+        )
+        return time.perf_counter() - start_time
+
+    # sampled tokens are the same for each run
+    torch.manual_seed(seed)
+    # warm up
+    generate(case.length)
+
+    first_token_latencies = [generate(1) for _ in range(num_requests)]
+    latencies = [generate(case.length) for _ in range(num_requests)]
+
+    return CaseResult(
+        case=case,
+        first_token_latency_ms=float(np.median(first_token_latencies)) * 1000,
+        tokens_per_second=case.batch_size * case.length * num_requests / sum(latencies),
+        p50_latency_ms=float(np.percentile(latencies, 50)) * 1000,
+        p95_latency_ms=float(np.percentile(latencies, 95)) * 1000,
+    )
+
+
+def run_backend(
+    backend: str,
+    checkpoint_dir: Path,
+    onnx_dir: Path | None,
+    cases: list[BenchmarkCase],
+    prompt_length: int = DEFAULT_PROMPT_LENGTH,
+    num_requests: int = DEFAULT_NUM_REQUESTS,
+) -> BackendResult:
+    """Loads the model with the backend and runs all cases.
+
+    Run in a new process to measure the peak RSS of the backend"""
+
+    result = BackendResult(backend=backend, baseline_rss_mb=_get_peak_rss_mb())
+    try:
+        start_time = time.perf_counter()
+        model = _load_model(backend, checkpoint_dir, onnx_dir)
+        result.load_time_s = time.perf_counter() - start_time
+
+        for case in cases:
+            logger.info(f"{backend}: {case}")
+            result.cases.append(
+                run_case(model, case, prompt_length, num_requests=num_requests)
+            )
+    except Exception as e:
+        # e.g. a backend failing to load or to run a case, the other backends still run
+        logger.exception(f"{backend} failed")
+        result.error = f"{type(e).__name__}: {e}"
+
+    result.peak_rss_mb = _get_peak_rss_mb()
+    return result
+
+
+def format_table(results: list[BackendResult]) -> str:
+    lines = [
+        "| backend | load (s) | peak RSS (MB) | batch | length | CFG | beams | sampling "
+        "| first token (ms) | tokens/s | p50 (ms) | p95 (ms) |",
+        "|---|---|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for result in results:
+        # cases finished before an error are still shown
+        for case_result in result.cases:
+            case = case_result.case
+            lines.append(
+                f"| {result.backend} | {result.load_time_s:.2f} "
+                f"| {result.peak_rss_mb:.0f} | {case.batch_size} | {case.length} "
+                f"| {case.cfg_name} | {case.num_beams} "
+                f"| {'top-k/top-p' if case.sampling else 'greedy'} "
+                f"| {case_result.first_token_latency_ms:.1f} "
+                f"| {case_result.tokens_per_second:.1f} "
+                f"| {case_result.p50_latency_ms:.1f} | {case_result.p95_latency_ms:.1f} |"
+            )
+        if result.error is not None:
+            lines.append(f"| {result.backend} | {result.error} |")
+
+    return "\n".join(lines)
+
+
+def _export_if_possible(checkpoint_dir: Path, onnx_dir: Path) -> Path | None:
+    try:
+        export_onnx(checkpoint_dir, onnx_dir)
+        quantize_onnx(onnx_dir)
+    except ImportError as e:
+        logger.warning(f"ONNX backends are skipped: {e}")
+        return None
+
+    return onnx_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the model backends on a locally generated model"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="a local checkpoint to benchmark instead of a generated model",
+    )
+    parser.add_argument("--output", type=Path, help="the JSON file of the results")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=DEFAULT_BATCH_SIZES
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=DEFAULT_LENGTHS)
+    parser.add_argument("--num-beams", type=int, nargs="+", default=DEFAULT_NUM_BEAMS)
+    parser.add_argument("--prompt-length", type=int, default=DEFAULT_PROMPT_LENGTH)
+    parser.add_argument("--num-requests", type=int, default=DEFAULT_NUM_REQUESTS)
+    parser.add_argument("--vocab-size", type=int, default=DEFAULT_VOCAB_SIZE)
+    parser.add_argument("--hidden-size", type=int, default=DEFAULT_HIDDEN_SIZE)
+    parser.add_argument("--num-layers", type=int, default=DEFAULT_NUM_LAYERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    cases = get_benchmark_cases(args.batch_sizes, args.lengths, args.num_beams)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_dir: Path = args.checkpoint or Path(tmp_dir) / "checkpoint"
+        if args.checkpoint is None:
+            create_benchmark_model(
+                checkpoint_dir, args.vocab_size, args.hidden_size, args.num_layers
+            )
+
+        onnx_dir = None
+        if any(backend != ORIGINAL_BACKEND for backend in args.backends):
+            onnx_dir = _export_if_possible(checkpoint_dir, Path(tmp_dir) / "onnx")
+
+        results = []
+        # a new process for each backend, so that peak RSS is not shared
+        context = multiprocessing.get_context("spawn")
+        for backend in args.backends:
+            with context.Pool(1) as pool:
+                results.append(
+                    pool.apply(
+                        run_backend,
+                        (
+                            backend,
+                            checkpoint_dir,
+                            onnx_dir,
+                            cases,
+                            args.prompt_length,
+                            args.num_requests,
+                        ),
+                    )
+                )
+
+    print(format_table(results))
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps([asdict(result) for result in results], indent=2)
+        )
+        logger.info(f"Saved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""A co-occurrence index of tags, sampled by the fallback upsampler.
+
+Usage: python -m dart.fallback [--model MODEL] [--output INDEX_JSON] [--draft-output DRAFT_JSON]
+
+Builds the index from outputs of the model for the tags in tags/, so that the fallback has
+tags to sample before any request is upsampled by the model. The draft table of speculative
+decoding is built from the same outputs."""
+
+import argparse
+import json
+import logging
+import random
+import threading
+from pathlib import Path
+from typing import Callable, Container, Iterable
+
+logger = logging.getLogger(__name__)
+
+# the index of the extension, loaded by the script
+DEFAULT_INDEX_PATH = Path(__file__).resolve().parent.parent / "cooccurrence.json"
+DEFAULT_DRAFT_PATH = Path(__file__).resolve().parent.parent / "draft.json"
+DEFAULT_TAGS_DIR = Path(__file__).resolve().parent.parent / "tags"
+DEFAULT_MODEL_NAME = "p1atdev/dart-v1-sft"
+
+# the number of copyright, character and general tags used as inputs to build the index
+DEFAULT_NUM_INPUTS = 300
+
+# the number of co-occurring tags kept for each input tag
+MAX_COOCCURRING_TAGS = 64
+# the number of tags kept in the prior, the general inputs of the build are taken from it
+MAX_PRIOR_TAGS = 4096
+
+# the number of total tags the fallback aims at for each length tag
+LENGTH_TAG_NUM_TAGS = {
+    "<|very_short|>": 8,
+    "<|short|>": 16,
+    "<|long|>": 32,
+    "<|very_long|>": 48,
+}
+
+
+class CooccurrenceFallback:
+    """A fast upsampler which samples tags co-occurring with the input tags.
+
+    The index maps each input tag id to the counts of the tags generated with it."""
+
+    def __init__(self, tokenizer_name: str | None = None):
+        # token ids of the index are only valid for this tokenizer
+        self.tokenizer_name = tokenizer_name
+        # input tag id -> output tag id -> count
+        self.table: dict[int, dict[int, int]] = {}
+        # output tag id -> count, used when no input tag is known
+        self.prior: dict[int, int] = {}
+        self.updated = False
+        # updated and read by concurrent requests
+        self.lock = threading.Lock()
+
+    def _count(self, counts: dict[int, int], token_id: int, max_size: int):
+        counts[token_id] = counts.get(token_id, 0) + 1
+
+        if len(counts) > max_size:
+            # forget the rarest one
+            del counts[min(counts, key=counts.__getitem__)]
+
+    def update(self, input_ids: Iterable[int], output_ids: Iterable[int]):
+        """Counts output tags co-occurring with input tags"""
+
+        input_ids = list(input_ids)
+        with self.lock:
+            for output_id in output_ids:
+                self._count(self.prior, output_id, MAX_PRIOR_TAGS)
+                for input_id in input_ids:
+                    self._count(
+                        self.table.setdefault(input_id, {}),
+                        output_id,
+                        MAX_COOCCURRING_TAGS,
+                    )
+
+            self.updated = True
+
+    def generate(
+        self,
+        input_ids: list[int],
+        num_tags: int,
+        seed: int,
+        excluded_ids: set[int] | None = None,
+    ) -> list[int]:
+        """Samples at most `num_tags` tag ids weighted by co-occurrence counts"""
+
+        excluded_ids = set(input_ids) | (excluded_ids or set())
+
+        weights: dict[int, float] = {}
+        with self.lock:
+            for input_id in input_ids:
+                for output_id, count in self.table.get(input_id, {}).items():
+                    weights[output_id] = weights.get(output_id, 0) + count
+            if len(weights) == 0:
+                weights = {output_id: count for output_id, count in self.prior.items()}
+
+        candidates = [
+            (output_id, weight)
+            for output_id, weight in weights.items()
+            if output_id not in excluded_ids
+        ]
+
+        # weighted sampling without replacement (Efraimidis-Spirakis)
+        rng = random.Random(seed)
+        keyed = sorted(
+            candidates,
+            key=lambda item: rng.random() ** (1 / item[1]),
+            reverse=True,
+        )
+
+        return [output_id for output_id, _weight in keyed[:num_tags]]
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "tokenizer_name": self.tokenizer_name,
+                "table": {
+                    str(input_id): {str(k): v for k, v in counts.items()}
+                    for input_id, counts in self.table.items()
+                },
+                "prior": {str(k): v for k, v in self.prior.items()},
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CooccurrenceFallback":
+        fallback = cls(data.get("tokenizer_name"))
+        fallback.table = {
+            int(input_id): {int(k): v for k, v in counts.items()}
+            for input_id, counts in data["table"].items()
+        }
+        fallback.prior = {int(k): v for k, v in data["prior"].items()}
+        return fallback
+
+    def save(self, path: Path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file)
+        self.updated = False
+
+    @classmethod
+    def load(
+        cls, path: Path, tokenizer_name: str | None = None
+    ) -> "CooccurrenceFallback":
+        """Loads the index built for the tokenizer, or returns an empty index"""
+
+        if not path.exists():
+            logger.warning(
+                f"Co-occurrence index is not found: {path}, build it with python -m dart.fallback"
+            )
+            return cls(tokenizer_name)
+
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                fallback = cls.from_dict(json.load(file))
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            logger.error(f"Failed to load co-occurrence index: {path} ({e})")
+            return cls(tokenizer_name)
+
+        if (
+            tokenizer_name is not None
+            and fallback.tokenizer_name is not None
+            and fallback.tokenizer_name != tokenizer_name
+        ):
+            logger.warning(
+                f"Co-occurrence index is not used, it is built for {fallback.tokenizer_name}"
+            )
+            return cls(tokenizer_name)
+
+        return fallback
+
+
+def get_build_inputs(
+    tags_dir: Path, vocab: Container[str], num_inputs: int, seed: int = 0
+) -> list[tuple[str, str]]:
+    """Returns (copyright, character) inputs for building the index.
+
+    Samples `num_inputs` copyright tags and character tags in the vocab, each as a prompt
+    """
+
+    rng = random.Random(seed)
+    inputs = []
+    for file_name, category in [("copyright.txt", 0), ("character.txt", 1)]:
+        tags = [
+            tag
+            for tag in (tags_dir / file_name).read_text(encoding="utf-8").splitlines()
+            if tag in vocab
+        ]
+        for tag in rng.sample(tags, min(num_inputs, len(tags))):
+            inputs.append((tag, "") if category == 0 else ("", tag))
+
+    return inputs
+
+
+def build_index(
+    inputs: list[tuple[str, str]],
+    generate: Callable[[str, str, str], tuple[list[int], list[int]]],
+    convert_ids_to_tokens: Callable[[list[int]], list[str]],
+    num_general_inputs: int,
+    tokenizer_name: str | None = None,
+) -> CooccurrenceFallback:
+    """Builds the index from the outputs of `generate`.
+
+    `generate` takes copyright, character and general tags, and returns the ids of the input
+    tags and the generated tags. The most frequent generated tags are then used as general
+    inputs"""
+
+    fallback = CooccurrenceFallback(tokenizer_name)
+    for i, (copyright, character) in enumerate(inputs):
+        fallback.update(*generate(copyright, character, ""))
+        if (i + 1) % 50 == 0:
+            logger.info(f"Upsampled {i + 1}/{len(inputs)} copyright and character tags")
+
+    general_ids = sorted(fallback.prior, key=fallback.prior.__getitem__, reverse=True)
+    for tag in convert_ids_to_tokens(general_ids[:num_general_inputs]):
+        fallback.update(*generate("", "", tag))
+
+    return fallback
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the co-occurrence index of the fallback upsampler"
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    parser.add_argument("--tokenizer", help="defaults to the model")
+    parser.add_argument("--tags-dir", type=Path, default=DEFAULT_TAGS_DIR)
+    parser.add_argument("--output", type=Path, default=DEFAULT_INDEX_PATH)
+    parser.add_argument("--draft-output", type=Path, default=DEFAULT_DRAFT_PATH)
+    parser.add_argument("--num-inputs", type=int, default=DEFAULT_NUM_INPUTS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # heavy, and only needed by this tool
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    from dart.speculative import TagCooccurrenceDraft
+
+    tokenizer_name = args.tokenizer or args.model
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model).eval()
+    special_ids = set(tokenizer.get_added_vocab().values())
+    torch.manual_seed(args.seed)
+    draft = TagCooccurrenceDraft(tokenizer_name)
+
+    @torch.no_grad()
+    def generate(copyright: str, character: str, general: str):
+        # the same as DartGenerator.compose_prompt
+        prompt = (
+            f"<|bos|><rating>rating:sfw, rating:general</rating>"
+            f"<copyright>{copyright}</copyright><character>{character}</character>"
+            f"<general><|long|>{general}<|input_end|>"
+        )
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        output_ids = model.generate(
+            input_ids,
+            max_new_tokens=128,
+            do_sample=True,
+            top_k=30,
+            no_repeat_ngram_size=1,
+        )
+        generated_ids = output_ids[0][input_ids.shape[1] :].tolist()
+        # the same sequence as DartGenerator learns from, the last prompt token included
+        draft.update(input_ids[0, -1:].tolist() + generated_ids)
+        return (
+            [id for id in input_ids[0].tolist() if id not in special_ids],
+            [id for id in generated_ids if id not in special_ids],
+        )
+
+    fallback = build_index(
+        get_build_inputs(args.tags_dir, tokenizer.vocab, args.num_inputs, args.seed),
+        generate,
+        tokenizer.convert_ids_to_tokens,
+        num_general_inputs=args.num_inputs,
+        tokenizer_name=tokenizer_name,
+    )
+    fallback.save(args.output)
+    logger.info(f"Saved the co-occurrence index to {args.output}")
+    draft.save(args.draft_output)
+    logger.info(f"Saved the draft table to {args.draft_output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,37 +2,96 @@ import logging
 
 import time
 import re
+import threading
+from contextlib import nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 import torch
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    PreTrainedModel,
-    PreTrainedTokenizer,
-    PreTrainedTokenizerFast,
-    LogitsProcessorList,
-)
-from optimum.onnxruntime import ORTModelForCausalLM
+from transformers import set_seed, LogitsProcessorList
+from huggingface_hub import snapshot_download
 
 from modules.shared import opts
 
-from dart.settings import MODEL_BACKEND_TYPE, parse_options
+from dart.settings import MODEL_BACKEND_TYPE, UPSAMPLING_ENGINE_TYPE, parse_options
 from dart.utils import (
+    LRUCache,
     escape_webui_special_symbols,
     get_valid_tag_list,
     get_patterns_from_tag_list,
+    pad_input_ids_left,
+)
+from dart.fallback import LENGTH_TAG_NUM_TAGS, CooccurrenceFallback
+from dart.model_manager import ModelKey, ModelManager
+from dart.model_pool import ModelPool
+from dart.snapshot import (
+    ONNX_CONFIG_PATTERNS,
+    TOKENIZER_PATTERNS,
+    TORCH_MODEL_PATTERNS,
+    TORCH_MODEL_REQUIRED_PATTERNS,
+    SnapshotError,
+    SnapshotResolver,
+    find_file,
+    get_onnx_patterns,
+    get_snapshot_name,
+)
+from dart.pruned_head import prune_output_vocab
+from dart.shared_weights import (
+    add_shared_initializers,
+    get_external_data_model,
+    get_memory_usage,
+    load_shared_torch_model,
+)
+from dart.tag_tokenizer import (
+    TagTokenizer,
+    VerifiedTokenizers,
+    verify_tag_tokenizer,
 )
-from dart.logits_processor import UnbatchedClassifierFreeGuidanceLogitsProcessor
+from dart.token_budget import LengthTokenBudget
+from dart.beam_search import beam_search_generate, get_max_num_beams
+from dart.batch import batch_generate
+from dart.speculative import (
+    TagCooccurrenceDraft,
+    get_logits_processors,
+    speculative_generate,
+)
+from dart.logits_processor import (
+    UNCONDITIONAL_CACHE_SIZE,
+    GeneratorSamplingLogitsProcessor,
+    UnbatchedClassifierFreeGuidanceLogitsProcessor,
+)
+
+if TYPE_CHECKING:
+    # imported when the backend or the tokenizer is first used, to keep the startup fast
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import (
+        PreTrainedModel,
+        PreTrainedTokenizer,
+        PreTrainedTokenizerFast,
+    )
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# the number of composed prompts whose input_ids are kept
+PROMPT_CACHE_SIZE = 64
+
+
+def _load_remote_tokenizer(
+    tokenizer_path: str,
+) -> "PreTrainedTokenizer | PreTrainedTokenizerFast":
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+
 
 class DartGenerator:
     """A class for generating danbooru tags"""
 
-    dart_model: PreTrainedModel | ORTModelForCausalLM | None = None
-    dart_tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast | None = None
+    dart_model: "PreTrainedModel | ORTModelForCausalLM | None" = None
+    dart_tokenizer: (
+        "PreTrainedTokenizer | PreTrainedTokenizerFast | TagTokenizer | None"
+    ) = None
 
     def __init__(
         self,
@@ -40,6 +99,10 @@ class DartGenerator:
         tokenizer_name: str,
         model_backend: str,
         model_device: str = "cpu",
+        snapshot_manifest_path: Path | None = None,
+        shared_weights_dir: Path | None = None,
+        verified_tokenizers_path: Path | None = None,
+        draft_path: Path | None = None,
     ):
         self.options = parse_options(opts)
 
@@ -52,33 +115,320 @@ class DartGenerator:
         self.model_backend = model_backend
         self.model_device = model_device
 
+        # composed prompt -> input_ids
+        self.prompt_cache: LRUCache[str, torch.Tensor] = LRUCache(PROMPT_CACHE_SIZE)
+        # negative input_ids -> prefilled states of the unconditional branch
+        self.unconditional_cache: LRUCache = LRUCache(UNCONDITIONAL_CACHE_SIZE)
+        # which tags follow, built offline and learned from outputs for speculative decoding
+        self.draft_path = draft_path
+        self.draft = self._load_draft(tokenizer_name)
+        # token ids the pruned output projection keeps
+        self.output_token_ids: list[int] | None = None
+        # ORT models are loaded with profiling enabled if this is set
+        self.ort_profile_prefix: str | None = None
+        # input tag -> co-occurring output tags, used while the model is not available
+        self.fallback = CooccurrenceFallback(tokenizer_name)
+        # observed output lengths for each length tag
+        self.token_budget = LengthTokenBudget()
+        # token id -> output tag, escaped if needed. None for special tokens
+        self.output_table: list[str | None] | None = None
+        # models and tokenizers are loaded from local snapshots without accessing the hub
+        self.snapshots = (
+            SnapshotResolver(snapshot_manifest_path)
+            if snapshot_manifest_path is not None
+            and self.options["use_local_snapshots"]
+            else None
+        )
+        # tokenizer files the native tag tokenizer is known to match
+        self.verified_tokenizers = (
+            VerifiedTokenizers(verified_tokenizers_path)
+            if verified_tokenizers_path is not None
+            else None
+        )
+        # weights are memory-mapped so that processes on the same host share them.
+        # converted ONNX models are saved in this directory
+        self.shared_weights_dir = (
+            shared_weights_dir if self.options["shared_model_weights"] else None
+        )
+
+        self.model_lock = threading.Lock()
+        self.model_loading_thread: threading.Thread | None = None
+        self.model_manager = ModelManager(
+            memory_budget_mb=float(self.options["model_memory_budget"]),
+            idle_timeout_minutes=float(self.options["model_idle_timeout"]),
+            on_evict=self._on_model_evicted,
+        )
+        # lends the model to concurrent requests
+        self.model_pool = ModelPool(
+            int(self.options["model_pool_size"]), create_replica=self._create_dart_model
+        )
+        # concurrent beam sampling of generate has to use the global RNG in turn
+        self.rng_lock = threading.Lock()
+
         if self.options["debug_logging"]:
             logger.setLevel(logging.DEBUG)
 
-    def _load_dart_model(
-        self,
-    ):
+    def _resolve_model_files(self) -> tuple[str, dict]:
+        """Returns the path to load the model from and the arguments for ORT models"""
+
+        onnx_file_name = (
+            "model_quantized.onnx"
+            if self.model_backend == MODEL_BACKEND_TYPE["ONNX_QUANTIZED"]
+            else None
+        )
+        if self.snapshots is None and self.shared_weights_dir is None:
+            return self.model_name, {"file_name": onnx_file_name}
+
         if self.model_backend == MODEL_BACKEND_TYPE["ORIGINAL"]:
-            self.dart_model = AutoModelForCausalLM.from_pretrained(self.model_name)
-        else:
-            self.dart_model = ORTModelForCausalLM.from_pretrained(
+            local_dir, _files = self._get_local_files(
+                allow_patterns=TORCH_MODEL_PATTERNS,
+                required_patterns=TORCH_MODEL_REQUIRED_PATTERNS,
+            )
+            return str(local_dir), {}
+
+        onnx_file_name = onnx_file_name or "model.onnx"
+        local_dir, files = self._get_local_files(
+            allow_patterns=get_onnx_patterns(onnx_file_name),
+            required_patterns=[
+                ONNX_CONFIG_PATTERNS,
+                [onnx_file_name, f"*/{onnx_file_name}"],
+            ],
+        )
+        # the ONNX file can be in a subfolder
+        relative_path = Path(find_file(files, onnx_file_name))  # type: ignore
+        return str(local_dir), {
+            "file_name": relative_path.name,
+            "subfolder": (
+                ""
+                if relative_path.parent == Path(".")
+                else relative_path.parent.as_posix()
+            ),
+        }
+
+    def _get_local_files(
+        self, allow_patterns: list[str], required_patterns: list[list[str]]
+    ) -> tuple[Path, list[str]]:
+        if self.snapshots is not None:
+            return self.snapshots.resolve(
+                get_snapshot_name(self.model_name, self.model_backend),
                 self.model_name,
-                file_name=(
-                    "model_quantized.onnx"
-                    if self.model_backend == MODEL_BACKEND_TYPE["ONNX_QUANTIZED"]
-                    else None
-                ),
+                allow_patterns=allow_patterns,
+                required_patterns=required_patterns,
+            )
+
+        # local snapshots are disabled, but memory-mapped weights need local files.
+        # only a local directory or the hub cache is used, without accessing the hub
+        local_dir = Path(self.model_name)
+        if not local_dir.is_dir():
+            try:
+                local_dir = Path(
+                    snapshot_download(
+                        self.model_name,
+                        allow_patterns=allow_patterns,
+                        local_files_only=True,
+                    )
+                )
+            except OSError as e:
+                raise SnapshotError(
+                    f"{self.model_name} is not downloaded. Enable local snapshots to download it once: {e}"
+                ) from e
+        files = sorted(
+            path.relative_to(local_dir).as_posix()
+            for path in local_dir.rglob("*")
+            if path.is_file()
+        )
+        return local_dir, files
+
+    def _create_dart_model(self) -> "PreTrainedModel | ORTModelForCausalLM":
+        model_path, ort_kwargs = self._resolve_model_files()
+
+        if self.model_backend == MODEL_BACKEND_TYPE["ORIGINAL"]:
+            from transformers import AutoModelForCausalLM
+
+            dart_model = None
+            if self.shared_weights_dir is not None:
+                try:
+                    dart_model = load_shared_torch_model(Path(model_path))
+                except ValueError as e:
+                    logger.warning(f"Model weights are not shared: {e}")
+            if dart_model is None:
+                dart_model = AutoModelForCausalLM.from_pretrained(model_path)
+            if self.output_token_ids is not None:
+                prune_output_vocab(dart_model, self.output_token_ids)
+        else:
+            import onnxruntime as ort
+            from optimum.onnxruntime import ORTModelForCausalLM
+
+            if self.output_token_ids is not None:
+                logger.warning(
+                    f"Pruning output vocabulary is not supported by {self.model_backend} backend"
+                )
+            session_options = None
+            if self.ort_profile_prefix is not None:
+                session_options = ort.SessionOptions()
+                session_options.enable_profiling = True
+                session_options.profile_file_prefix = self.ort_profile_prefix
+
+            shared_initializers = None
+            if self.shared_weights_dir is not None:
+                session_options = session_options or ort.SessionOptions()
+                onnx_path = get_external_data_model(
+                    Path(model_path)
+                    / ort_kwargs["subfolder"]
+                    / ort_kwargs["file_name"],
+                    self.shared_weights_dir,
+                    config_dir=Path(model_path),
+                )
+                model_path, ort_kwargs = str(onnx_path.parent), {
+                    "file_name": onnx_path.name
+                }
+                shared_initializers = add_shared_initializers(
+                    session_options, onnx_path
+                )
+
+            dart_model = ORTModelForCausalLM.from_pretrained(
+                model_path,
+                session_options=session_options,
+                **ort_kwargs,
+            )
+            if shared_initializers is not None:
+                # the memory of the initializers must outlive the session
+                dart_model.shared_initializers = shared_initializers
+        if self.snapshots is not None:
+            self.snapshots.confirm(
+                get_snapshot_name(self.model_name, self.model_backend)
             )
         logger.info(f"Dart model backend is {self.model_backend }")
 
-        assert self.dart_model is not None
+        assert dart_model is not None
+
+        dart_model.to(self.model_device)  # type: ignore
+
+        memory_usage = get_memory_usage()
+        if memory_usage is not None:
+            logger.info(f"Memory after loading the Dart model: {memory_usage}")
+
+        return dart_model
+
+    def _load_dart_model(
+        self,
+    ):
+        # prefilled states of another model can not be reused
+        self.unconditional_cache.clear()
+
+        self.dart_model = self._create_dart_model()
+
+        return self.dart_model
+
+    def _get_model_key(self) -> ModelKey:
+        return self.model_name, self.model_backend
+
+    def _on_model_evicted(self, key: ModelKey):
+        if key == self._get_model_key():
+            # loaded again on the next request
+            self.dart_model = None
+            self.unconditional_cache.clear()
+            self.model_pool.set_model(None)
+
+    def set_model(self, model_name: str, model_backend: str):
+        """Switches the model used by the next request"""
+
+        assert model_backend in list(
+            MODEL_BACKEND_TYPE.values()
+        ), f"Unknown model type: {model_backend}"
+
+        if (model_name, model_backend) == self._get_model_key():
+            return
+
+        with self.model_lock:
+            logger.info(f"Switching Dart model to {model_name} ({model_backend})")
+            self.model_name = model_name
+            self.model_backend = model_backend
+            self.dart_model = None
+            self.unconditional_cache.clear()
+            # replicas of the previous model are not lent any more
+            self.model_pool.set_model(None)
 
-        self.dart_model.to(self.model_device)  # type: ignore
+    def set_tokenizer(self, tokenizer_name: str):
+        """Switches the tokenizer used by the next request.
+
+        States depending on token ids are reset."""
+
+        if tokenizer_name == self.tokenizer_name:
+            return
+
+        with self.model_lock:
+            logger.info(f"Switching Dart tokenizer to {tokenizer_name}")
+            self.tokenizer_name = tokenizer_name
+            self.dart_tokenizer = None
+            self.output_table = None
+            self.prompt_cache.clear()
+            self.unconditional_cache.clear()
+            self.draft = self._load_draft(tokenizer_name)
+            self.fallback = CooccurrenceFallback(tokenizer_name)
+            self.token_budget = LengthTokenBudget()
+            if self.output_token_ids is not None:
+                # models are loaded again with the new output vocabulary
+                self.output_token_ids = None
+                for key in list(self.model_manager.models.keys()):
+                    self.model_manager.evict(key)
+
+    def enable_ort_profiling(self, profile_prefix: str):
+        """Reloads the ORT model with profiling enabled on the next request"""
+
+        if self.model_backend == MODEL_BACKEND_TYPE["ORIGINAL"]:
+            return
+
+        with self.model_lock:
+            self.ort_profile_prefix = profile_prefix
+            self.model_manager.evict(self._get_model_key())
 
     def _load_dart_tokenizer(self):
-        self.dart_tokenizer = AutoTokenizer.from_pretrained(
-            self.tokenizer_name, trust_remote_code=True
-        )
+        tokenizer_path = self.tokenizer_name
+        snapshot_name = get_snapshot_name(self.tokenizer_name, "tokenizer")
+        if self.snapshots is not None:
+            local_dir, _files = self.snapshots.resolve(
+                snapshot_name,
+                self.tokenizer_name,
+                allow_patterns=TOKENIZER_PATTERNS,
+                required_patterns=[["tokenizer_config.json"]],
+            )
+            tokenizer_path = str(local_dir)
+
+        reference = None
+        dart_tokenizer = None
+        if self.options["native_tag_tokenizer"]:
+            try:
+                tag_tokenizer = TagTokenizer.from_pretrained(tokenizer_path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Native tag tokenizer is not available: {e}")
+                tag_tokenizer = None
+
+            # verified once for each version of the tokenizer files
+            if tag_tokenizer is not None and not (
+                self.verified_tokenizers is not None
+                and tag_tokenizer.files_hash in self.verified_tokenizers
+            ):
+                reference = _load_remote_tokenizer(tokenizer_path)
+                mismatches = verify_tag_tokenizer(tag_tokenizer, reference)
+                if len(mismatches) > 0:
+                    logger.warning(
+                        f"Native tag tokenizer is not used, it differs from {self.tokenizer_name} on {len(mismatches)} texts"
+                    )
+                    tag_tokenizer = None
+                elif self.verified_tokenizers is not None:
+                    self.verified_tokenizers.add(tag_tokenizer.files_hash)  # type: ignore
+            dart_tokenizer = tag_tokenizer
+
+        if dart_tokenizer is None:
+            dart_tokenizer = (
+                reference
+                if reference is not None
+                else _load_remote_tokenizer(tokenizer_path)
+            )
+        if self.snapshots is not None:
+            self.snapshots.confirm(snapshot_name)
+        self.dart_tokenizer = dart_tokenizer
 
     def _check_model_avaiable(self):
         return self.dart_model is not None
@@ -87,8 +437,30 @@ class DartGenerator:
         return self.dart_tokenizer is not None
 
     def load_model_if_needed(self):
-        if not self._check_model_avaiable():
-            self._load_dart_model()
+        with self.model_lock:
+            if not self._check_model_avaiable():
+                self.dart_model = self.model_manager.get(
+                    self._get_model_key(), self._load_dart_model
+                )
+            else:
+                self.model_manager.touch(self._get_model_key())
+            self.model_pool.set_model(self.dart_model)
+
+    def load_model_in_background(self):
+        """Starts loading the model in another thread if it is not loaded yet"""
+
+        if self._check_model_avaiable():
+            return
+        if (
+            self.model_loading_thread is not None
+            and self.model_loading_thread.is_alive()
+        ):
+            return
+
+        self.model_loading_thread = threading.Thread(
+            target=self.load_model_if_needed, daemon=True
+        )
+        self.model_loading_thread.start()
 
     def load_tokenizer_if_needed(self):
         if not self._check_tokenizer_avaiable():
@@ -97,12 +469,101 @@ class DartGenerator:
     def get_vocab_list(self) -> list[str]:
         self.load_tokenizer_if_needed()
 
-        return list(self.dart_tokenizer.vocab.keys())  # type: ignore
+        vocab = self.dart_tokenizer.vocab  # type: ignore
+        # ordered by token ids
+        return sorted(vocab.keys(), key=vocab.__getitem__)
 
     def get_special_vocab_list(self) -> list[str]:
         self.load_tokenizer_if_needed()
 
-        return list(self.dart_tokenizer.get_added_vocab().values())  # type: ignore
+        return list(self.dart_tokenizer.get_added_vocab().keys())  # type: ignore
+
+    def get_tag_counts(self) -> dict[str, int]:
+        """Returns how often the model generates each tag, counted by the co-occurrence index"""
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        if self.fallback.tokenizer_name not in [None, self.tokenizer_name]:
+            # token ids of another tokenizer
+            return {}
+        with self.fallback.lock:
+            prior = dict(self.fallback.prior)
+
+        tags = self.dart_tokenizer.convert_ids_to_tokens(list(prior.keys()))
+        return dict(zip(tags, prior.values()))
+
+    def get_special_ids(self) -> set[int]:
+        self.load_tokenizer_if_needed()
+
+        return set(self.dart_tokenizer.get_added_vocab().values())  # type: ignore
+
+    def get_output_table(self) -> list[str | None]:
+        """Returns output tags indexed by token id, built once for each tokenizer"""
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        if self.output_table is None:
+            vocab: dict[str, int] = self.dart_tokenizer.vocab  # type: ignore
+            tokens = list(vocab.keys())
+            tags = (
+                escape_webui_special_symbols(tokens)
+                if self.options["escape_output_brackets"]
+                else tokens
+            )
+            # skipped like decode(skip_special_tokens=True)
+            special_ids = set(self.dart_tokenizer.all_special_ids)
+
+            output_table: list[str | None] = [None] * (max(vocab.values()) + 1)
+            for tag, id in zip(tags, vocab.values()):
+                if id not in special_ids:
+                    output_table[id] = tag
+            self.output_table = output_table
+
+        return self.output_table
+
+    def detokenize(self, token_ids: list[int]) -> str:
+        """Returns the output tags of the tokens joined in prompt format"""
+
+        output_table = self.get_output_table()
+        size = len(output_table)
+
+        return ", ".join(
+            tag
+            for id in token_ids
+            if id < size and (tag := output_table[id]) is not None
+        )
+
+    def set_output_tags(self, tags: list[str], ban_tags: str = ""):
+        """Restricts the output vocabulary of the model to the tags except for the ban tags.
+
+        Loaded models are unloaded, and it takes effect only for the original backend.
+        """
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        vocab: dict[str, int] = self.dart_tokenizer.vocab  # type: ignore
+        ban_ids = {ids[0] for ids in self.get_bad_words_ids(ban_tags) or []}
+        # e.g. rating, length and section tokens
+        special_ids = self.get_special_ids()
+
+        output_token_ids = (
+            {vocab[tag] for tag in tags if tag in vocab} - ban_ids - special_ids
+        )
+        # tokens which end generation
+        for token in [self.dart_tokenizer.eos_token, "</general>"]:
+            if token in vocab:
+                output_token_ids.add(vocab[token])
+
+        with self.model_lock:
+            if self.output_token_ids == sorted(output_token_ids):
+                return
+            self.output_token_ids = sorted(output_token_ids)
+            # models are loaded again with the new output vocabulary
+            for key in list(self.model_manager.models.keys()):
+                self.model_manager.evict(key)
 
     def compose_prompt(
         self, rating: str, copyright: str, character: str, general: str, length: str
@@ -124,6 +585,61 @@ class DartGenerator:
 
         return f"<|bos|><rating>{rating}</rating><copyright>{copyright}</copyright><character>{character}</character><general>{length}{general}<|input_end|>"
 
+    def encode_prompts(self, prompts: list[str]) -> list[torch.Tensor]:
+        """Tokenizes prompts in a batch and returns input_ids of each prompt.
+
+        Already tokenized prompts are taken from the cache."""
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        # dedup and keep the order
+        not_cached = [
+            prompt
+            for prompt in dict.fromkeys(prompts)
+            if prompt not in self.prompt_cache
+        ]
+        if len(not_cached) == 1:
+            self.prompt_cache.put(
+                not_cached[0],
+                self.dart_tokenizer.encode_plus(
+                    not_cached[0], return_tensors="pt"
+                ).input_ids,
+            )
+        elif len(not_cached) > 1:
+            encoded = self.dart_tokenizer(not_cached, padding=True, return_tensors="pt")
+            for prompt, ids, mask in zip(
+                not_cached, encoded.input_ids, encoded.attention_mask
+            ):
+                # remove padding
+                self.prompt_cache.put(prompt, ids[mask.bool()].unsqueeze(0))
+
+        input_ids = []
+        for prompt in prompts:
+            ids = self.prompt_cache.get(prompt)
+            if ids is None:
+                # more prompts than the cache size
+                ids = self.dart_tokenizer.encode_plus(
+                    prompt, return_tensors="pt"
+                ).input_ids
+            input_ids.append(ids)
+
+        return input_ids
+
+    def encode_prompt(self, prompt: str) -> torch.Tensor:
+        return self.encode_prompts([prompt])[0]
+
+    def get_length_tag(self, input_ids: list[int]) -> str | None:
+        """Returns the length tag in the prompt"""
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        for length_tag in LENGTH_TAG_NUM_TAGS.keys():
+            if self.dart_tokenizer.convert_tokens_to_ids(length_tag) in input_ids:
+                return length_tag
+        return None
+
     def get_bad_words_ids(self, tag_text: str) -> list[list[int]] | None:
         if tag_text.strip() == "":
             return None
@@ -150,11 +666,145 @@ class DartGenerator:
         # return type should be list[list[int]]
         return [[id] for id in ban_words_ids]
 
+    def _generate_ids(
+        self,
+        dart_model: "PreTrainedModel | ORTModelForCausalLM",
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        min_new_tokens: int,
+        do_sample: bool,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        num_beams: int,
+        bad_words_ids: list[list[int]] | None,
+        negative_prompt_ids: torch.Tensor | None,
+        cfg_scale: float,
+        cfg_max_guidance_steps: int | None,
+        cfg_divergence_threshold: float | None,
+        seed: int | None,
+    ) -> torch.Tensor:
+        assert self.dart_tokenizer is not None
+
+        # concurrent requests can not share the global RNG
+        generator = None
+        if seed is not None and self.model_pool.size > 1:
+            generator = torch.Generator(device=self.model_device).manual_seed(seed)
+        elif seed is not None:
+            set_seed(seed)
+
+        cfg_processor = (
+            UnbatchedClassifierFreeGuidanceLogitsProcessor(
+                guidance_scale=cfg_scale,
+                model=dart_model,
+                unconditional_ids=negative_prompt_ids,
+                prefix_cache=self.unconditional_cache,
+                max_guidance_steps=cfg_max_guidance_steps,
+                divergence_threshold=cfg_divergence_threshold,
+            )
+            if negative_prompt_ids is not None
+            else None
+        )
+
+        if num_beams > 1:
+            max_num_beams = get_max_num_beams(
+                dart_model,
+                input_ids.shape[1] + max_new_tokens,
+                memory_budget_mb=float(self.options["beam_search_memory_budget"]),
+                num_beams=num_beams,
+            )
+            if max_num_beams < num_beams:
+                logger.warning(
+                    f"num_beams is reduced from {num_beams} to {max_num_beams} to fit in the memory budget"
+                )
+                num_beams = max_num_beams
+
+        if num_beams > 1 and cfg_processor is None:
+            output_ids = beam_search_generate(
+                dart_model,
+                input_ids,
+                logits_processor=get_logits_processors(
+                    prompt_length=input_ids.shape[1],
+                    eos_token_id=self.dart_tokenizer.eos_token_id,  # type: ignore
+                    min_new_tokens=min_new_tokens,
+                    # warpers are used only for sampling
+                    temperature=temperature if do_sample else 1.0,
+                    top_p=top_p if do_sample else 1.0,
+                    top_k=top_k if do_sample else 0,
+                    bad_words_ids=bad_words_ids,
+                ),
+                eos_token_id=self.dart_tokenizer.eos_token_id,  # type: ignore
+                max_new_tokens=max_new_tokens,
+                num_beams=num_beams,
+                do_sample=do_sample,
+                generator=generator,
+            )
+        elif (
+            self.options["speculative_decoding"]
+            and num_beams == 1
+            and cfg_processor is None
+        ):
+            output_ids = speculative_generate(
+                dart_model,
+                input_ids,
+                draft=self.draft,
+                logits_processor=get_logits_processors(
+                    prompt_length=input_ids.shape[1],
+                    eos_token_id=self.dart_tokenizer.eos_token_id,  # type: ignore
+                    min_new_tokens=min_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    bad_words_ids=bad_words_ids,
+                ),
+                eos_token_id=self.dart_tokenizer.eos_token_id,  # type: ignore
+                max_new_tokens=max_new_tokens,
+                do_sample=do_sample,
+                num_draft_tokens=int(self.options["num_draft_tags"]),
+                generator=generator,
+            )
+        else:
+            logits_processor = LogitsProcessorList()
+            if cfg_processor is not None:
+                logits_processor.append(cfg_processor)
+            # beam sampling of generate needs the scores of all tokens
+            use_global_rng = generator is not None and do_sample and num_beams > 1
+            if generator is not None and do_sample and num_beams == 1:
+                logits_processor.append(
+                    GeneratorSamplingLogitsProcessor(
+                        [generator], temperature=temperature, top_p=top_p, top_k=top_k
+                    )
+                )
+
+            with self.rng_lock if use_global_rng else nullcontext():
+                if use_global_rng:
+                    set_seed(seed)  # type: ignore
+                # output_ids is list[list[int]]
+                output_ids = dart_model.generate(
+                    input_ids,
+                    max_new_tokens=max_new_tokens,
+                    min_new_tokens=min_new_tokens,
+                    do_sample=do_sample,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    num_beams=num_beams,
+                    bad_words_ids=bad_words_ids,
+                    no_repeat_ngram_size=1,
+                    logits_processor=(
+                        logits_processor if len(logits_processor) > 0 else None
+                    ),
+                )
+        if cfg_processor is not None:
+            logger.debug(f"CFG has been applied to {cfg_processor.guided_steps} tags")
+
+        return output_ids
+
     @torch.no_grad()
     def generate(
         self,
         prompt: str,
-        max_new_tokens: int = 128,
+        max_new_tokens: int | None = None,
         min_new_tokens: int = 0,
         do_sample: bool = True,
         temperature: float = 1.0,
@@ -164,8 +814,13 @@ class DartGenerator:
         bad_words_ids: list[list[int]] | None = None,
         negative_prompt: str | None = None,
         cfg_scale: float = 1.5,
+        cfg_max_guidance_steps: int | None = None,
+        cfg_divergence_threshold: float | None = None,
+        seed: int | None = None,
     ) -> str:
-        """Upsamples prompt"""
+        """Upsamples prompt.
+
+        `max_new_tokens` defaults to the budget estimated for the length tag."""
 
         start_time = time.time()
 
@@ -175,54 +830,205 @@ class DartGenerator:
         assert self.dart_tokenizer is not None
         assert self.dart_model is not None
 
-        input_ids = self.dart_tokenizer.encode_plus(
-            prompt, return_tensors="pt"
-        ).input_ids
+        input_ids = self.encode_prompt(prompt)
+        length_tag = self.get_length_tag(input_ids[0].tolist())
+        if max_new_tokens is None:
+            max_new_tokens = self.token_budget.get(length_tag)
+            logger.debug(f"Token budget for {length_tag}: {max_new_tokens}")
         negative_prompt_ids = (
-            self.dart_tokenizer.encode_plus(
-                negative_prompt,
-                return_tensors="pt",
-            ).input_ids
-            if negative_prompt is not None
-            else None
+            self.encode_prompt(negative_prompt) if negative_prompt is not None else None
         )
 
-        # output_ids is list[list[int]]
-        output_ids = self.dart_model.generate(
-            input_ids,
+        with self.model_pool.checkout() as dart_model:
+            output_ids = self._generate_ids(
+                dart_model,
+                input_ids,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=min_new_tokens,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                num_beams=num_beams,
+                bad_words_ids=bad_words_ids,
+                negative_prompt_ids=negative_prompt_ids,
+                cfg_scale=cfg_scale,
+                cfg_max_guidance_steps=cfg_max_guidance_steps,
+                cfg_divergence_threshold=cfg_divergence_threshold,
+                seed=seed,
+            )
+        escaped = self._finish_generation(
+            input_ids[0].tolist(),
+            output_ids[0][len(input_ids[0]) :].tolist(),
             max_new_tokens=max_new_tokens,
+            length_tag=length_tag,
+        )
+
+        end_time = time.time()
+        logger.info(f"Upsampling tags has taken {end_time-start_time:.2f} seconds")
+
+        return escaped
+
+    def generate_batch(
+        self,
+        prompts: list[str],
+        seeds: list[int],
+        max_new_tokens: int | None = None,
+        min_new_tokens: int = 0,
+        do_sample: bool = True,
+        temperature: float = 1.0,
+        top_p: float = 1,
+        top_k: int = 20,
+        bad_words_ids: list[list[int]] | None = None,
+    ) -> list[str]:
+        """Upsamples prompts in one batch.
+
+        Each prompt is sampled with its own seed, so the tags are the same as those of `generate`
+        up to rounding errors. A prompt leaves the batch once it ends or reaches the budget of its
+        length tag. CFG, beam search and speculative decoding are not batched
+        """
+
+        start_time = time.time()
+
+        self.load_tokenizer_if_needed()
+        self.load_model_if_needed()
+
+        assert self.dart_tokenizer is not None
+        assert self.dart_model is not None
+
+        prompt_ids = self.encode_prompts(prompts)
+        length_tags = [self.get_length_tag(ids[0].tolist()) for ids in prompt_ids]
+        budgets = [
+            (
+                max_new_tokens
+                if max_new_tokens is not None
+                else self.token_budget.get(length_tag)
+            )
+            for length_tag in length_tags
+        ]
+        input_ids, attention_mask = pad_input_ids_left(prompt_ids)
+
+        logits_processor = get_logits_processors(
+            prompt_length=input_ids.shape[1],
+            eos_token_id=self.dart_tokenizer.eos_token_id,
             min_new_tokens=min_new_tokens,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            num_beams=num_beams,
+            temperature=temperature if do_sample else 1.0,
+            top_p=top_p if do_sample else 1.0,
+            top_k=top_k if do_sample else 0,
             bad_words_ids=bad_words_ids,
-            no_repeat_ngram_size=1,
-            logits_processor=(
-                LogitsProcessorList(
-                    [
-                        UnbatchedClassifierFreeGuidanceLogitsProcessor(
-                            guidance_scale=cfg_scale,
-                            model=self.dart_model,
-                            unconditional_ids=negative_prompt_ids,
-                        )
-                    ]
-                )
-                if negative_prompt_ids is not None
-                else None
-            ),
         )
 
-        decoded = self.dart_tokenizer.decode(
-            output_ids[0][len(input_ids[0]) :],
-            skip_special_tokens=True,
+        with self.model_pool.checkout() as dart_model:
+            # each prompt stops at its own budget
+            generated_ids = batch_generate(
+                dart_model,
+                input_ids,
+                attention_mask,
+                logits_processor=logits_processor,
+                eos_token_id=self.dart_tokenizer.eos_token_id,
+                max_new_tokens=budgets,
+                do_sample=do_sample,
+                generators=[
+                    torch.Generator(device=self.model_device).manual_seed(seed)
+                    for seed in seeds
+                ],
+            )
+
+        upsampled_tags = [
+            self._finish_generation(
+                ids[0].tolist(),
+                generated,
+                max_new_tokens=budget,
+                length_tag=length_tag,
+            )
+            for ids, generated, length_tag, budget in zip(
+                prompt_ids, generated_ids, length_tags, budgets, strict=True
+            )
+        ]
+
+        end_time = time.time()
+        logger.info(
+            f"Upsampling tags of {len(prompts)} prompts has taken {end_time-start_time:.2f} seconds"
+        )
+
+        return upsampled_tags
+
+    def _load_draft(self, tokenizer_name: str) -> TagCooccurrenceDraft:
+        if self.draft_path is None:
+            return TagCooccurrenceDraft(tokenizer_name)
+        return TagCooccurrenceDraft.load(self.draft_path, tokenizer_name=tokenizer_name)
+
+    def _finish_generation(
+        self,
+        input_ids: list[int],
+        generated_ids: list[int],
+        max_new_tokens: int,
+        length_tag: str | None,
+    ) -> str:
+        """Learns from the generated tags and returns them as text"""
+
+        assert self.dart_tokenizer is not None
+
+        # cut by the budget before the end of tags
+        truncated = (
+            len(generated_ids) >= max_new_tokens
+            and self.dart_tokenizer.eos_token_id not in generated_ids
         )
-        logger.debug(f"Generated tags: {decoded}")
+        self.token_budget.observe(length_tag, len(generated_ids), truncated)
+        if self.options["speculative_decoding"]:
+            # the last prompt token is followed by the first generated tag
+            self.draft.update(input_ids[-1:] + generated_ids)
 
-        escaped = ", ".join(escape_webui_special_symbols(decoded.split(", ")))
+        if (
+            self.options["fallback_online_update"]
+            and self.options["upsampling_engine"]
+            != UPSAMPLING_ENGINE_TYPE["ALWAYS_MODEL"]
+        ):
+            special_ids = self.get_special_ids()
+            self.fallback.update(
+                [id for id in input_ids if id not in special_ids],
+                [id for id in generated_ids if id not in special_ids],
+            )
+
+        escaped = self.detokenize(generated_ids)
+        logger.debug(f"Generated tags: {escaped}")
+
+        return escaped
+
+    def generate_fallback(
+        self,
+        prompt: str,
+        seed: int,
+        bad_words_ids: list[list[int]] | None = None,
+    ) -> str:
+        """Upsamples prompt with the co-occurrence index without the model"""
+
+        start_time = time.time()
+
+        self.load_tokenizer_if_needed()
+        assert self.dart_tokenizer is not None
+
+        input_ids = self.encode_prompt(prompt)[0].tolist()
+        special_ids = self.get_special_ids()
+        input_tag_ids = [id for id in input_ids if id not in special_ids]
+
+        num_tags = LENGTH_TAG_NUM_TAGS[self.get_length_tag(input_ids) or "<|long|>"]
+
+        output_ids = self.fallback.generate(
+            input_tag_ids,
+            num_tags=max(num_tags - len(input_tag_ids), 0),
+            seed=seed,
+            excluded_ids=special_ids
+            | {ids[0] for ids in bad_words_ids or [] if len(ids) == 1},
+        )
+        # dart outputs tags in alphabetical order
+        tags = self.dart_tokenizer.convert_ids_to_tokens(output_ids)
+        escaped = self.detokenize([id for _tag, id in sorted(zip(tags, output_ids))])
+        logger.debug(f"Generated tags (fallback): {escaped}")
 
         end_time = time.time()
-        logger.info(f"Upsampling tags has taken {end_time-start_time:.2f} seconds")
+        logger.info(
+            f"Upsampling tags with fallback has taken {end_time-start_time:.2f} seconds"
+        )
 
         return escaped
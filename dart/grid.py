@@ -0,0 +1,100 @@
+import csv
+import re
+from dataclasses import dataclass
+from io import StringIO
+from itertools import chain, permutations
+from typing import Any, Literal
+
+# the job text of each cell set by the X/Y/Z plot script, e.g. "3 out of 12"
+GRID_JOB_PATTERN = re.compile(r"(\d+) out of (\d+)")
+
+# int ranges of the X/Y/Z plot, e.g. "1-5", "1-10 (+2)" and "1-10 [4]"
+INT_RANGE_PATTERN = re.compile(
+    r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*"
+)
+INT_RANGE_COUNT_PATTERN = re.compile(
+    r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\[(\d+)\s*\])?\s*"
+)
+
+AXIS_KIND = Literal["seed", "text", "order"]
+
+# axes of the X/Y/Z plot changing upsampling prompts or seeds (label -> kind).
+# the other axes give the same upsampling requests in all cells
+GRID_PROMPT_AXES: dict[str, AXIS_KIND] = {
+    "Seed": "seed",
+    "Var. seed": "seed",
+    "Prompt S/R": "text",
+    "Prompt order": "order",
+}
+
+
+@dataclass(frozen=True)
+class UpsamplingRequest:
+    """Everything upsampled tags depend on, used as the key of upsampled tags"""
+
+    prompt: str
+    negative_prompt: str | None
+    seed: int
+    # temperature, top_p, top_k, num_beams, ban tags and cfg_scale
+    params: tuple
+
+
+def parse_grid_job(job: str) -> tuple[int, int] | None:
+    """Returns the cell number (from 1) and the number of cells of the X/Y/Z plot job"""
+
+    match = GRID_JOB_PATTERN.fullmatch(job.strip())
+    if match is None:
+        return None
+
+    return int(match.group(1)), int(match.group(2))
+
+
+def _split_values(text: str) -> list[str]:
+    # the same as csv_string_to_list_strip of the X/Y/Z plot
+    return [
+        value.strip()
+        for value in chain.from_iterable(
+            csv.reader(StringIO(text), skipinitialspace=True)
+        )
+        if value
+    ]
+
+
+def _expand_int_values(values: list[str]) -> list[int]:
+    ints = []
+    for value in values:
+        match = INT_RANGE_PATTERN.fullmatch(value)
+        count_match = INT_RANGE_COUNT_PATTERN.fullmatch(value)
+        if match is not None:
+            start, end = int(match.group(1)), int(match.group(2))
+            step = int(match.group(3)) if match.group(3) is not None else 1
+            ints.extend(range(start, end + 1, step))
+        elif count_match is not None:
+            start, end = int(count_match.group(1)), int(count_match.group(2))
+            num = int(count_match.group(3)) if count_match.group(3) is not None else 1
+            if num == 1:
+                ints.append(start)
+            else:
+                # the same as np.linspace(start, end, num)
+                step = (end - start) / (num - 1)
+                ints.extend(int(i * step + start) for i in range(num - 1))
+                ints.append(end)
+        else:
+            ints.append(int(value))
+
+    return ints
+
+
+def expand_axis_values(text: str, kind: AXIS_KIND) -> list[Any] | None:
+    """Parses axis values as the X/Y/Z plot does.
+
+    Returns None if the values are decided randomly by the X/Y/Z plot"""
+
+    values = _split_values(text)
+    if kind == "seed":
+        seeds = _expand_int_values(values)
+        return None if -1 in seeds else seeds
+    if kind == "order":
+        return list(permutations(values))
+
+    return values
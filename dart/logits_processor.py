@@ -13,23 +13,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import inspect
 import logging
-from typing import Optional
+from typing import Any, Optional
 
 import torch
 
-from transformers.generation import LogitsProcessor
+from transformers.generation import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from dart.utils import LRUCache
 
 logger = logging.Logger(__name__)
 
+# the number of negative prompts whose prefilled states are kept
+UNCONDITIONAL_CACHE_SIZE = 8
+
+
+def _clone_past_key_values(past_key_values: Any) -> Any:
+    """Returns a copy of past_key_values which can be extended independently"""
+
+    if past_key_values is None:
+        return None
+    if isinstance(past_key_values, torch.Tensor):
+        return past_key_values.clone()
+    if isinstance(past_key_values, (tuple, list)):
+        return type(past_key_values)(
+            _clone_past_key_values(item) for item in past_key_values
+        )
+
+    # e.g. Cache classes of newer transformers
+    return copy.deepcopy(past_key_values)
+
 
-# Copied from transformers.generation.logits_processor.UnbatchedClassifierFreeGuidanceLogitsProcessor
+def _get_last_logits_kwargs(model) -> dict[str, Any]:
+    """Returns kwargs to make the model compute the logits of the last position only, if supported"""
+
+    try:
+        parameters = inspect.signature(model.forward).parameters
+    except (TypeError, ValueError):
+        return {}
+
+    # the name differs between transformers versions
+    for name in ["logits_to_keep", "num_logits_to_keep"]:
+        if name in parameters:
+            return {name: 1}
+
+    # e.g. old transformers and ORT models
+    return {}
+
+
+# Based on transformers.generation.logits_processor.UnbatchedClassifierFreeGuidanceLogitsProcessor
 class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
     r"""
     Logits processor for Classifier-Free Guidance (CFG). The processors computes a weighted average across scores
     from prompt conditional and prompt unconditional (or negative) logits, parameterized by the `guidance_scale`.
     The unconditional scores are computed internally by prompting `model` with the `unconditional_ids` branch.
 
+    Unlike the original implementation, the model is asked for the logits of the last position only when it supports
+    it, and the guidance is computed in place with a preallocated buffer. When `unconditional_ids` has a single row and
+    the scores have multiple rows (e.g. batched prompts or beams), the unconditional branch is expanded to all rows.
+
     See [the paper](https://arxiv.org/abs/2306.17806) for more information.
 
     Args:
@@ -48,6 +98,16 @@ class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
             Attention mask for unconditional_ids.
         use_cache (`bool`, *optional*, defaults to `True`):
             Whether to cache key/values during the negative prompt forward pass.
+        prefix_cache (`LRUCache`, *optional*):
+            A cache of the prefilled states of the negative prompt, keyed by `unconditional_ids`. When provided, the
+            first pass of the same negative prompt reuses a copy of the cached past_key_values instead of prefilling
+            it again.
+        max_guidance_steps (`int`, *optional*):
+            The number of decoding steps (tags) to apply guidance for. After that, the unconditional branch is no longer
+            computed. If unset, guidance is applied on every step.
+        divergence_threshold (`float`, *optional*):
+            Stops guidance once the KL divergence between the conditional and the unconditional distributions exceeds
+            this value. If unset, the divergence is not checked.
 
 
     Examples:
@@ -83,9 +143,24 @@ class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
         unconditional_ids: Optional[torch.LongTensor] = None,
         unconditional_attention_mask: Optional[torch.LongTensor] = None,
         use_cache: Optional[bool] = True,
+        prefix_cache: Optional[LRUCache[tuple, tuple[torch.Tensor, Any]]] = None,
+        max_guidance_steps: Optional[int] = None,
+        divergence_threshold: Optional[float] = None,
     ):
         self.guidance_scale = guidance_scale
         self.model = model
+        self.prefix_cache = prefix_cache
+        self.max_guidance_steps = max_guidance_steps
+        self.divergence_threshold = divergence_threshold
+
+        # the number of steps guidance has been applied
+        self.guided_steps = 0
+        self.guidance_finished = max_guidance_steps == 0
+
+        self.forward_kwargs = _get_last_logits_kwargs(model)
+        # reused to store the unconditional log probabilities on every step
+        self.unconditional_buffer: torch.Tensor | None = None
+
         self.unconditional_context = {
             "input_ids": unconditional_ids,
             "attention_mask": unconditional_attention_mask,
@@ -94,6 +169,18 @@ class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
             "first_pass": True,
         }
 
+    def _get_prefix_cache_key(self) -> tuple | None:
+        if self.prefix_cache is None or not self.unconditional_context["use_cache"]:
+            return None
+
+        input_ids = self.unconditional_context["input_ids"]
+        attention_mask = self.unconditional_context["attention_mask"]
+        if not bool(attention_mask.all()):
+            # padded prompts are not shared
+            return None
+
+        return (tuple(input_ids.shape), *input_ids.flatten().tolist())
+
     def get_unconditional_logits(self, input_ids):
         if self.unconditional_context["first_pass"]:
             if self.unconditional_context["input_ids"] is None:
@@ -102,9 +189,43 @@ class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
                 self.unconditional_context["attention_mask"] = torch.ones_like(
                     self.unconditional_context["input_ids"], dtype=torch.long
                 )
+            num_rows = input_ids.shape[0]
+            if self.unconditional_context["input_ids"].shape[0] == 1 and num_rows > 1:
+                # share the negative prompt with all rows
+                for key in ["input_ids", "attention_mask"]:
+                    self.unconditional_context[key] = self.unconditional_context[
+                        key
+                    ].repeat(num_rows, 1)
             input_ids = self.unconditional_context["input_ids"]
             attention_mask = self.unconditional_context["attention_mask"]
             self.unconditional_context["first_pass"] = False
+
+            cache_key = self._get_prefix_cache_key()
+            if cache_key is not None:
+                assert self.prefix_cache is not None
+                cached = self.prefix_cache.get(cache_key)
+                if cached is not None:
+                    logger.debug("Reusing the prefilled negative prompt")
+                    logits, past_key_values = cached
+                    self.unconditional_context["past_key_values"] = (
+                        _clone_past_key_values(past_key_values)
+                    )
+                    return logits
+
+                out = self.model(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    use_cache=True,
+                    **self.forward_kwargs,
+                )
+                past_key_values = out.get("past_key_values", None)
+                # only the last position is used
+                logits = out.logits[:, -1:]
+                self.prefix_cache.put(cache_key, (logits, past_key_values))
+                self.unconditional_context["past_key_values"] = _clone_past_key_values(
+                    past_key_values
+                )
+                return logits
         else:
             attention_mask = torch.cat(
                 [
@@ -127,20 +248,130 @@ class UnbatchedClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
             attention_mask=attention_mask,
             use_cache=self.unconditional_context["use_cache"],
             past_key_values=self.unconditional_context["past_key_values"],
+            **self.forward_kwargs,
         )
         self.unconditional_context["past_key_values"] = out.get("past_key_values", None)
 
         return out.logits
 
+    def _should_stop_guidance(self, scores, unconditional_logits) -> bool:
+        if (
+            self.max_guidance_steps is not None
+            and self.guided_steps >= self.max_guidance_steps
+        ):
+            return True
+
+        if self.divergence_threshold is not None:
+            # KL(conditional || unconditional) of the most diverged row
+            # nansum ignores banned (-inf) tokens
+            divergence = torch.nansum(
+                scores.exp() * (scores - unconditional_logits), dim=-1
+            ).max()
+            if divergence.item() > self.divergence_threshold:
+                logger.debug(
+                    f"CFG stopped at step {self.guided_steps} (divergence: {divergence.item():.3f})"
+                )
+                return True
+
+        return False
+
+    def _log_softmax_into_buffer(
+        self, logits: torch.Tensor, scores: torch.Tensor
+    ) -> torch.Tensor:
+        """Computes log_softmax of logits into the preallocated buffer"""
+
+        if (
+            self.unconditional_buffer is None
+            or self.unconditional_buffer.shape != logits.shape
+            or self.unconditional_buffer.dtype != scores.dtype
+            or self.unconditional_buffer.device != scores.device
+        ):
+            self.unconditional_buffer = torch.empty(
+                logits.shape, dtype=scores.dtype, device=scores.device
+            )
+
+        buffer = self.unconditional_buffer
+        buffer.copy_(logits)
+        buffer.sub_(torch.logsumexp(buffer, dim=-1, keepdim=True))
+
+        return buffer
+
     def __call__(self, input_ids, scores):
         scores = torch.nn.functional.log_softmax(scores, dim=-1)
         if self.guidance_scale == 1:
             return scores
 
+        if self.guidance_finished:
+            # the unconditional branch is no longer computed
+            return scores
+
         logits = self.get_unconditional_logits(input_ids)
+        unconditional_logits = self._log_softmax_into_buffer(logits[:, -1], scores)
+
+        self.guided_steps += 1
+        # check before scores are overwritten
+        if self._should_stop_guidance(scores, unconditional_logits):
+            self.guidance_finished = True
 
-        unconditional_logits = torch.nn.functional.log_softmax(logits[:, -1], dim=-1)
-        out = (
-            self.guidance_scale * (scores - unconditional_logits) + unconditional_logits
+        # guidance_scale * (scores - unconditional_logits) + unconditional_logits
+        scores.sub_(unconditional_logits)
+        scores.mul_(self.guidance_scale)
+        scores.add_(unconditional_logits)
+        # tokens impossible in both branches (e.g. pruned output vocabulary) become nan
+        torch.nan_to_num_(
+            scores, nan=float("-inf"), posinf=float("inf"), neginf=float("-inf")
         )
-        return out
+
+        return scores
+
+
+class GeneratorSamplingLogitsProcessor(LogitsProcessor):
+    r"""
+    Samples the next token of each row with a `torch.Generator` of the request instead of the global RNG. The scores
+    of the sampled token are kept and all other scores are set to `-inf`, so that `generate` picks the sampled token.
+    A generator seeded with `seed` samples the same tokens as `generate` after `set_seed(seed)`.
+
+    The warpers are applied here before sampling, because `generate` applies its warpers after custom processors.
+    They leave the sampled token unchanged.
+
+    Args:
+        generators (`list[torch.Generator]`):
+            The random generators of the requests, one for each row of the batch.
+        temperature (`float`, *optional*, defaults to 1.0):
+            The same as `temperature` of `generate`.
+        top_p (`float`, *optional*, defaults to 1.0):
+            The same as `top_p` of `generate`.
+        top_k (`int`, *optional*, defaults to 0):
+            The same as `top_k` of `generate`. 0 means no limit.
+    """
+
+    def __init__(
+        self,
+        generators: list[torch.Generator],
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        top_k: int = 0,
+    ):
+        self.generators = generators
+        self.warpers = LogitsProcessorList()
+        if temperature != 1.0:
+            self.warpers.append(TemperatureLogitsWarper(temperature))
+        if top_k != 0:
+            self.warpers.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(top_p))
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        scores = self.warpers(input_ids, scores)
+        probs = torch.softmax(scores.float(), dim=-1)
+        # each row consumes only its own generator, as if it were generated alone
+        next_tokens = torch.cat(
+            [
+                torch.multinomial(probs[i : i + 1], num_samples=1, generator=generator)
+                for i, generator in enumerate(self.generators)
+            ]
+        )
+
+        sampled = torch.full_like(scores, -float("inf"))
+        sampled.scatter_(1, next_tokens, 0.0)
+        return sampled
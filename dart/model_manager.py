@@ -0,0 +1,164 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# interval of checking idle models (seconds)
+IDLE_CHECK_INTERVAL = 30
+
+ModelKey = tuple[str, str]  # (model name, backend)
+
+
+@dataclass
+class LoadedModel:
+    """A class of a model kept by ModelManager"""
+
+    model: Any
+    size_bytes: int
+    last_used: float = field(default_factory=time.time)
+
+
+def estimate_model_size(model: Any) -> int:
+    """Returns the approximate memory size of the model weights in bytes"""
+
+    if isinstance(model, torch.nn.Module):
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in [*model.parameters(), *model.buffers()]
+        )
+
+    # ORT models: the size of the onnx file and its external data
+    model_path = getattr(model, "model_path", None)
+    if model_path is not None and os.path.exists(model_path):
+        model_dir = os.path.dirname(model_path)
+        model_file = os.path.basename(model_path)
+        return sum(
+            os.path.getsize(os.path.join(model_dir, name))
+            for name in os.listdir(model_dir)
+            if name.startswith(model_file)
+        )
+
+    return 0
+
+
+def _get_rss_bytes() -> int | None:
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class ModelManager:
+    """Keeps loaded models under a memory budget and unloads idle ones.
+
+    Models are evicted in least-recently-used order and loaded again on the next request.
+    """
+
+    def __init__(
+        self,
+        memory_budget_mb: float = 0,
+        idle_timeout_minutes: float = 0,
+        on_evict: Callable[[ModelKey], None] | None = None,
+    ):
+        # 0 means unlimited
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.idle_timeout_seconds = idle_timeout_minutes * 60
+        self.on_evict = on_evict
+
+        self.models: OrderedDict[ModelKey, LoadedModel] = OrderedDict()
+        self.lock = threading.RLock()
+
+        if self.idle_timeout_seconds > 0:
+            threading.Thread(target=self._watch_idle_models, daemon=True).start()
+
+    def get(self, key: ModelKey, loader: Callable[[], Any]) -> Any:
+        """Returns the loaded model, loading it if needed"""
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.models[key].last_used = time.time()
+                return self.models[key].model
+
+            model = loader()
+            loaded = LoadedModel(model=model, size_bytes=estimate_model_size(model))
+            self.models[key] = loaded
+            logger.info(
+                f"Loaded {key[0]} ({key[1]}): {loaded.size_bytes / 1024 / 1024:.1f} MB"
+            )
+
+            self._evict_over_budget(keep=key)
+
+            return model
+
+    def touch(self, key: ModelKey):
+        with self.lock:
+            if key in self.models:
+                self.models[key].last_used = time.time()
+
+    def total_size_bytes(self) -> int:
+        return sum(loaded.size_bytes for loaded in self.models.values())
+
+    def _evict_over_budget(self, keep: ModelKey):
+        if self.memory_budget_bytes <= 0:
+            return
+
+        for key in list(self.models.keys()):
+            if self.total_size_bytes() <= self.memory_budget_bytes:
+                break
+            if key == keep:
+                # the model in use is kept even if it exceeds the budget
+                continue
+            self.evict(key)
+
+    def unload_idle(self):
+        """Unloads models not used for the idle timeout"""
+
+        now = time.time()
+        with self.lock:
+            for key, loaded in list(self.models.items()):
+                if now - loaded.last_used > self.idle_timeout_seconds:
+                    logger.info(f"Unloading idle model {key[0]} ({key[1]})")
+                    self.evict(key)
+
+    def evict(self, key: ModelKey):
+        with self.lock:
+            if key not in self.models:
+                return
+
+            rss_before = _get_rss_bytes()
+            loaded = self.models.pop(key)
+            del loaded.model
+            if self.on_evict is not None:
+                self.on_evict(key)
+
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            rss_after = _get_rss_bytes()
+            freed = (
+                f"RSS decreased by {(rss_before - rss_after) / 1024 / 1024:.1f} MB"
+                if rss_before is not None and rss_after is not None
+                else "RSS is not measured without psutil"
+            )
+            logger.info(
+                f"Evicted {key[0]} ({key[1]}): {loaded.size_bytes / 1024 / 1024:.1f} MB of weights; {freed}"
+            )
+
+    def _watch_idle_models(self):
+        while True:
+            time.sleep(IDLE_CHECK_INTERVAL)
+            self.unload_idle()
@@ -0,0 +1,98 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def can_share_model(model: Any) -> bool:
+    """Returns whether the model can run several requests at the same time.
+
+    Torch modules and ORT sessions are thread-safe in inference, but ORT models with IO binding
+    keep their output buffers in the model."""
+
+    if isinstance(model, torch.nn.Module):
+        return True
+    return not getattr(model, "use_io_binding", False)
+
+
+class ModelPool:
+    """Lends a model to each of at most `size` concurrent requests.
+
+    The loaded model is shared by all requests if it can be. Otherwise replicas are created
+    when concurrent requests need them and kept for later ones."""
+
+    def __init__(self, size: int, create_replica: Callable[[], Any]):
+        self.size = max(size, 1)
+        self.create_replica = create_replica
+
+        self.model: Any = None
+        self.idle_replicas: list[Any] = []
+        self.num_replicas = 0
+        # incremented when the model is replaced, so old replicas are not returned
+        self.version = 0
+
+        self.lock = threading.Lock()
+        # a single request does not need to pick a model
+        self.single_lock = threading.Lock()
+        self.slots = threading.Semaphore(self.size)
+
+    def set_model(self, model: Any):
+        with self.lock:
+            if model is self.model:
+                return
+            self.model = model
+            self.idle_replicas = []
+            self.num_replicas = 0
+            self.version += 1
+
+    def _take(self) -> tuple[Any, int]:
+        with self.lock:
+            version = self.version
+            if self.model is None:
+                raise RuntimeError("No model is loaded")
+            if can_share_model(self.model):
+                return self.model, version
+            if len(self.idle_replicas) > 0:
+                return self.idle_replicas.pop(), version
+            if self.num_replicas == 0:
+                # the loaded model is the first replica
+                self.num_replicas += 1
+                return self.model, version
+            self.num_replicas += 1
+
+        logger.info(
+            f"Creating model replica {self.num_replicas} for concurrent requests"
+        )
+        try:
+            return self.create_replica(), version
+        except Exception:
+            with self.lock:
+                self.num_replicas -= 1
+            raise
+
+    def _give_back(self, model: Any, version: int):
+        with self.lock:
+            if version == self.version and not can_share_model(model):
+                self.idle_replicas.append(model)
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        """Lends a model until the context exits, waiting while all slots are in use"""
+
+        if self.size == 1:
+            with self.single_lock:
+                if self.model is None:
+                    raise RuntimeError("No model is loaded")
+                yield self.model
+            return
+
+        with self.slots:
+            model, version = self._take()
+            try:
+                yield model
+            finally:
+                self._give_back(model, version)
@@ -0,0 +1,208 @@
+"""Exports a local Dart checkpoint to ONNX for the ONNX backends.
+
+Usage: python -m dart.onnx_export CHECKPOINT_DIR OUTPUT_DIR
+
+The exported model is validated against the torch model and registered in the snapshot
+manifest, so OUTPUT_DIR can be selected as the model with any backend."""
+
+import argparse
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+
+from dart.snapshot import (
+    TORCH_MODEL_PATTERNS,
+    TORCH_MODEL_REQUIRED_PATTERNS,
+    SnapshotResolver,
+    get_onnx_patterns,
+    get_snapshot_name,
+)
+
+logger = logging.getLogger(__name__)
+
+# the manifest of the extension, read by the generator
+DEFAULT_MANIFEST_PATH = Path(__file__).resolve().parent.parent / "snapshots.json"
+
+# backend (the values of MODEL_BACKEND_TYPE) -> ONNX file name
+ONNX_BACKEND_FILE_NAMES = {
+    "ONNX": "model.onnx",
+    "ONNX (Quantized)": "model_quantized.onnx",
+}
+ORIGINAL_BACKEND = "Original"
+
+VALIDATION_SEQUENCE_LENGTH = 32
+VALIDATION_NEW_TOKENS = 16
+# the maximum difference of logits of the exported model
+DEFAULT_ATOL = 1e-3
+# the minimum ratio of positions where the quantized model predicts the same token
+DEFAULT_MIN_TOP1_AGREEMENT = 0.9
+
+
+@dataclass
+class ValidationResult:
+    file_name: str
+    max_abs_diff: float
+    top1_agreement: float
+    # whether greedy generation with the cache gives the same tokens
+    same_generation: bool
+
+
+def export_onnx(checkpoint_dir: Path, output_dir: Path, opset: int | None = None):
+    """Exports the checkpoint to model.onnx, a decoder merged with and without KV cache.
+
+    Only local files are used."""
+
+    # heavy, and only needed by this tool
+    from optimum.exporters.onnx import main_export
+
+    main_export(
+        str(checkpoint_dir),
+        output=str(output_dir),
+        task="text-generation-with-past",
+        opset=opset,
+        device="cpu",
+        local_files_only=True,
+    )
+
+    if not (output_dir / ONNX_BACKEND_FILE_NAMES["ONNX"]).exists():
+        # older optimum exports separate decoders
+        raise RuntimeError(
+            f"model.onnx is not exported to {output_dir}, optimum>=1.14 is required"
+        )
+
+
+def quantize_onnx(output_dir: Path):
+    """Quantizes weights of model.onnx to int8 for CPU"""
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        output_dir / ONNX_BACKEND_FILE_NAMES["ONNX"],
+        output_dir / ONNX_BACKEND_FILE_NAMES["ONNX (Quantized)"],
+        weight_type=QuantType.QInt8,
+    )
+
+
+@torch.no_grad()
+def validate_onnx(
+    checkpoint_dir: Path, output_dir: Path, file_name: str, seed: int = 0
+) -> ValidationResult:
+    """Compares logits and greedy generation of the exported model with the torch model"""
+
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import AutoModelForCausalLM
+
+    torch_model = AutoModelForCausalLM.from_pretrained(checkpoint_dir).eval()
+    onnx_model = ORTModelForCausalLM.from_pretrained(
+        output_dir, file_name=file_name, use_cache=True
+    )
+
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(
+        torch_model.config.vocab_size,
+        (1, VALIDATION_SEQUENCE_LENGTH),
+        generator=generator,
+    )
+    attention_mask = torch.ones_like(input_ids)
+
+    expected = torch_model(input_ids, attention_mask=attention_mask).logits
+    actual = onnx_model(input_ids, attention_mask=attention_mask).logits
+
+    # the second forward pass uses the cache branch of the merged decoder
+    generate_kwargs = dict(
+        max_new_tokens=VALIDATION_NEW_TOKENS,
+        min_new_tokens=VALIDATION_NEW_TOKENS,
+        do_sample=False,
+        pad_token_id=torch_model.config.eos_token_id,
+    )
+    expected_ids = torch_model.generate(input_ids, **generate_kwargs)
+    actual_ids = onnx_model.generate(input_ids, **generate_kwargs)
+
+    return ValidationResult(
+        file_name=file_name,
+        max_abs_diff=(expected - actual).abs().max().item(),
+        top1_agreement=(expected.argmax(-1) == actual.argmax(-1)).float().mean().item(),
+        same_generation=expected_ids.tolist() == actual_ids.tolist(),
+    )
+
+
+def register_exported_model(
+    manifest_path: Path, name: str, checkpoint_dir: Path, output_dir: Path
+):
+    """Records the checkpoint and the exported models as snapshots of `name`"""
+
+    snapshots = SnapshotResolver(manifest_path)
+    snapshots.register(
+        get_snapshot_name(name, ORIGINAL_BACKEND),
+        checkpoint_dir,
+        allow_patterns=TORCH_MODEL_PATTERNS,
+        required_patterns=TORCH_MODEL_REQUIRED_PATTERNS,
+    )
+    for backend, file_name in ONNX_BACKEND_FILE_NAMES.items():
+        if (output_dir / file_name).exists():
+            snapshots.register(
+                get_snapshot_name(name, backend),
+                output_dir,
+                allow_patterns=get_onnx_patterns(file_name),
+                required_patterns=[[file_name]],
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export a local Dart checkpoint to ONNX for the ONNX backends"
+    )
+    parser.add_argument("checkpoint_dir", type=Path)
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument(
+        "--name",
+        help="the model name to select in the settings, defaults to the output directory",
+    )
+    parser.add_argument("--manifest", type=Path, default=DEFAULT_MANIFEST_PATH)
+    parser.add_argument("--opset", type=int, default=None)
+    parser.add_argument("--no-quantize", action="store_true")
+    parser.add_argument("--atol", type=float, default=DEFAULT_ATOL)
+    parser.add_argument(
+        "--min-top1-agreement", type=float, default=DEFAULT_MIN_TOP1_AGREEMENT
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    checkpoint_dir: Path = args.checkpoint_dir.resolve()
+    output_dir: Path = args.output_dir.resolve()
+
+    logger.info(f"Exporting {checkpoint_dir} to {output_dir}")
+    export_onnx(checkpoint_dir, output_dir, opset=args.opset)
+    if not args.no_quantize:
+        logger.info("Quantizing the exported model")
+        quantize_onnx(output_dir)
+
+    failed = False
+    for backend, file_name in ONNX_BACKEND_FILE_NAMES.items():
+        if not (output_dir / file_name).exists():
+            continue
+
+        result = validate_onnx(checkpoint_dir, output_dir, file_name)
+        logger.info(
+            f"{file_name}: max abs diff {result.max_abs_diff:.6f}, "
+            f"top-1 agreement {result.top1_agreement:.3f}, "
+            f"same generation {result.same_generation}"
+        )
+        if backend == "ONNX":
+            failed |= result.max_abs_diff > args.atol or not result.same_generation
+        else:
+            # quantization changes logits, so only predictions are compared
+            failed |= result.top1_agreement < args.min_top1_agreement
+    if failed:
+        raise SystemExit("Validation failed, the exported model is not registered")
+
+    name = args.name or str(output_dir)
+    register_exported_model(args.manifest, name, checkpoint_dir, output_dir)
+    logger.info(f"Registered as '{name}' in {args.manifest}")
+
+
+if __name__ == "__main__":
+    main()
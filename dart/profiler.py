@@ -0,0 +1,201 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+logger = logging.getLogger(__name__)
+
+# the number of functions listed in the hotspot summary
+NUM_HOTSPOTS = 30
+
+
+def get_ort_session(model: Any) -> Any | None:
+    """Returns the InferenceSession of an ORT model, or None for other models"""
+
+    for name in ["session", "model"]:
+        session = getattr(model, name, None)
+        if session is not None and hasattr(session, "end_profiling"):
+            return session
+    return None
+
+
+class UpsamplingProfiler:
+    """Profiles the next upsampling requests with torch.profiler and cProfile.
+
+    Only the code in `capture` is profiled, and each request is recorded by its own torch
+    profiler. When the requests are done, a Chrome trace of all requests including ORT profiling
+    events and a summary of hotspots are written to the output directory."""
+
+    def __init__(self):
+        self.remaining_requests = 0
+        self.num_requests = 0
+        self.output_dir: Path | None = None
+
+        # a torch profiler of each captured request
+        self.torch_profilers: list[profile] = []
+        self.cprofile: cProfile.Profile | None = None
+        # the total time of the captured requests
+        self.captured_time = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.remaining_requests > 0
+
+    def request(self, num_requests: int, output_dir: Path):
+        """Profiles the next `num_requests` requests"""
+
+        if self.active:
+            return
+
+        logger.info(f"Profiling the next {num_requests} upsampling requests")
+        self.remaining_requests = num_requests
+        self.num_requests = num_requests
+        self.output_dir = output_dir
+
+    @contextmanager
+    def capture(self, get_model: Callable[[], Any] | None = None) -> Iterator[None]:
+        """Profiles a request in the context if profiling is requested.
+
+        `get_model` returns the model whose ORT profiling events are merged."""
+
+        if not self.active:
+            yield
+            return
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        torch_profiler = profile(activities=activities)
+        if self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+
+        start_time = time.time()
+        torch_profiler.start()
+        self.cprofile.enable()
+        try:
+            yield
+        finally:
+            self.cprofile.disable()
+            torch_profiler.stop()
+            self.captured_time += time.time() - start_time
+            self.torch_profilers.append(torch_profiler)
+
+            self.remaining_requests -= 1
+            if self.remaining_requests == 0:
+                self._finish(get_model() if get_model is not None else None)
+
+    def _finish(self, model: Any):
+        assert self.output_dir is not None
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        name = f"dart-profile-{time.strftime('%Y%m%d-%H%M%S')}"
+        trace_path = self.output_dir / f"{name}.json"
+        summary_path = self.output_dir / f"{name}.txt"
+
+        try:
+            self._export_chrome_trace(trace_path)
+            self._merge_ort_trace(trace_path, model)
+
+            with open(summary_path, "w", encoding="utf-8") as file:
+                file.write(self._get_summary())
+
+            logger.info(
+                f"Profiling results are saved to {trace_path} and {summary_path}"
+            )
+        except OSError as e:
+            logger.error(f"Failed to save profiling results: {e}")
+        finally:
+            self.torch_profilers = []
+            self.cprofile = None
+            self.captured_time = 0.0
+
+    def _export_chrome_trace(self, trace_path: Path):
+        """Writes the events of all requests to a trace"""
+
+        trace: dict[str, Any] = {}
+        for i, torch_profiler in enumerate(self.torch_profilers):
+            request_path = trace_path.with_suffix(f".{i}.json")
+            torch_profiler.export_chrome_trace(str(request_path))
+            with open(request_path, "r", encoding="utf-8") as file:
+                request_trace = json.load(file)
+            request_path.unlink()
+
+            # timestamps of the requests have the same base
+            if i == 0:
+                trace = request_trace
+            else:
+                trace["traceEvents"].extend(request_trace["traceEvents"])
+
+        with open(trace_path, "w", encoding="utf-8") as file:
+            json.dump(trace, file)
+
+    def _merge_ort_trace(self, trace_path: Path, model: Any):
+        session = get_ort_session(model)
+        if session is None:
+            return
+
+        # empty if profiling is not enabled for the session
+        ort_trace_path = session.end_profiling()
+        if not ort_trace_path:
+            return
+
+        with open(ort_trace_path, "r", encoding="utf-8") as file:
+            ort_events = json.load(file)
+        with open(trace_path, "r", encoding="utf-8") as file:
+            trace = json.load(file)
+
+        # ORT timestamps are relative to the start of its profiling, so shown as another process
+        for event in ort_events:
+            event["pid"] = "onnxruntime"
+        trace["traceEvents"].extend(ort_events)
+
+        with open(trace_path, "w", encoding="utf-8") as file:
+            json.dump(trace, file)
+        Path(ort_trace_path).unlink(missing_ok=True)
+
+    def _get_operator_table(self) -> str:
+        # operator -> [calls, self CPU time, total CPU time] of all requests (us)
+        operators: dict[str, list[float]] = {}
+        for torch_profiler in self.torch_profilers:
+            for average in torch_profiler.key_averages():
+                stats = operators.setdefault(average.key, [0, 0.0, 0.0])
+                stats[0] += average.count
+                stats[1] += average.self_cpu_time_total
+                stats[2] += average.cpu_time_total
+
+        lines = [
+            f"{'Name':<60} {'Self CPU (ms)':>14} {'CPU total (ms)':>14} {'Calls':>8}"
+        ]
+        for key, (count, self_cpu_time, cpu_time) in sorted(
+            operators.items(), key=lambda item: item[1][1], reverse=True
+        )[:NUM_HOTSPOTS]:
+            lines.append(
+                f"{key[:60]:<60} {self_cpu_time / 1000:>14.3f} {cpu_time / 1000:>14.3f} {int(count):>8}"
+            )
+
+        return "\n".join(lines)
+
+    def _get_summary(self) -> str:
+        assert self.cprofile is not None
+
+        stream = io.StringIO()
+        stream.write(
+            f"{self.num_requests} requests in {self.captured_time:.2f} seconds\n\n"
+        )
+
+        stream.write("# torch operators\n")
+        stream.write(self._get_operator_table())
+
+        stream.write("\n\n# Python functions\n")
+        stats = pstats.Stats(self.cprofile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(NUM_HOTSPOTS)
+
+        return stream.getvalue()
@@ -0,0 +1,57 @@
+import logging
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+class PrunedLMHead(nn.Module):
+    """An output projection which computes the logits of the kept tokens only.
+
+    The logits are mapped back to the full vocabulary and the other tokens get `-inf`,
+    so they can never be generated."""
+
+    def __init__(self, lm_head: nn.Linear, keep_ids: torch.Tensor):
+        super().__init__()
+
+        self.vocab_size = lm_head.out_features
+        self.in_features = lm_head.in_features
+        self.out_features = lm_head.out_features
+
+        keep_ids = keep_ids.to(device=lm_head.weight.device, dtype=torch.long)
+        self.register_buffer("keep_ids", keep_ids, persistent=False)
+
+        self.weight = nn.Parameter(
+            lm_head.weight.detach()[keep_ids].clone(), requires_grad=False
+        )
+        self.bias = (
+            nn.Parameter(lm_head.bias.detach()[keep_ids].clone(), requires_grad=False)
+            if lm_head.bias is not None
+            else None
+        )
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        pruned_logits = nn.functional.linear(hidden_states, self.weight, self.bias)
+
+        # map back to the full vocabulary
+        logits = pruned_logits.new_full(
+            (*pruned_logits.shape[:-1], self.vocab_size), float("-inf")
+        )
+        logits.index_copy_(-1, self.keep_ids, pruned_logits)
+
+        return logits
+
+
+def prune_output_vocab(model, keep_ids: list[int]):
+    """Replaces the output projection of the model with the pruned one"""
+
+    lm_head = model.get_output_embeddings()
+    assert isinstance(lm_head, nn.Linear), f"Unsupported output head: {lm_head}"
+
+    pruned_head = PrunedLMHead(lm_head, torch.tensor(sorted(set(keep_ids))))
+    model.set_output_embeddings(pruned_head)
+
+    logger.info(
+        f"Output vocabulary has been pruned from {pruned_head.vocab_size} to {len(pruned_head.keep_ids)} tokens"
+    )
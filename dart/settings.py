@@ -15,6 +15,12 @@ MODEL_BACKEND_TYPE = {
     "ONNX_QUANTIZED": "ONNX (Quantized)",
 }
 
+UPSAMPLING_ENGINE_TYPE = {
+    "ALWAYS_MODEL": "Always model",
+    "FALLBACK_ON_BUDGET": "Fallback when latency budget is exceeded",
+    "FALLBACK_WHILE_WARMING_UP": "Fallback while model is loading",
+}
+
 OPTION_NAME = Literal[
     "model_name",
     "tokenizer_name",
@@ -23,6 +29,29 @@ OPTION_NAME = Literal[
     "debug_logging",
     "escape_input_brackets",
     "escape_output_brackets",
+    "cfg_max_guidance_steps",
+    "cfg_divergence_threshold",
+    "prune_output_vocab",
+    "pruned_ban_tags",
+    "speculative_decoding",
+    "num_draft_tags",
+    "upsampling_engine",
+    "latency_budget",
+    "fallback_online_update",
+    "model_memory_budget",
+    "model_idle_timeout",
+    "resolve_unknown_tags",
+    "alias_min_similarity",
+    "alias_resolution_budget",
+    "beam_search_memory_budget",
+    "profile_num_requests",
+    "profile_output_dir",
+    "model_pool_size",
+    "use_local_snapshots",
+    "native_tag_tokenizer",
+    "grid_bulk_upsampling",
+    "shared_model_weights",
+    "max_input_tokens",
 ]
 
 DEFAULT_VALUES: dict[OPTION_NAME, Any] = {
@@ -32,6 +61,29 @@ DEFAULT_VALUES: dict[OPTION_NAME, Any] = {
     "model_device": "cpu",
     "escape_input_brackets": True,
     "escape_output_brackets": True,
+    "cfg_max_guidance_steps": 0,
+    "cfg_divergence_threshold": 0.0,
+    "prune_output_vocab": False,
+    "pruned_ban_tags": "",
+    "speculative_decoding": False,
+    "num_draft_tags": 4,
+    "upsampling_engine": UPSAMPLING_ENGINE_TYPE["ALWAYS_MODEL"],
+    "latency_budget": 10.0,
+    "fallback_online_update": False,
+    "model_memory_budget": 0,
+    "model_idle_timeout": 0,
+    "resolve_unknown_tags": True,
+    "alias_min_similarity": 0.8,
+    "alias_resolution_budget": 20,
+    "beam_search_memory_budget": 0,
+    "profile_num_requests": 0,
+    "profile_output_dir": "",
+    "model_pool_size": 1,
+    "use_local_snapshots": True,
+    "native_tag_tokenizer": True,
+    "grid_bulk_upsampling": True,
+    "shared_model_weights": False,
+    "max_input_tokens": 0,
     "debug_logging": False,
 }
 
@@ -50,6 +102,29 @@ def parse_options(opts: Options | None) -> dict[OPTION_NAME, Any]:
         "model_device": get_value("model_device"),
         "escape_input_brackets": get_value("escape_input_brackets"),
         "escape_output_brackets": get_value("escape_output_brackets"),
+        "cfg_max_guidance_steps": get_value("cfg_max_guidance_steps"),
+        "cfg_divergence_threshold": get_value("cfg_divergence_threshold"),
+        "prune_output_vocab": get_value("prune_output_vocab"),
+        "pruned_ban_tags": get_value("pruned_ban_tags"),
+        "speculative_decoding": get_value("speculative_decoding"),
+        "num_draft_tags": get_value("num_draft_tags"),
+        "upsampling_engine": get_value("upsampling_engine"),
+        "latency_budget": get_value("latency_budget"),
+        "fallback_online_update": get_value("fallback_online_update"),
+        "model_memory_budget": get_value("model_memory_budget"),
+        "model_idle_timeout": get_value("model_idle_timeout"),
+        "resolve_unknown_tags": get_value("resolve_unknown_tags"),
+        "alias_min_similarity": get_value("alias_min_similarity"),
+        "alias_resolution_budget": get_value("alias_resolution_budget"),
+        "beam_search_memory_budget": get_value("beam_search_memory_budget"),
+        "profile_num_requests": get_value("profile_num_requests"),
+        "profile_output_dir": get_value("profile_output_dir"),
+        "model_pool_size": get_value("model_pool_size"),
+        "use_local_snapshots": get_value("use_local_snapshots"),
+        "native_tag_tokenizer": get_value("native_tag_tokenizer"),
+        "grid_bulk_upsampling": get_value("grid_bulk_upsampling"),
+        "shared_model_weights": get_value("shared_model_weights"),
+        "max_input_tokens": get_value("max_input_tokens"),
         "debug_logging": get_value("debug_logging"),
     }
 
@@ -62,9 +137,12 @@ def on_ui_settings():
             default=DEFAULT_VALUES["model_name"],
             label="The model to use for upsampling danbooru tags.",
             component=gr.Dropdown,
-            component_args={"choices": ["p1atdev/dart-v1-sft"]},
+            component_args={
+                "choices": ["p1atdev/dart-v1-sft"],
+                "allow_custom_value": True,
+            },
             section=section,
-        ),
+        ).info("or a model exported by python -m dart.onnx_export"),
     )
     shared.opts.add_option(
         key="tokenizer_name",
@@ -85,7 +163,7 @@ def on_ui_settings():
             component_args={"choices": list(MODEL_BACKEND_TYPE.values())},
             section=section,
         ).info(
-            "Original = inefficient computation; ONNX = efficient computing but the model size is very large; ONNX (Quantized) = efficient computation, smallest model file size, and fastest"
+            "Original = inefficient computation; ONNX = efficient computing but the model size is very large; ONNX (Quantized) = efficient computation, smallest model file size, and fastest; compare them on your hardware with python -m dart.benchmark"
         ),
     )
     shared.opts.add_option(
@@ -115,6 +193,244 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        key="cfg_max_guidance_steps",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["cfg_max_guidance_steps"],
+            label="The number of tags to apply CFG for.",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 1},
+            section=section,
+        ).info("0 = apply CFG to all tags"),
+    )
+    shared.opts.add_option(
+        key="cfg_divergence_threshold",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["cfg_divergence_threshold"],
+            label="Stop CFG once the positive and negative distributions diverge more than this value.",
+            component=gr.Number,
+            component_args={"minimum": 0.0, "step": 0.1},
+            section=section,
+        ).info("KL divergence; 0 = never stop"),
+    )
+    shared.opts.add_option(
+        key="prune_output_vocab",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["prune_output_vocab"],
+            label="Compute the output of general tags only.",
+            component=gr.Checkbox,
+            section=section,
+        ).info("Only for Original backend; requires restart"),
+    )
+    shared.opts.add_option(
+        key="pruned_ban_tags",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["pruned_ban_tags"],
+            label="Tags removed from the output vocabulary when it is pruned.",
+            component=gr.Textbox,
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key="speculative_decoding",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["speculative_decoding"],
+            label="Use speculative decoding.",
+            component=gr.Checkbox,
+            section=section,
+        ).info(
+            "Guesses the next tags from the table built by python -m dart.fallback and previous outputs, and verifies them at once; not used with CFG or beams"
+        ),
+    )
+    shared.opts.add_option(
+        key="num_draft_tags",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["num_draft_tags"],
+            label="The number of tags guessed at once in speculative decoding.",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key="upsampling_engine",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["upsampling_engine"],
+            label="When to use the fast fallback upsampler instead of the model.",
+            component=gr.Dropdown,
+            component_args={"choices": list(UPSAMPLING_ENGINE_TYPE.values())},
+            section=section,
+        ).info(
+            "The fallback samples tags which appeared with the input tags in the index built by python -m dart.fallback"
+        ),
+    )
+    shared.opts.add_option(
+        key="latency_budget",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["latency_budget"],
+            label="Latency budget for upsampling all prompts in a batch (seconds).",
+            component=gr.Number,
+            component_args={"minimum": 0.0, "step": 0.5},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key="fallback_online_update",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["fallback_online_update"],
+            label="Add the outputs of the model to the co-occurrence index of the fallback.",
+            component=gr.Checkbox,
+            section=section,
+        ).info("Saved to cooccurrence.json; not used when the model is always used"),
+    )
+    shared.opts.add_option(
+        key="model_memory_budget",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["model_memory_budget"],
+            label="Memory budget for loaded upsampling models (MB).",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 1},
+            section=section,
+        ).info("0 = unlimited; least recently used models are unloaded first"),
+    )
+    shared.opts.add_option(
+        key="model_idle_timeout",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["model_idle_timeout"],
+            label="Unload upsampling models not used for this duration (minutes).",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 1},
+            section=section,
+        ).info("0 = never; requires restart"),
+    )
+    shared.opts.add_option(
+        key="resolve_unknown_tags",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["resolve_unknown_tags"],
+            label="Resolve unknown tags to the closest known tags.",
+            component=gr.Checkbox,
+            section=section,
+        ).info("e.g. Hatsune_Miku -> hatsune miku; requires restart"),
+    )
+    shared.opts.add_option(
+        key="alias_min_similarity",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["alias_min_similarity"],
+            label="Minimum similarity to resolve an unknown tag.",
+            component=gr.Slider,
+            component_args={"minimum": 0.5, "maximum": 1.0, "step": 0.05},
+            section=section,
+        ).info("requires restart"),
+    )
+    shared.opts.add_option(
+        key="alias_resolution_budget",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["alias_resolution_budget"],
+            label="Time budget for resolving unknown tags in a prompt (milliseconds).",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 5},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key="beam_search_memory_budget",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["beam_search_memory_budget"],
+            label="Memory budget for the states of beams (MB).",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 16},
+            section=section,
+        ).info("0 = unlimited; num_beams is reduced to fit in the budget"),
+    )
+    shared.opts.add_option(
+        key="profile_num_requests",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["profile_num_requests"],
+            label="Profile the next upsampling requests.",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 1},
+            section=section,
+        ).info(
+            "The number of requests; writes a Chrome trace and hotspots, then goes back to 0"
+        ),
+    )
+    shared.opts.add_option(
+        key="profile_output_dir",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["profile_output_dir"],
+            label="The directory to save profiling results.",
+            component=gr.Textbox,
+            section=section,
+        ).info("empty = profiles in the extension directory"),
+    )
+    shared.opts.add_option(
+        key="model_pool_size",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["model_pool_size"],
+            label="The number of upsampling requests processed at the same time.",
+            component=gr.Number,
+            component_args={"minimum": 1, "step": 1},
+            section=section,
+        ).info(
+            "Over 1, each request has its own random generator, so results differ from 1; requires restart"
+        ),
+    )
+    shared.opts.add_option(
+        key="use_local_snapshots",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["use_local_snapshots"],
+            label="Load models and tokenizers from local snapshots without accessing the hub.",
+            component=gr.Checkbox,
+            section=section,
+        ).info(
+            "Downloaded once and recorded in snapshots.json; remove an entry to update it; requires restart"
+        ),
+    )
+    shared.opts.add_option(
+        key="native_tag_tokenizer",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["native_tag_tokenizer"],
+            label="Tokenize prompts natively without the remote tokenizer code.",
+            component=gr.Checkbox,
+            section=section,
+        ).info(
+            "Verified against the remote tokenizer once for each snapshot; requires restart"
+        ),
+    )
+    shared.opts.add_option(
+        key="grid_bulk_upsampling",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["grid_bulk_upsampling"],
+            label="Upsample prompts of all cells of X/Y/Z plots at once.",
+            component=gr.Checkbox,
+            section=section,
+        ).info(
+            "Cells with the same prompt and seed share the upsampled tags; prompts are generated in batches unless CFG, beams or speculative decoding are used"
+        ),
+    )
+    shared.opts.add_option(
+        key="shared_model_weights",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["shared_model_weights"],
+            label="Load model weights from memory-mapped files shared between processes.",
+            component=gr.Checkbox,
+            section=section,
+        ).info(
+            "Saves memory when several WebUI processes run on the same host with the CPU device; ONNX models are converted once; requires restart"
+        ),
+    )
+    shared.opts.add_option(
+        key="max_input_tokens",
+        info=shared.OptionInfo(
+            default=DEFAULT_VALUES["max_input_tokens"],
+            label="Maximum number of tokens of an upsampling prompt.",
+            component=gr.Number,
+            component_args={"minimum": 0, "step": 16},
+            section=section,
+        ).info(
+            "0 = unlimited; character and copyright tags are kept first, then general tags the model generates less often according to the co-occurrence index; requires restart"
+        ),
+    )
     shared.opts.add_option(
         key="debug_logging",
         info=shared.OptionInfo(
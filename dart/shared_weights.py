@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import torch
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+# initializers smaller than this are kept in the ONNX file
+EXTERNAL_DATA_SIZE_THRESHOLD = 1024
+
+
+@dataclass
+class MemoryUsage:
+    rss_mb: float
+    # file-backed pages, shared by processes mapping the same files
+    shared_mb: float
+    # anonymous pages of this process
+    private_mb: float
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rss_mb:.0f} MB RSS ({self.shared_mb:.0f} MB shared, "
+            f"{self.private_mb:.0f} MB private)"
+        )
+
+
+def get_memory_usage() -> MemoryUsage | None:
+    """Returns the resident memory of this process, only available on Linux"""
+
+    status_path = Path("/proc/self/status")
+    if not status_path.exists():
+        return None
+
+    values: dict[str, float] = {}
+    for line in status_path.read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ["VmRSS", "RssAnon", "RssFile", "RssShmem"]:
+            # in kB
+            values[key] = int(value.split()[0]) / 1024
+    if "RssAnon" not in values:
+        return None
+
+    return MemoryUsage(
+        rss_mb=values["VmRSS"],
+        shared_mb=values["RssFile"] + values.get("RssShmem", 0),
+        private_mb=values["RssAnon"],
+    )
+
+
+def load_mmap_safetensors(path: Path) -> dict[str, torch.Tensor]:
+    """Returns the tensors of a safetensors file as views of the memory-mapped file"""
+
+    with open(path, "rb") as file:
+        header_size = int.from_bytes(file.read(8), "little")
+        header = json.loads(file.read(header_size))
+    header.pop("__metadata__", None)
+
+    # pages are shared with the page cache until they are written
+    storage = torch.UntypedStorage.from_file(
+        str(path), shared=False, nbytes=path.stat().st_size
+    )
+    buffer = torch.empty(0, dtype=torch.uint8).set_(storage)  # type: ignore
+
+    tensors = {}
+    data_start = 8 + header_size
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        data = buffer[data_start + start : data_start + end]
+        if (data_start + start) % dtype.itemsize != 0:
+            # views must be aligned to the element size
+            data = data.clone()
+        tensors[name] = data.view(dtype).reshape(info["shape"])
+
+    return tensors
+
+
+def load_mmap_state_dict(model_dir: Path) -> dict[str, torch.Tensor]:
+    state_dict = {}
+    for path in sorted(model_dir.glob("*.safetensors")):
+        state_dict.update(load_mmap_safetensors(path))
+    if len(state_dict) > 0:
+        return state_dict
+
+    for path in sorted(model_dir.glob("pytorch_model*.bin")):
+        state_dict.update(
+            torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        )
+    if len(state_dict) == 0:
+        raise FileNotFoundError(f"No model weights in {model_dir}")
+
+    return state_dict
+
+
+# modules created in these threads get parameters on the meta device
+_meta_init = threading.local()
+_meta_init_lock = threading.Lock()
+_num_meta_init_threads = 0
+_register_parameter = torch.nn.Module.register_parameter
+
+
+def _register_parameter_on_meta(
+    module: torch.nn.Module, name: str, param: torch.nn.Parameter | None
+):
+    if param is not None and getattr(_meta_init, "enabled", False):
+        param = torch.nn.Parameter(
+            torch.empty_like(param, device="meta"), requires_grad=param.requires_grad
+        )
+    _register_parameter(module, name, param)
+
+
+@contextmanager
+def _init_parameters_on_meta():
+    """Creates parameters on the meta device, so that they are neither allocated nor initialized.
+
+    Unlike `torch.device("meta")`, buffers which are not in checkpoints (e.g. rotary
+    frequencies) are still computed. Modules created in other threads are not affected
+    """
+
+    global _num_meta_init_threads
+
+    with _meta_init_lock:
+        if _num_meta_init_threads == 0:
+            torch.nn.Module.register_parameter = _register_parameter_on_meta  # type: ignore
+        _num_meta_init_threads += 1
+    _meta_init.enabled = True
+    try:
+        yield
+    finally:
+        _meta_init.enabled = False
+        with _meta_init_lock:
+            _num_meta_init_threads -= 1
+            if _num_meta_init_threads == 0:
+                torch.nn.Module.register_parameter = _register_parameter  # type: ignore
+
+
+def load_shared_torch_model(model_dir: Path) -> "PreTrainedModel":
+    """Loads a model whose parameters are views of the memory-mapped weight files.
+
+    Only float32 weights are supported, as conversions to float32 make private copies"""
+
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    state_dict = load_mmap_state_dict(model_dir)
+    dtypes = {
+        tensor.dtype for tensor in state_dict.values() if tensor.is_floating_point()
+    }
+    if dtypes - {torch.float32}:
+        names = ", ".join(sorted(str(dtype) for dtype in dtypes))
+        raise ValueError(
+            f"Weights in {model_dir} are {names}, only float32 weights can be shared"
+        )
+
+    config = AutoConfig.from_pretrained(model_dir)
+    with _init_parameters_on_meta():
+        model = AutoModelForCausalLM.from_config(config)
+
+    missing_keys, unexpected_keys = model.load_state_dict(
+        state_dict, strict=False, assign=True
+    )
+    model.tie_weights()
+
+    # tied weights are shared by tie_weights
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    missing_keys = [
+        key for key in missing_keys if key not in tensors or tensors[key].is_meta
+    ]
+    if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise ValueError(
+            f"Weights in {model_dir} do not match the model: "
+            f"missing {missing_keys}, unexpected {unexpected_keys}"
+        )
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+    except OSError:
+        pass
+
+    return model.eval()
+
+
+def get_external_data_model(
+    onnx_path: Path, cache_dir: Path, config_dir: Path | None = None
+) -> Path:
+    """Returns a copy of the ONNX model with the initializers in an external data file.
+
+    Converted once for each model file. The configs in the directory of the model and
+    `config_dir` are copied, so that the copy can be loaded as a model directory"""
+
+    import onnx
+
+    stat = onnx_path.stat()
+    key = hashlib.sha256(
+        f"{onnx_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+    output_dir = cache_dir / key
+    output_path = output_dir / onnx_path.name
+    if output_path.exists():
+        return output_path
+
+    logger.info(f"Converting {onnx_path} to share the weights between processes")
+    # other processes may convert the same model at the same time
+    tmp_dir = cache_dir / f"{key}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    for source_dir in [config_dir, onnx_path.parent]:
+        if source_dir is not None:
+            for path in source_dir.glob("*.json"):
+                shutil.copy(path, tmp_dir / path.name)
+
+    onnx.save_model(
+        onnx.load(str(onnx_path)),
+        str(tmp_dir / onnx_path.name),
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location=f"{onnx_path.name}.data",
+        size_threshold=EXTERNAL_DATA_SIZE_THRESHOLD,
+    )
+
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # converted by another process
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return output_path
+
+
+def add_shared_initializers(session_options: Any, onnx_path: Path) -> list[Any]:
+    """Makes ORT use the initializers mapped from the external data file of the model.
+
+    Returns the values which must be kept alive as long as the session"""
+
+    import onnx
+    import onnxruntime as ort
+    from onnx.external_data_helper import ExternalDataInfo, uses_external_data
+    from onnx.helper import tensor_dtype_to_np_dtype
+
+    model = onnx.load(str(onnx_path), load_external_data=False)
+
+    values = []
+    for initializer in model.graph.initializer:
+        if not uses_external_data(initializer):
+            continue
+
+        info = ExternalDataInfo(initializer)
+        array = np.memmap(
+            onnx_path.parent / info.location,
+            dtype=tensor_dtype_to_np_dtype(initializer.data_type),
+            # copy-on-write, the pages are shared until they are written
+            mode="c",
+            offset=info.offset or 0,
+            shape=tuple(initializer.dims),
+        )
+        value = ort.OrtValue.ortvalue_from_numpy(array)
+        session_options.add_initializer(initializer.name, value)
+        values.append(value)
+
+    # prepacked weights are private copies
+    session_options.add_session_config_entry("session.disable_prepacking", "1")
+
+    return values
@@ -0,0 +1,240 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from huggingface_hub import snapshot_download
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# files of each kind of snapshot
+TOKENIZER_PATTERNS = ["*.json", "*.py", "*.txt", "*.model"]
+TORCH_MODEL_PATTERNS = ["*.json", "*.py", "*.safetensors", "pytorch_model*.bin"]
+# each is a list of alternatives
+TORCH_MODEL_REQUIRED_PATTERNS = [
+    ["config.json"],
+    ["*.safetensors", "pytorch_model*.bin"],
+]
+ONNX_CONFIG_PATTERNS = ["*.json"]
+
+
+class SnapshotError(FileNotFoundError):
+    """Raised when files of a snapshot are missing"""
+
+
+def get_snapshot_name(repo_id: str, kind: str) -> str:
+    """Returns the name of the snapshot of a model backend or the tokenizer"""
+
+    return f"{repo_id} ({kind})"
+
+
+def get_onnx_patterns(file_name: str) -> list[str]:
+    # also matches external data, e.g. model.onnx_data
+    return [*ONNX_CONFIG_PATTERNS, f"{file_name}*", f"*/{file_name}*"]
+
+
+def get_file_hash(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def find_file(files: list[str], file_name: str) -> str | None:
+    """Returns the relative path of the file named `file_name` in the snapshot"""
+
+    for relative_path in sorted(files, key=lambda path: path.count("/")):
+        if Path(relative_path).name == file_name:
+            return relative_path
+    return None
+
+
+class SnapshotResolver:
+    """Resolves hub repositories to local snapshots recorded in a manifest.
+
+    A snapshot is downloaded once (or taken from the hub cache), and the local paths, sizes and
+    hashes of its files are recorded. After that, it is loaded from the local paths without
+    accessing the hub, and missing files are reported instead of downloaded again. A new snapshot
+    is saved to the manifest by `confirm` once it is loaded successfully."""
+
+    def __init__(self, manifest_path: Path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict] = self._load_manifest()
+        # recorded in this session, but not loaded yet
+        self.pending: dict[str, dict] = {}
+
+    def _load_manifest(self) -> dict[str, dict]:
+        if not self.manifest_path.exists():
+            return {}
+
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load snapshot manifest: {e}")
+            return {}
+
+        if manifest.get("version") != MANIFEST_VERSION:
+            logger.warning("Snapshot manifest of another version is ignored")
+            return {}
+        return manifest["snapshots"]
+
+    def _save_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=self.manifest_path.parent,
+            prefix=f"{self.manifest_path.name}.",
+            suffix=".tmp",
+            delete=False,
+        ) as file:
+            json.dump(
+                {"version": MANIFEST_VERSION, "snapshots": self.entries},
+                file,
+                indent=2,
+            )
+        os.replace(file.name, self.manifest_path)
+
+    def verify(self, name: str, check_hashes: bool = False) -> list[str]:
+        """Returns the files of the snapshot which are missing or modified"""
+
+        entry = self.entries.get(name) or self.pending[name]
+        local_dir = Path(entry["local_dir"])
+
+        invalid = []
+        for relative_path, record in entry["files"].items():
+            path = local_dir / relative_path
+            if not path.is_file() or path.stat().st_size != record["size"]:
+                invalid.append(relative_path)
+            elif check_hashes and get_file_hash(path) != record["sha256"]:
+                invalid.append(relative_path)
+        return invalid
+
+    def resolve(
+        self,
+        name: str,
+        repo_id: str,
+        allow_patterns: list[str],
+        required_patterns: list[list[str]] | None = None,
+    ) -> tuple[Path, list[str]]:
+        """Returns the local directory of the snapshot and the relative paths of its files.
+
+        Each of `required_patterns` lists alternatives, one of which must match."""
+
+        with self.lock:
+            if name not in self.entries:
+                # recorded again until it is confirmed
+                self.pending[name] = self._record(
+                    repo_id, allow_patterns, required_patterns or []
+                )
+
+            entry = self.entries.get(name) or self.pending[name]
+            invalid = self.verify(name)
+            if len(invalid) > 0:
+                raise SnapshotError(
+                    f"Files of the snapshot of {repo_id} are missing or modified in {entry['local_dir']}: "
+                    f"{', '.join(invalid)}. Remove '{name}' from {self.manifest_path} to download it again."
+                )
+
+            return Path(entry["local_dir"]), list(entry["files"].keys())
+
+    def confirm(self, name: str):
+        """Saves the snapshot to the manifest after the files are loaded successfully"""
+
+        with self.lock:
+            entry = self.pending.pop(name, None)
+            if entry is None:
+                return
+            self.entries[name] = entry
+            self._try_save_manifest()
+
+    def register(
+        self,
+        name: str,
+        local_dir: Path,
+        allow_patterns: list[str],
+        required_patterns: list[list[str]] | None = None,
+    ):
+        """Records files in a local directory, e.g. an exported model, as a snapshot"""
+
+        with self.lock:
+            self.entries[name] = self._record_dir(
+                str(local_dir), local_dir, allow_patterns, required_patterns or []
+            )
+            self.pending.pop(name, None)
+            self._try_save_manifest()
+
+    def _record(
+        self,
+        repo_id: str,
+        allow_patterns: list[str],
+        required_patterns: list[list[str]],
+    ) -> dict:
+        logger.info(f"Recording a local snapshot of {repo_id}")
+        if Path(repo_id).is_dir():
+            # a local checkpoint, e.g. a custom value of the model setting
+            return self._record_dir(
+                repo_id, Path(repo_id), allow_patterns, required_patterns
+            )
+
+        try:
+            local_dir = Path(snapshot_download(repo_id, allow_patterns=allow_patterns))
+        except (OSError, ValueError) as e:
+            # hub errors and invalid repository ids
+            raise SnapshotError(f"Failed to download {repo_id}: {e}") from e
+
+        return self._record_dir(repo_id, local_dir, allow_patterns, required_patterns)
+
+    def _record_dir(
+        self,
+        repo_id: str,
+        local_dir: Path,
+        allow_patterns: list[str],
+        required_patterns: list[list[str]],
+    ) -> dict:
+        files = sorted(
+            path.relative_to(local_dir).as_posix()
+            for path in local_dir.rglob("*")
+            if path.is_file()
+            and any(
+                fnmatch.fnmatch(path.relative_to(local_dir).as_posix(), pattern)
+                for pattern in allow_patterns
+            )
+        )
+        for alternatives in required_patterns:
+            if not any(
+                fnmatch.fnmatch(file, pattern)
+                for file in files
+                for pattern in alternatives
+            ):
+                raise SnapshotError(
+                    f"No file of {repo_id} matches any of {', '.join(alternatives)}"
+                )
+
+        return {
+            "repo_id": repo_id,
+            "local_dir": str(local_dir),
+            "files": {
+                file: {
+                    "size": (local_dir / file).stat().st_size,
+                    "sha256": get_file_hash(local_dir / file),
+                }
+                for file in files
+            },
+        }
+
+    def _try_save_manifest(self):
+        try:
+            self._save_manifest()
+        except OSError as e:
+            # still usable in this session
+            logger.warning(f"Failed to save snapshot manifest: {e}")
@@ -0,0 +1,354 @@
+import inspect
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Iterable
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    NoRepeatNGramLogitsProcessor,
+    NoBadWordsLogitsProcessor,
+    MinNewTokensLengthLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+logger = logging.getLogger(__name__)
+
+# the number of following tags kept for each tag
+MAX_FOLLOWING_TAGS = 32
+
+
+class TagCooccurrenceDraft:
+    """A draft model which proposes the next tags from counts of adjacent tags.
+
+    Dart outputs tags in a stable (alphabetical) order, so the tags which followed a tag in
+    previous outputs are good guesses of the next tags. The table is built offline by
+    `python -m dart.fallback` and updated by later outputs."""
+
+    def __init__(self, tokenizer_name: str | None = None):
+        # token ids of the table are only valid for this tokenizer
+        self.tokenizer_name = tokenizer_name
+        # tag id -> following tag id -> count
+        self.table: dict[int, dict[int, int]] = {}
+        # updated and read by concurrent requests
+        self.lock = threading.Lock()
+
+    def update(self, token_ids: Iterable[int]):
+        """Counts adjacent tags in a sequence"""
+
+        token_ids = list(token_ids)
+        with self.lock:
+            for prev_id, next_id in zip(token_ids[:-1], token_ids[1:]):
+                following = self.table.setdefault(prev_id, {})
+                following[next_id] = following.get(next_id, 0) + 1
+
+                if len(following) > MAX_FOLLOWING_TAGS:
+                    # forget the rarest one
+                    del following[min(following, key=following.__getitem__)]
+
+    def propose(self, context_ids: list[int], num_tokens: int) -> list[int]:
+        """Proposes at most `num_tokens` next tags which do not appear in the context"""
+
+        if len(context_ids) == 0:
+            return []
+
+        seen = set(context_ids)
+        proposed: list[int] = []
+        current_id = context_ids[-1]
+        while len(proposed) < num_tokens:
+            with self.lock:
+                following = self.table.get(current_id)
+                if following is None:
+                    break
+
+                candidates = [
+                    token_id
+                    for token_id in sorted(
+                        following, key=following.__getitem__, reverse=True
+                    )
+                    if token_id not in seen
+                ]
+            if len(candidates) == 0:
+                break
+
+            current_id = candidates[0]
+            proposed.append(current_id)
+            seen.add(current_id)
+
+        return proposed
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "tokenizer_name": self.tokenizer_name,
+                "table": {
+                    str(prev_id): {
+                        str(next_id): count for next_id, count in following.items()
+                    }
+                    for prev_id, following in self.table.items()
+                },
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TagCooccurrenceDraft":
+        draft = cls(data.get("tokenizer_name"))
+        draft.table = {
+            int(prev_id): {int(next_id): count for next_id, count in following.items()}
+            for prev_id, following in data["table"].items()
+        }
+        return draft
+
+    def save(self, path: Path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(
+        cls, path: Path, tokenizer_name: str | None = None
+    ) -> "TagCooccurrenceDraft":
+        """Loads the table built for the tokenizer, or returns an empty draft"""
+
+        if not path.exists():
+            logger.info(
+                f"Draft table is not found: {path}, build it with python -m dart.fallback"
+            )
+            return cls(tokenizer_name)
+
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                draft = cls.from_dict(json.load(file))
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            logger.error(f"Failed to load draft table: {path} ({e})")
+            return cls(tokenizer_name)
+
+        if (
+            tokenizer_name is not None
+            and draft.tokenizer_name is not None
+            and draft.tokenizer_name != tokenizer_name
+        ):
+            logger.warning(
+                f"Draft table is not used, it is built for {draft.tokenizer_name}"
+            )
+            return cls(tokenizer_name)
+
+        return draft
+
+
+def get_logits_processors(
+    prompt_length: int,
+    eos_token_id: int,
+    min_new_tokens: int = 0,
+    temperature: float = 1.0,
+    top_p: float = 1,
+    top_k: int = 20,
+    bad_words_ids: list[list[int]] | None = None,
+) -> LogitsProcessorList:
+    """Returns the same processors as `generate` uses for the arguments of DartGenerator"""
+
+    processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(1)])
+    if bad_words_ids is not None:
+        processors.append(NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id))
+    if min_new_tokens > 0:
+        processors.append(
+            MinNewTokensLengthLogitsProcessor(
+                prompt_length, min_new_tokens, eos_token_id
+            )
+        )
+
+    # warpers
+    if temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if top_k != 0:
+        processors.append(TopKLogitsWarper(top_k))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+
+    return processors
+
+
+def verify_draft_token(
+    probs: torch.Tensor,
+    draft_id: int,
+    eos_token_id: int,
+    generator: torch.Generator | None = None,
+) -> tuple[int, bool]:
+    """Accepts the draft tag with its target probability, or resamples without it.
+
+    Returns the next tag and whether the draft is accepted. `probs` is modified"""
+
+    if (
+        torch.rand(1, generator=generator, device=probs.device).item()
+        < probs[draft_id].item()
+    ):
+        return draft_id, True
+
+    # rejected; sample from the distribution without the draft
+    probs[draft_id] = 0
+    if probs.sum() <= 0:
+        # no other candidates
+        return eos_token_id, False
+    return (
+        int(
+            torch.multinomial(
+                probs / probs.sum(), num_samples=1, generator=generator
+            ).item()
+        ),
+        False,
+    )
+
+
+def _crop_past_key_values(past_key_values: Any, length: int) -> Any:
+    """Drops the states after `length`"""
+
+    if hasattr(past_key_values, "crop"):
+        # Cache classes of newer transformers
+        num_dropped = past_key_values.get_seq_length() - length
+        if num_dropped > 0:
+            past_key_values.crop(-num_dropped)
+        return past_key_values
+
+    # tuple of (key, value) with shape (batch, heads, length, dim)
+    return tuple(
+        tuple(state[:, :, :length] for state in layer) for layer in past_key_values
+    )
+
+
+def _accepts_position_ids(model) -> bool:
+    try:
+        return "position_ids" in inspect.signature(model.forward).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    input_ids: torch.Tensor,
+    draft: TagCooccurrenceDraft,
+    logits_processor: LogitsProcessorList,
+    eos_token_id: int,
+    max_new_tokens: int = 128,
+    do_sample: bool = True,
+    num_draft_tokens: int = 4,
+    generator: torch.Generator | None = None,
+) -> torch.Tensor:
+    """Generates tags verifying the draft tags in one forward pass.
+
+    Drafts are accepted with the probability of the target distribution and a rejected draft is
+    resampled from the rest, so the output follows the same distribution as `generate`.
+    Random numbers are drawn from `generator` if given, otherwise from the global generator.
+    Only a single sequence without beams is supported."""
+
+    assert input_ids.shape[0] == 1, "Only a single sequence is supported"
+
+    pass_position_ids = _accepts_position_ids(model)
+    num_forwards = 0
+
+    def forward(ids: torch.Tensor, past_key_values: Any, past_length: int):
+        nonlocal num_forwards
+        num_forwards += 1
+
+        kwargs = {}
+        if pass_position_ids:
+            kwargs["position_ids"] = torch.arange(
+                past_length, past_length + ids.shape[1], device=ids.device
+            ).unsqueeze(0)
+
+        return model(
+            ids,
+            attention_mask=torch.ones(
+                (1, past_length + ids.shape[1]), dtype=torch.long, device=ids.device
+            ),
+            past_key_values=past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+
+    def get_probs(prefix_ids: torch.Tensor, logits: torch.Tensor) -> torch.Tensor:
+        scores = logits_processor(prefix_ids, logits.unsqueeze(0).float())[0]
+        if do_sample:
+            return torch.softmax(scores, dim=-1)
+
+        # greedy
+        probs = torch.zeros_like(scores)
+        probs[scores.argmax()] = 1.0
+        return probs
+
+    def sample(probs: torch.Tensor) -> int:
+        return int(torch.multinomial(probs, num_samples=1, generator=generator).item())
+
+    output_ids = input_ids
+    past_key_values = None
+    if input_ids.shape[1] > 1:
+        # the states cover all tokens except for the last one
+        past_key_values = forward(input_ids[:, :-1], None, 0).past_key_values
+
+    num_generated = 0
+    while num_generated < max_new_tokens:
+        past_length = output_ids.shape[1] - 1
+        draft_ids = draft.propose(
+            output_ids[0].tolist(),
+            min(num_draft_tokens, max_new_tokens - num_generated - 1),
+        )
+
+        # logits[i] is the distribution after draft_ids[i - 1]
+        out = forward(
+            torch.tensor(
+                [output_ids[0, -1].item(), *draft_ids], device=output_ids.device
+            ).unsqueeze(0),
+            past_key_values,
+            past_length,
+        )
+        logits = out.logits[0]
+
+        new_ids: list[int] = []
+        for i, draft_id in enumerate([*draft_ids, None]):
+            prefix_ids = torch.cat(
+                [
+                    output_ids,
+                    torch.tensor([new_ids], dtype=output_ids.dtype).to(
+                        output_ids.device
+                    ),
+                ],
+                dim=1,
+            )
+            probs = get_probs(prefix_ids, logits[i])
+
+            if draft_id is None:
+                # all drafts are accepted
+                new_ids.append(sample(probs))
+                break
+
+            token_id, accepted = verify_draft_token(
+                probs, draft_id, eos_token_id, generator
+            )
+            new_ids.append(token_id)
+            if not accepted or draft_id == eos_token_id:
+                break
+
+        # the last new token has not been forwarded yet
+        past_key_values = _crop_past_key_values(
+            out.past_key_values, past_length + len(new_ids)
+        )
+
+        output_ids = torch.cat(
+            [
+                output_ids,
+                torch.tensor([new_ids], dtype=output_ids.dtype).to(output_ids.device),
+            ],
+            dim=1,
+        )
+        num_generated += len(new_ids)
+
+        if new_ids[-1] == eos_token_id:
+            break
+
+    logger.debug(
+        f"Speculative decoding generated {num_generated} tokens in {num_forwards} forwards"
+    )
+
+    return output_ids
@@ -0,0 +1,240 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# category flags of a tag. a tag can belong to multiple categories
+TAG_CATEGORY = {
+    "VOCAB": 1 << 0,
+    "CHARACTER": 1 << 1,
+    "COPYRIGHT": 1 << 2,
+    "QUALITY": 1 << 3,
+}
+
+INDEX_MAGIC = b"DTIX"
+INDEX_VERSION = 1
+
+# magic, version, number of tags, hash table size, string table size, fingerprint
+HEADER_FORMAT = "<4sIIIIQ"
+HEADER_SIZE = 32
+
+EMPTY_SLOT = 0xFFFFFFFF
+
+
+def _hash_tag(data: bytes) -> int:
+    # stable across processes unlike hash()
+    return zlib.crc32(data)
+
+
+def _align(size: int, alignment: int = 4) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+
+def get_file_stamp(path: Path) -> tuple[int, int] | None:
+    """Returns the size and the modification time of the file, or None if it does not exist"""
+
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_fingerprint(vocab: Iterable[str], tag_files: list[Path]) -> int:
+    """Returns a fingerprint of the sources of an index"""
+
+    checksum = zlib.crc32("\n".join(vocab).encode("utf-8"))
+    for path in tag_files:
+        size, mtime = get_file_stamp(path) or (-1, -1)
+        source = f"{path.name}:{size}:{mtime}"
+        checksum = zlib.crc32(source.encode("utf-8"), checksum)
+
+    return checksum
+
+
+def build_tag_index(
+    path: Path,
+    categorized_tags: dict[str, Iterable[str]],
+    fingerprint: int = 0,
+) -> Path:
+    """Compiles tags of each category into a binary index file and returns its path.
+
+    The file consists of a header, string offsets, category bytes, an open addressing hash
+    table and a sorted string table."""
+
+    categories: dict[str, int] = {}
+    for category, tags in categorized_tags.items():
+        flag = TAG_CATEGORY[category]
+        for tag in tags:
+            categories[tag] = categories.get(tag, 0) | flag
+
+    tags = sorted(categories.keys())
+    encoded = [tag.encode("utf-8") for tag in tags]
+
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    blob = b"".join(encoded)
+
+    # load factor <= 0.5
+    hash_size = 1
+    while hash_size < len(tags) * 2:
+        hash_size *= 2
+    table = [EMPTY_SLOT] * hash_size
+    for i, data in enumerate(encoded):
+        slot = _hash_tag(data) & (hash_size - 1)
+        while table[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & (hash_size - 1)
+        table[slot] = i
+
+    category_bytes = bytes(categories[tag] for tag in tags)
+
+    header = struct.pack(
+        HEADER_FORMAT,
+        INDEX_MAGIC,
+        INDEX_VERSION,
+        len(tags),
+        hash_size,
+        len(blob),
+        fingerprint,
+    ).ljust(HEADER_SIZE, b"\0")
+
+    # write to a temporary file and swap, so other processes never see a partial file
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+    ) as file:
+        tmp_path = Path(file.name)
+        file.write(header)
+        file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        file.write(category_bytes.ljust(_align(len(category_bytes)), b"\0"))
+        file.write(struct.pack(f"<{hash_size}I", *table))
+        file.write(blob)
+    try:
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # e.g. the file is mapped by another process on Windows
+        logger.warning(f"Failed to replace tag index, using {tmp_path} instead: {e}")
+        path = tmp_path
+
+    logger.info(f"Built tag index with {len(tags)} tags: {path}")
+
+    return path
+
+
+class TagIndex:
+    """A read-only memory-mapped tag index.
+
+    The pages are shared between processes mapping the same file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            self.num_tags,
+            self.hash_size,
+            blob_size,
+            self.fingerprint,
+        ) = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self._mmap.close()
+            raise ValueError(f"Invalid tag index: {path}")
+
+        view = memoryview(self._mmap)
+        position = HEADER_SIZE
+        self._offsets = view[position : position + (self.num_tags + 1) * 4].cast("I")
+        position += (self.num_tags + 1) * 4
+        self._categories = view[position : position + self.num_tags]
+        position += _align(self.num_tags)
+        self._table = view[position : position + self.hash_size * 4].cast("I")
+        position += self.hash_size * 4
+        self._blob = view[position : position + blob_size]
+
+    def __len__(self) -> int:
+        return self.num_tags
+
+    def close(self):
+        for view in [self._offsets, self._categories, self._table, self._blob]:
+            view.release()
+        self._mmap.close()
+
+    def _get_bytes(self, index: int) -> bytes:
+        return bytes(self._blob[self._offsets[index] : self._offsets[index + 1]])
+
+    def get_category(self, tag: str) -> int:
+        """Returns category flags of the tag, or 0 if the tag does not exist"""
+
+        data = tag.encode("utf-8")
+        mask = self.hash_size - 1
+        slot = _hash_tag(data) & mask
+        while True:
+            index = self._table[slot]
+            if index == EMPTY_SLOT:
+                return 0
+            if self._blob[self._offsets[index] : self._offsets[index + 1]] == data:
+                return self._categories[index]
+            slot = (slot + 1) & mask
+
+    def has(self, tag: str, category: str) -> bool:
+        return self.get_category(tag) & TAG_CATEGORY[category] != 0
+
+    def iter_tags(self, include: int, exclude: int = 0) -> Iterator[str]:
+        """Yields tags in sorted order which have any of `include` and none of `exclude` flags"""
+
+        for index in range(self.num_tags):
+            flags = self._categories[index]
+            if flags & include and not flags & exclude:
+                yield self._get_bytes(index).decode("utf-8")
+
+
+def load_tag_index(
+    path: Path,
+    vocab: list[str],
+    tag_files: dict[str, Path],
+    previous: TagIndex | None = None,
+    unchanged: Iterable[str] = (),
+) -> TagIndex:
+    """Loads the tag index, building it if it does not exist or its sources are changed.
+
+    Tags of the `unchanged` categories are copied from the `previous` index."""
+
+    fingerprint = get_fingerprint(vocab, list(tag_files.values()))
+
+    if path.exists():
+        try:
+            index = TagIndex(path)
+            if index.fingerprint == fingerprint:
+                return index
+            logger.info("Tag index is outdated, rebuilding")
+            index.close()
+        except ValueError as e:
+            logger.warning(e)
+
+    categorized_tags: dict[str, Iterable[str]] = {"VOCAB": vocab}
+    for category, tag_file in tag_files.items():
+        if previous is not None and category in unchanged:
+            categorized_tags[category] = previous.iter_tags(
+                include=TAG_CATEGORY[category]
+            )
+        else:
+            categorized_tags[category] = load_tags_in_file(tag_file)
+    return TagIndex(build_tag_index(path, categorized_tags, fingerprint=fingerprint))
+
+
+def load_tags_in_file(path: Path) -> list[str]:
+    if not path.exists():
+        logger.error(f"File not found: {path}")
+        return []
+
+    with open(path, "r", encoding="utf-8") as file:
+        return [tag.strip() for tag in file if tag.strip() != ""]
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Iterable
+
+import torch
+from huggingface_hub import snapshot_download
+from transformers import BatchEncoding
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_FILE = "tokenizer.json"
+TOKENIZER_CONFIG_FILE = "tokenizer_config.json"
+SPECIAL_TOKENS_MAP_FILE = "special_tokens_map.json"
+
+# special tokens skipped in decoding, in addition to the additional special tokens
+SPECIAL_TOKEN_KEYS = [
+    "bos_token",
+    "eos_token",
+    "unk_token",
+    "sep_token",
+    "pad_token",
+    "cls_token",
+    "mask_token",
+]
+
+# the number of tags in each text used for verification
+VERIFICATION_CHUNK_SIZE = 64
+
+# files which change how texts are tokenized
+TOKENIZER_FILES = [TOKENIZER_FILE, TOKENIZER_CONFIG_FILE, SPECIAL_TOKENS_MAP_FILE]
+
+
+def _get_token_content(token: str | dict | None) -> str | None:
+    # special tokens in tokenizer_config.json can be AddedToken dicts
+    if isinstance(token, dict):
+        return token["content"]
+    return token
+
+
+def _get_separator(pre_tokenizer: dict | None) -> re.Pattern | None:
+    """Returns the pattern the pre-tokenizer splits texts with"""
+
+    if pre_tokenizer is None:
+        return None
+    if (
+        pre_tokenizer["type"] == "Split"
+        and pre_tokenizer["behavior"] == "Removed"
+        and not pre_tokenizer.get("invert", False)
+    ):
+        pattern = pre_tokenizer["pattern"]
+        return re.compile(
+            re.escape(pattern["String"]) if "String" in pattern else pattern["Regex"]
+        )
+
+    raise ValueError(f"Unsupported pre-tokenizer: {pre_tokenizer['type']}")
+
+
+class TagTokenizer:
+    """A tokenizer of Dart prompts which looks up whole tags in a dict.
+
+    Dart tokens are added tokens or whole tags separated by ", ", so a prompt is encoded by
+    splitting it without running the remote tokenizer code. Supports the subset of the tokenizer
+    API used by the generator."""
+
+    def __init__(
+        self,
+        vocab: dict[str, int],
+        added_tokens: dict[str, int],
+        special_tokens: Iterable[str],
+        unk_token: str,
+        eos_token: str,
+        pad_token: str | None = None,
+        separator: re.Pattern | None = None,
+    ):
+        self.vocab = {**vocab, **added_tokens}
+        self.added_tokens = added_tokens
+
+        self.unk_token_id = self.vocab[unk_token]
+        self.eos_token = eos_token
+        self.eos_token_id = self.vocab[eos_token]
+        self.pad_token_id = self.vocab.get(pad_token or eos_token, self.eos_token_id)
+        # skipped in decoding
+        self.special_ids = {
+            self.vocab[token] for token in special_tokens if token in self.vocab
+        }
+
+        # id -> token
+        self.id_to_token: list[str | None] = [None] * (max(self.vocab.values()) + 1)
+        for token, id in self.vocab.items():
+            self.id_to_token[id] = token
+
+        # longer tokens first, so that a token containing another one is matched
+        self.added_pattern = re.compile(
+            "("
+            + "|".join(
+                re.escape(token)
+                for token in sorted(added_tokens, key=len, reverse=True)
+            )
+            + ")"
+        )
+        self.separator = separator
+        # sha256 of the tokenizer files it is loaded from
+        self.files_hash: str | None = None
+
+    @classmethod
+    def from_pretrained(cls, name_or_path: str) -> "TagTokenizer":
+        """Loads the vocabulary from tokenizer.json of a local directory or a hub repository"""
+
+        tokenizer_dir = Path(name_or_path)
+        if not tokenizer_dir.is_dir():
+            tokenizer_dir = Path(
+                snapshot_download(name_or_path, allow_patterns=TOKENIZER_FILES)
+            )
+
+        with open(tokenizer_dir / TOKENIZER_FILE, "r", encoding="utf-8") as file:
+            tokenizer = json.load(file)
+        config = {}
+        # special_tokens_map.json is overridden by tokenizer_config.json
+        for file_name in [SPECIAL_TOKENS_MAP_FILE, TOKENIZER_CONFIG_FILE]:
+            if (tokenizer_dir / file_name).exists():
+                with open(tokenizer_dir / file_name, "r", encoding="utf-8") as file:
+                    config.update(json.load(file))
+
+        model = tokenizer["model"]
+        if model["type"] != "WordLevel":
+            raise ValueError(f"Unsupported tokenizer model: {model['type']}")
+        for component in ["normalizer", "post_processor"]:
+            # e.g. bos tokens added to every input
+            if tokenizer.get(component) is not None:
+                raise ValueError(f"Tokenizers with a {component} are not supported")
+
+        added_tokens = tokenizer.get("added_tokens", [])
+        special_tokens = [
+            _get_token_content(config.get(key)) for key in SPECIAL_TOKEN_KEYS
+        ]
+        for key in ["additional_special_tokens", "extra_special_tokens"]:
+            if isinstance(config.get(key), list):
+                special_tokens.extend(
+                    _get_token_content(token) for token in config[key]
+                )
+
+        tag_tokenizer = cls(
+            vocab=model["vocab"],
+            added_tokens={token["content"]: token["id"] for token in added_tokens},
+            special_tokens=[token for token in special_tokens if token is not None],
+            unk_token=model["unk_token"],
+            eos_token=_get_token_content(config.get("eos_token")) or "<|eos|>",
+            pad_token=_get_token_content(config.get("pad_token")),
+            separator=_get_separator(tokenizer.get("pre_tokenizer")),
+        )
+        tag_tokenizer.files_hash = get_tokenizer_files_hash(tokenizer_dir)
+        return tag_tokenizer
+
+    def encode(self, text: str) -> list[int]:
+        ids: list[int] = []
+        # odd parts are added tokens
+        for i, part in enumerate(self.added_pattern.split(text)):
+            if i % 2 == 1:
+                ids.append(self.added_tokens[part])
+                continue
+
+            tags = self.separator.split(part) if self.separator is not None else [part]
+            ids.extend(
+                self.vocab.get(tag, self.unk_token_id) for tag in tags if tag != ""
+            )
+
+        return ids
+
+    def __call__(
+        self, texts: list[str], padding: bool = True, return_tensors: str = "pt"
+    ) -> BatchEncoding:
+        """Encodes texts in a batch, padded on the right"""
+
+        assert return_tensors == "pt", "Only torch tensors are supported"
+
+        encoded = [self.encode(text) for text in texts]
+        max_length = max((len(ids) for ids in encoded), default=0)
+
+        input_ids = torch.full((len(encoded), max_length), self.pad_token_id)
+        attention_mask = torch.zeros((len(encoded), max_length), dtype=torch.long)
+        for i, ids in enumerate(encoded):
+            input_ids[i, : len(ids)] = torch.tensor(ids)
+            attention_mask[i, : len(ids)] = 1
+
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def encode_plus(self, text: str, return_tensors: str = "pt") -> BatchEncoding:
+        return self([text], return_tensors=return_tensors)
+
+    def decode(self, ids: Any, skip_special_tokens: bool = False) -> str:
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+
+        return ", ".join(
+            self.id_to_token[id] or ""
+            for id in ids
+            if not (skip_special_tokens and id in self.special_ids)
+        )
+
+    def convert_tokens_to_ids(self, tokens: str | list[str]) -> int | list[int]:
+        if isinstance(tokens, str):
+            return self.vocab.get(tokens, self.unk_token_id)
+        return [self.vocab.get(token, self.unk_token_id) for token in tokens]
+
+    def convert_ids_to_tokens(self, ids: list[int]) -> list[str]:
+        return [self.id_to_token[id] or "" for id in ids]
+
+    @property
+    def all_special_ids(self) -> list[int]:
+        return sorted(self.special_ids)
+
+    def get_added_vocab(self) -> dict[str, int]:
+        return dict(self.added_tokens)
+
+    def sanitize_special_tokens(self):
+        # added tokens are already matched as they are
+        pass
+
+
+def get_tokenizer_files_hash(tokenizer_dir: Path) -> str:
+    sha256 = hashlib.sha256()
+    for file_name in TOKENIZER_FILES:
+        path = tokenizer_dir / file_name
+        if path.exists():
+            sha256.update(file_name.encode())
+            sha256.update(path.read_bytes())
+    return sha256.hexdigest()
+
+
+class VerifiedTokenizers:
+    """Records the hashes of tokenizer files the tag tokenizer has been verified with"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes: set[str] = self._load()
+
+    def _load(self) -> set[str]:
+        if not self.path.exists():
+            return set()
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                return set(json.load(file)["verified"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Failed to load verified tokenizers: {e}")
+            return set()
+
+    def __contains__(self, files_hash: str | None) -> bool:
+        return files_hash in self.hashes
+
+    def add(self, files_hash: str):
+        with self.lock:
+            self.hashes.add(files_hash)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    "w",
+                    encoding="utf-8",
+                    dir=self.path.parent,
+                    prefix=f"{self.path.name}.",
+                    suffix=".tmp",
+                    delete=False,
+                ) as file:
+                    json.dump({"verified": sorted(self.hashes)}, file, indent=2)
+                os.replace(file.name, self.path)
+            except OSError as e:
+                # verified again in the next session
+                logger.warning(f"Failed to save verified tokenizers: {e}")
+
+
+def get_verification_texts(tag_tokenizer: TagTokenizer) -> list[str]:
+    """Returns texts covering all tags and added tokens"""
+
+    tags = sorted(
+        token
+        for token in tag_tokenizer.vocab
+        if token not in tag_tokenizer.added_tokens
+    )
+    added_tokens = sorted(tag_tokenizer.added_tokens)
+
+    texts = []
+    for i in range(0, len(tags), VERIFICATION_CHUNK_SIZE):
+        chunk = tags[i : i + VERIFICATION_CHUNK_SIZE]
+        # tags between added tokens, as in prompts
+        prefix = (
+            added_tokens[(i // VERIFICATION_CHUNK_SIZE) % len(added_tokens)]
+            if len(added_tokens) > 0
+            else ""
+        )
+        texts.append(f"{prefix}{', '.join(chunk)}{prefix}")
+    if len(added_tokens) > 0:
+        texts.append("".join(added_tokens))
+    if len(tags) > 0:
+        # unknown tags and irregular separators
+        texts.append(f"{tags[0]},{tags[-1]} ,  unknown tag of dart, , {tags[0]}, ")
+
+    return texts
+
+
+def verify_tag_tokenizer(
+    tag_tokenizer: TagTokenizer, reference: Any, texts: list[str] | None = None
+) -> list[str]:
+    """Returns texts which are encoded or decoded differently from the reference tokenizer"""
+
+    if texts is None:
+        texts = get_verification_texts(tag_tokenizer)
+
+    mismatches = []
+    for text in texts:
+        reference_ids = reference(text).input_ids
+        ids = tag_tokenizer.encode(text)
+        if ids != reference_ids or tag_tokenizer.decode(
+            ids, skip_special_tokens=True
+        ) != reference.decode(reference_ids, skip_special_tokens=True):
+            mismatches.append(text)
+
+    return mismatches
@@ -0,0 +1,81 @@
+import logging
+import math
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# max_new_tokens until enough outputs are observed
+DEFAULT_MAX_NEW_TOKENS = 128
+
+# the number of outputs needed to estimate a budget
+MIN_OBSERVATIONS = 16
+# the number of recent outputs kept for each length tag
+MAX_OBSERVATIONS = 256
+
+BUDGET_QUANTILE = 0.99
+BUDGET_MARGIN = 1.25
+
+# tokens of a composed prompt other than the input tags: 10 special tokens and 2 rating tags
+PROMPT_TEMPLATE_NUM_TOKENS = 12
+
+
+class LengthTokenBudget:
+    """Estimates max_new_tokens for each length tag from the lengths of previous outputs.
+
+    Outputs cut by the budget count as the default length, so the budget grows back."""
+
+    def __init__(self, default_max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS):
+        self.default_max_new_tokens = default_max_new_tokens
+        # length tag -> the number of generated tokens
+        self.observations: dict[str | None, deque[int]] = {}
+        # observed and read by concurrent requests
+        self.lock = threading.Lock()
+
+    def observe(self, length_tag: str | None, num_tokens: int, truncated: bool):
+        with self.lock:
+            lengths = self.observations.setdefault(
+                length_tag, deque(maxlen=MAX_OBSERVATIONS)
+            )
+            lengths.append(self.default_max_new_tokens if truncated else num_tokens)
+
+    def get(self, length_tag: str | None) -> int:
+        with self.lock:
+            lengths = self.observations.get(length_tag)
+            if lengths is None or len(lengths) < MIN_OBSERVATIONS:
+                return self.default_max_new_tokens
+
+            ordered = sorted(lengths)
+        quantile = ordered[min(int(len(ordered) * BUDGET_QUANTILE), len(ordered) - 1)]
+
+        return min(math.ceil(quantile * BUDGET_MARGIN), self.default_max_new_tokens)
+
+
+def truncate_tags_to_budget(
+    character: list[str],
+    copyright: list[str],
+    general: list[str],
+    max_tokens: int,
+    tag_counts: dict[str, int],
+) -> tuple[list[str], list[str], list[str]]:
+    """Keeps the most informative tags which fit in `max_tokens` of a composed prompt.
+
+    Character and copyright tags are kept first, then general tags with smaller counts (rarer
+    tags), e.g. how often the model generates them. Tags without counts are the rarest and ties
+    are broken by the input order. Each tag is a token, and kept tags stay in the input order
+    """
+
+    budget = max(max_tokens - PROMPT_TEMPLATE_NUM_TOKENS, 0)
+    if len(character) + len(copyright) + len(general) <= budget:
+        return character, copyright, general
+
+    kept_character = character[:budget]
+    budget -= len(kept_character)
+    kept_copyright = copyright[:budget]
+    budget -= len(kept_copyright)
+
+    # sorted is stable, so earlier tags win ties
+    rarest = set(sorted(general, key=lambda tag: tag_counts.get(tag, 0))[:budget])
+    kept_general = [tag for tag in general if tag in rarest]
+
+    return kept_character, kept_copyright, kept_general
@@ -1,8 +1,12 @@
 import logging
 import random
 import re
+import threading
 
-from typing import TYPE_CHECKING, Any
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Generic, Hashable, TypeVar
+
+import torch
 
 if TYPE_CHECKING:
     from modules.processing import (
@@ -19,6 +23,9 @@ else:
 
 logger = logging.getLogger(__name__)
 
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
 SEED_MIN = 0
 SEED_MAX = 2**32 - 1
 
@@ -104,3 +111,71 @@ def get_patterns_from_tag_list(tags: list[str]) -> list[re.Pattern]:
 def get_valid_tag_list(tag_text: str) -> list[str]:
     """Returns a list of non-empty tags from a tag text"""
     return [tag.strip() for tag in tag_text.split(",") if tag.strip() != ""]
+
+
+def pad_input_ids_left(
+    input_ids: list[torch.Tensor],
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Pads input_ids of each prompt on the left and returns them with the attention mask.
+
+    Padded with the first token of the prompt, which `no_repeat_ngram_size=1` already bans
+    """
+
+    max_length = max(ids.shape[1] for ids in input_ids)
+    padded = torch.stack(
+        [
+            torch.cat([ids[0, :1].repeat(max_length - ids.shape[1]), ids[0]])
+            for ids in input_ids
+        ]
+    )
+    attention_mask = torch.stack(
+        [
+            torch.cat(
+                [
+                    torch.zeros(max_length - ids.shape[1], dtype=torch.long),
+                    torch.ones(ids.shape[1], dtype=torch.long),
+                ]
+            )
+            for ids in input_ids
+        ]
+    )
+    return padded, attention_mask
+
+
+class LRUCache(Generic[K, V]):
+    """A small least-recently-used cache"""
+
+    def __init__(self, max_size: int):
+        assert max_size > 0, f"max_size must be positive: {max_size}"
+
+        self.max_size = max_size
+        self._items: OrderedDict[K, V] = OrderedDict()
+        # shared by concurrent requests
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            if key not in self._items:
+                return None
+
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: K, value: V):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            # drop the least recently used items
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
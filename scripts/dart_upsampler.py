@@ -1,8 +1,12 @@
 import logging
+import time
+from copy import copy
+from itertools import product
+from pathlib import Path
+from typing import Any, Callable
 
 
 import gradio as gr
-from transformers import set_seed
 
 from modules import script_callbacks
 import modules.scripts as scripts
@@ -11,13 +15,21 @@ from modules.processing import (
     StableDiffusionProcessingTxt2Img,
     StableDiffusionProcessingImg2Img,
 )
-from modules.shared import opts
+from modules.shared import opts, state
 
 from dart.generator import DartGenerator
 from dart.analyzer import DartAnalyzer
-from dart.settings import on_ui_settings, parse_options
+from dart.fallback import CooccurrenceFallback
+from dart.grid import (
+    GRID_PROMPT_AXES,
+    UpsamplingRequest,
+    expand_axis_values,
+    parse_grid_job,
+)
+from dart.profiler import UpsamplingProfiler
+from dart.settings import UPSAMPLING_ENGINE_TYPE, on_ui_settings, parse_options
 import dart.utils as utils
-from dart.utils import SEED_MAX
+from dart.utils import SEED_MAX, LRUCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -63,6 +75,31 @@ VARIETY_PRESETS = {
 
 extension_dir = basedir()
 
+# co-occurrence index for the fallback upsampler, built by python -m dart.fallback
+FALLBACK_INDEX_PATH = Path(extension_dir) / "cooccurrence.json"
+# minimum interval of saving the index (seconds)
+FALLBACK_INDEX_SAVE_INTERVAL = 60
+# draft table for speculative decoding, built by python -m dart.fallback
+DRAFT_PATH = Path(extension_dir) / "draft.json"
+
+# default directory of profiling results
+PROFILE_OUTPUT_DIR = Path(extension_dir) / "profiles"
+
+# local snapshots of the models and tokenizers
+SNAPSHOT_MANIFEST_PATH = Path(extension_dir) / "snapshots.json"
+
+# hashes of the tokenizer files the native tag tokenizer has been verified with
+VERIFIED_TOKENIZERS_PATH = Path(extension_dir) / "verified_tokenizers.json"
+
+# ONNX models converted to share the weights between processes
+SHARED_WEIGHTS_DIR = Path(extension_dir) / "shared_weights"
+
+# the maximum number of prompts generated in one batch
+GENERATION_BATCH_SIZE = 16
+
+# the maximum number of upsampled tags kept for the cells of an X/Y/Z plot
+UPSAMPLED_STORE_MAX_SIZE = 4096
+
 
 def _join_texts(prefix: str, suffix: str) -> str:
     return ", ".join([part for part in [prefix, suffix] if part.strip() != ""])
@@ -72,9 +109,29 @@ def _concatnate_texts(prefix: list[str], suffix: list[str]) -> list[str]:
     return [_join_texts(prompt, suffix[i]) for i, prompt in enumerate(prefix)]
 
 
+def _find_xyz_grid(
+    p: StableDiffusionProcessingTxt2Img | StableDiffusionProcessingImg2Img,
+) -> tuple[Any, list] | None:
+    """Returns the module and the arguments of the X/Y/Z plot if it is running"""
+
+    # the first argument is the index of the selected script
+    script_index = p.script_args[0]
+    if not script_index:
+        return None
+    script = p.scripts.selectable_scripts[script_index - 1]
+
+    for data in scripts.scripts_data:
+        if data.script_class.__module__ == "xyz_grid.py" and isinstance(
+            script, data.script_class
+        ):
+            return data.module, p.script_args[script.args_from : script.args_to]
+
+    return None
+
+
 class DartUpsampleScript(scripts.Script):
     generator: DartGenerator
-    analyzer: DartAnalyzer
+    analyzer: DartAnalyzer | None
 
     def __init__(self):
         super().__init__()
@@ -87,11 +144,25 @@ class DartUpsampleScript(scripts.Script):
             self.options["model_name"],
             self.options["tokenizer_name"],
             self.options["model_backend_type"],
+            snapshot_manifest_path=SNAPSHOT_MANIFEST_PATH,
+            shared_weights_dir=SHARED_WEIGHTS_DIR,
+            verified_tokenizers_path=VERIFIED_TOKENIZERS_PATH,
+            draft_path=DRAFT_PATH,
         )
-        self.analyzer = DartAnalyzer(
-            extension_dir,
-            self.generator.get_vocab_list(),
-            self.generator.get_special_vocab_list(),
+        # created on the first request, so that the tokenizer is not loaded at startup
+        self.analyzer = None
+
+        # also loaded on demand for the tag counts of the input token budget
+        self.fallback_index_loaded = False
+        if self.options["upsampling_engine"] != UPSAMPLING_ENGINE_TYPE["ALWAYS_MODEL"]:
+            self._load_fallback_index()
+        self.fallback_index_saved_time = time.time()
+        # moving average of the model latency per prompt
+        self.average_latency: float | None = None
+        self.profiler = UpsamplingProfiler()
+        # upsampled tags of the current generation, shared by the cells of X/Y/Z plots
+        self.upsampled_store: LRUCache[UpsamplingRequest, str] = LRUCache(
+            UPSAMPLED_STORE_MAX_SIZE
         )
 
         script_callbacks.on_ui_settings(on_ui_settings)
@@ -294,60 +365,52 @@ class DartUpsampleScript(scripts.Script):
         if process_timing != PROCESSING_TIMING["AFTER"]:
             return
 
-        analyzing_results = [self.analyzer.analyze(prompt) for prompt in p.all_prompts]
-        logger.debug(f"Analyzed: {analyzing_results}")
+        self._sync_model_options()
 
-        upsampling_prompt = [
-            self.generator.compose_prompt(
-                rating=f"{result.rating_parent}, {result.rating_child}",
-                copyright=result.copyright,
-                character=result.character,
-                general=result.general,
-                length=TOTAL_TAG_LENGTH_TAGS[tag_length],
-            )
-            for result in analyzing_results
-        ]
-        logger.debug(f"Upsampling prompt: {upsampling_prompt}")
-        bad_words_ids = self.generator.get_bad_words_ids(ban_tags)
+        grid_cell = self._start_grid_cell()
+        params = (
+            float(temperature),
+            float(top_p),
+            int(top_k),
+            int(num_bemas),
+            ban_tags,
+            float(cfg_scale),
+        )
 
-        upsampling_negative_prompts = []
-        if do_cfg and negative_prompt is not None:
-            negative_analyzing_result = self.analyzer.analyze(negative_prompt)
-            logger.debug(f"Analyzed (negative): {negative_analyzing_result}")
+        def get_requests(
+            p: StableDiffusionProcessingTxt2Img | StableDiffusionProcessingImg2Img,
+        ) -> list[UpsamplingRequest]:
+            return self._get_upsampling_requests(
+                p.all_prompts,
+                upsampling_seeds=utils.get_upmsapling_seeds(
+                    p,
+                    p.n_iter * p.batch_size,
+                    custom_seed=seed_num,
+                ),
+                tag_length=tag_length,
+                negative_prompt=negative_prompt if do_cfg else None,
+                params=params,
+            )
 
-            for analyzing_result in analyzing_results:
-                upsampling_negative_prompt = self.generator.compose_prompt(
-                    rating=f"{analyzing_result.rating_parent}, {analyzing_result.rating_child}",
-                    copyright=_join_texts(
-                        analyzing_result.copyright, negative_analyzing_result.copyright
-                    ),
-                    character=_join_texts(
-                        analyzing_result.character, negative_analyzing_result.character
-                    ),
-                    general=negative_analyzing_result.general,
-                    length=TOTAL_TAG_LENGTH_TAGS[tag_length],
+        requests = get_requests(p)
+
+        if (
+            grid_cell is not None
+            and grid_cell[0] == 1
+            and parse_options(opts)["grid_bulk_upsampling"]
+        ):
+            # upsample all cells of the plot at once on the first cell
+            grid_requests = self._get_grid_requests(p, get_requests)
+            if grid_requests is not None:
+                logger.debug(
+                    f"Upsampling {len(grid_requests)} prompts of {grid_cell[1]} cells"
+                )
+                self._upsample_requests(
+                    requests + grid_requests,
+                    latency_budget=float(self.options["latency_budget"]) * grid_cell[1],
                 )
-                upsampling_negative_prompts.append(upsampling_negative_prompt)
-
-        num_images = p.n_iter * p.batch_size
-        upsampling_seeds = utils.get_upmsapling_seeds(
-            p,
-            num_images,
-            custom_seed=seed_num,
-        )
 
-        # this list has only 1 item
-        upsampled_tags = self._upsample_tags(
-            upsampling_prompt,
-            seeds=upsampling_seeds,
-            temperature=float(temperature),
-            top_p=float(top_p),
-            top_k=int(top_k),
-            num_bemas=int(num_bemas),
-            bad_words_ids=bad_words_ids,
-            negative_prompts=upsampling_negative_prompts if do_cfg else None,
-            cfg_scale=float(cfg_scale),
-        )
+        upsampled_tags = self._upsample_requests(requests)
         logger.debug(f"Upsampled tags: {upsampled_tags}")
 
         # set new prompts
@@ -378,6 +441,9 @@ class DartUpsampleScript(scripts.Script):
         if process_timing != PROCESSING_TIMING["BEFORE"]:
             return
 
+        self._sync_model_options()
+        assert self.analyzer is not None
+
         analyzing_result = self.analyzer.analyze(p.prompt)
         logger.debug(f"Analyzed: {analyzing_result}")
 
@@ -389,7 +455,6 @@ class DartUpsampleScript(scripts.Script):
             length=TOTAL_TAG_LENGTH_TAGS[tag_length],
         )
         logger.debug(f"Upsampling prompt: {upsampling_prompt}")
-        bad_words_ids = self.generator.get_bad_words_ids(ban_tags)
 
         upsampling_negative_prompt = None
         if do_cfg and negative_prompt is not None:
@@ -414,21 +479,25 @@ class DartUpsampleScript(scripts.Script):
             custom_seed=seed_num,
         )
 
+        # cells of X/Y/Z plots with the same prompt share the upsampled tags
+        self._start_grid_cell()
         # this list has only 1 item
-        upsampled_tags = self._upsample_tags(
-            [upsampling_prompt],
-            seeds=upsampling_seeds,
-            temperature=float(temperature),
-            top_p=float(top_p),
-            top_k=int(top_k),
-            num_bemas=int(num_bemas),
-            bad_words_ids=bad_words_ids,
-            negative_prompts=(
-                [upsampling_negative_prompt]
-                if upsampling_negative_prompt is not None
-                else None
-            ),
-            cfg_scale=float(cfg_scale),
+        upsampled_tags = self._upsample_requests(
+            [
+                UpsamplingRequest(
+                    prompt=upsampling_prompt,
+                    negative_prompt=upsampling_negative_prompt,
+                    seed=upsampling_seeds[0],
+                    params=(
+                        float(temperature),
+                        float(top_p),
+                        int(top_k),
+                        int(num_bemas),
+                        ban_tags,
+                        float(cfg_scale),
+                    ),
+                )
+            ]
         )
         logger.debug(f"Upsampled tags: {upsampled_tags}")
 
@@ -446,27 +515,349 @@ class DartUpsampleScript(scripts.Script):
         bad_words_ids: list[list[int]] | None = None,
         negative_prompts: list[str] | None = None,
         cfg_scale: float = 1.5,
+        latency_budget: float | None = None,
     ) -> list[str]:
         """Upsamples tags using provided prompts and returns added tags."""
 
+        if latency_budget is None:
+            latency_budget = float(self.options["latency_budget"])
+
         if len(prompts) == 1 and len(prompts) != len(seeds):
             prompts = prompts * len(seeds)
 
+        # tokenize all distinct prompts at once
+        self.generator.encode_prompts(
+            prompts + (negative_prompts if negative_prompts is not None else [])
+        )
+
+        engine = self.options["upsampling_engine"]
+        use_fallback = False
+        if engine == UPSAMPLING_ENGINE_TYPE["FALLBACK_WHILE_WARMING_UP"]:
+            self.generator.load_model_in_background()
+            use_fallback = not self.generator._check_model_avaiable()
+
+        self._start_profiling_if_requested()
+        start_time = time.time()
         upsampled_tags = []
-        for i, (prompt, seed) in enumerate(zip(prompts, seeds, strict=True)):
-            set_seed(seed)
-            upsampled_tags.append(
-                self.generator.generate(
-                    prompt,
-                    temperature=temperature,
-                    top_p=top_p,
-                    top_k=top_k,
-                    num_beams=num_bemas,
-                    bad_words_ids=bad_words_ids,
-                    negative_prompt=(
-                        negative_prompts[i] if negative_prompts is not None else None
+        # plain sampling of many prompts, e.g. cells of X/Y/Z plots, is batched
+        if (
+            len(prompts) > 1
+            and not use_fallback
+            and engine != UPSAMPLING_ENGINE_TYPE["FALLBACK_ON_BUDGET"]
+            and num_bemas == 1
+            and negative_prompts is None
+            and not self.options["speculative_decoding"]
+            # profiled for each prompt
+            and not self.profiler.active
+        ):
+            for i in range(0, len(prompts), GENERATION_BATCH_SIZE):
+                batch_prompts = prompts[i : i + GENERATION_BATCH_SIZE]
+                batch_start_time = time.time()
+                upsampled_tags.extend(
+                    self.generator.generate_batch(
+                        batch_prompts,
+                        seeds=seeds[i : i + GENERATION_BATCH_SIZE],
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        bad_words_ids=bad_words_ids,
+                    )
+                )
+                self._update_average_latency(
+                    (time.time() - batch_start_time) / len(batch_prompts)
+                )
+        else:
+            for i, (prompt, seed) in enumerate(zip(prompts, seeds, strict=True)):
+                if (
+                    engine == UPSAMPLING_ENGINE_TYPE["FALLBACK_ON_BUDGET"]
+                    and self.average_latency is not None
+                ):
+                    # fall back if the next prompt is not expected to finish in time
+                    use_fallback = (
+                        time.time() - start_time + self.average_latency > latency_budget
+                    )
+
+                # each prompt is profiled as a request
+                with self.profiler.capture(lambda: self.generator.dart_model):
+                    if use_fallback:
+                        upsampled_tags.append(
+                            self.generator.generate_fallback(
+                                prompt, seed=seed, bad_words_ids=bad_words_ids
+                            )
+                        )
+                        continue
+
+                    prompt_start_time = time.time()
+                    upsampled_tags.append(
+                        self.generator.generate(
+                            prompt,
+                            temperature=temperature,
+                            top_p=top_p,
+                            top_k=top_k,
+                            num_beams=num_bemas,
+                            bad_words_ids=bad_words_ids,
+                            negative_prompt=(
+                                negative_prompts[i]
+                                if negative_prompts is not None
+                                else None
+                            ),
+                            cfg_scale=cfg_scale,
+                            # 0 means no limit
+                            cfg_max_guidance_steps=(
+                                int(self.options["cfg_max_guidance_steps"]) or None
+                            ),
+                            cfg_divergence_threshold=(
+                                float(self.options["cfg_divergence_threshold"]) or None
+                            ),
+                            seed=seed,
+                        )
+                    )
+
+                self._update_average_latency(time.time() - prompt_start_time)
+
+        if not self.profiler.active:
+            self.generator.ort_profile_prefix = None
+
+        self._save_fallback_index_if_needed()
+
+        return upsampled_tags
+
+    def _update_average_latency(self, latency: float):
+        self.average_latency = (
+            latency
+            if self.average_latency is None
+            else 0.8 * self.average_latency + 0.2 * latency
+        )
+
+    def _get_upsampling_requests(
+        self,
+        image_prompts: list[str],
+        upsampling_seeds: list[int],
+        tag_length: str,
+        negative_prompt: str | None,
+        params: tuple,
+    ) -> list[UpsamplingRequest]:
+        assert self.analyzer is not None
+
+        analyzing_results = [self.analyzer.analyze(prompt) for prompt in image_prompts]
+        logger.debug(f"Analyzed: {analyzing_results}")
+
+        negative_analyzing_result = None
+        if negative_prompt is not None:
+            negative_analyzing_result = self.analyzer.analyze(negative_prompt)
+            logger.debug(f"Analyzed (negative): {negative_analyzing_result}")
+
+        requests = []
+        for analyzing_result, seed in zip(
+            analyzing_results, upsampling_seeds, strict=True
+        ):
+            upsampling_prompt = self.generator.compose_prompt(
+                rating=f"{analyzing_result.rating_parent}, {analyzing_result.rating_child}",
+                copyright=analyzing_result.copyright,
+                character=analyzing_result.character,
+                general=analyzing_result.general,
+                length=TOTAL_TAG_LENGTH_TAGS[tag_length],
+            )
+
+            upsampling_negative_prompt = None
+            if negative_analyzing_result is not None:
+                upsampling_negative_prompt = self.generator.compose_prompt(
+                    rating=f"{analyzing_result.rating_parent}, {analyzing_result.rating_child}",
+                    copyright=_join_texts(
+                        analyzing_result.copyright, negative_analyzing_result.copyright
+                    ),
+                    character=_join_texts(
+                        analyzing_result.character, negative_analyzing_result.character
                     ),
-                    cfg_scale=cfg_scale,
+                    general=negative_analyzing_result.general,
+                    length=TOTAL_TAG_LENGTH_TAGS[tag_length],
+                )
+
+            requests.append(
+                UpsamplingRequest(
+                    prompt=upsampling_prompt,
+                    negative_prompt=upsampling_negative_prompt,
+                    seed=seed,
+                    params=params,
                 )
             )
-        return upsampled_tags
+        logger.debug(f"Upsampling prompt: {[r.prompt for r in requests]}")
+
+        return requests
+
+    def _upsample_requests(
+        self, requests: list[UpsamplingRequest], latency_budget: float | None = None
+    ) -> list[str]:
+        """Upsamples tags of the requests which are not upsampled in this generation yet"""
+
+        results = {}
+        missing_requests: dict[tuple, list[UpsamplingRequest]] = {}
+        for request in dict.fromkeys(requests):
+            upsampled = self.upsampled_store.get(request)
+            if upsampled is not None:
+                results[request] = upsampled
+            else:
+                missing_requests.setdefault(request.params, []).append(request)
+
+        for params, missing in missing_requests.items():
+            temperature, top_p, top_k, num_beams, ban_tags, cfg_scale = params
+            negative_prompts = [request.negative_prompt for request in missing]
+
+            upsampled_tags = self._upsample_tags(
+                [request.prompt for request in missing],
+                seeds=[request.seed for request in missing],
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                num_bemas=num_beams,
+                bad_words_ids=self.generator.get_bad_words_ids(ban_tags),
+                negative_prompts=(
+                    negative_prompts if None not in negative_prompts else None
+                ),
+                cfg_scale=cfg_scale,
+                latency_budget=latency_budget,
+            )
+            for request, upsampled in zip(missing, upsampled_tags, strict=True):
+                results[request] = upsampled
+                self.upsampled_store.put(request, upsampled)
+
+        return [results[request] for request in requests]
+
+    def _start_grid_cell(self) -> tuple[int, int] | None:
+        """Returns the cell number and the number of cells if an X/Y/Z plot is running"""
+
+        grid_cell = parse_grid_job(state.job)
+        if grid_cell is None or grid_cell[0] == 1:
+            # upsampled tags are only shared by the cells of the same plot
+            self.upsampled_store.clear()
+
+        return grid_cell
+
+    def _get_grid_requests(
+        self,
+        p: StableDiffusionProcessingTxt2Img | StableDiffusionProcessingImg2Img,
+        get_requests: Callable[[Any], list[UpsamplingRequest]],
+    ) -> list[UpsamplingRequest] | None:
+        """Returns the upsampling requests of all cells of the running X/Y/Z plot.
+
+        Only the axes changing prompts or seeds are applied to copies of the first cell. Cells
+        differing from these requests are upsampled when they are processed"""
+
+        try:
+            xyz_grid = _find_xyz_grid(p)
+            if xyz_grid is None:
+                return None
+            xyz_module, xyz_args = xyz_grid
+
+            axes = []
+            # x, y and z each have the type, the values and the dropdown values
+            for axis_type, axis_values in [xyz_args[0:2], xyz_args[3:5], xyz_args[6:8]]:
+                axis_option = xyz_module.axis_options[axis_type]
+                kind = GRID_PROMPT_AXES.get(axis_option.label)
+                if kind is None:
+                    continue
+
+                values = expand_axis_values(axis_values, kind)
+                if values is None:
+                    # random seeds
+                    return None
+                axes.append((axis_option, values))
+
+            if len(axes) == 0:
+                # all cells are the same as the first cell
+                return []
+
+            first_cell = copy(p)
+            first_cell.setup_prompts()
+            if first_cell.all_prompts != p.all_prompts:
+                # e.g. prompts of sd-dynamic-prompts are not reproduced
+                return None
+
+            requests = []
+            for cell_values in product(*[values for _option, values in axes]):
+                pc = copy(p)
+                for (axis_option, values), value in zip(axes, cell_values):
+                    axis_option.apply(pc, value, values)
+                pc.setup_prompts()
+                requests.extend(get_requests(pc))
+
+            return requests
+
+        except Exception as e:
+            logger.warning(f"Failed to collect prompts of the X/Y/Z plot: {e}")
+            return None
+
+    def _sync_model_options(self):
+        """Follows the changes of the model settings and tag lists without restart"""
+
+        options = parse_options(opts)
+        self.generator.set_model(options["model_name"], options["model_backend_type"])
+
+        def set_output_tags():
+            assert self.analyzer is not None
+            if options["prune_output_vocab"]:
+                self.generator.set_output_tags(
+                    self.analyzer.get_general_vocab(),
+                    ban_tags=options["pruned_ban_tags"],
+                )
+
+        if options["tokenizer_name"] != self.generator.tokenizer_name:
+            self.generator.set_tokenizer(options["tokenizer_name"])
+            if self.analyzer is not None:
+                # counted for the previous tokenizer
+                self.analyzer.tag_counts = None
+                # the output vocabulary is taken from the tag tables of the new tokenizer
+                self.analyzer.reload_if_changed(
+                    self.generator.get_vocab_list(),
+                    self.generator.get_special_vocab_list(),
+                    on_reloaded=set_output_tags,
+                )
+        elif self.analyzer is not None:
+            # tag files may be edited while running
+            self.analyzer.reload_if_changed()
+
+        if self.analyzer is None:
+            self.analyzer = DartAnalyzer(
+                extension_dir,
+                self.generator.get_vocab_list(),
+                self.generator.get_special_vocab_list(),
+            )
+            set_output_tags()
+
+        if int(options["max_input_tokens"]) > 0 and self.analyzer.tag_counts is None:
+            # rarer tags are kept when long prompts are truncated
+            if not self.fallback_index_loaded:
+                self._load_fallback_index()
+            self.analyzer.tag_counts = self.generator.get_tag_counts()
+
+    def _load_fallback_index(self):
+        self.generator.fallback = CooccurrenceFallback.load(
+            FALLBACK_INDEX_PATH, tokenizer_name=self.generator.tokenizer_name
+        )
+        self.fallback_index_loaded = True
+
+    def _start_profiling_if_requested(self):
+        options = parse_options(opts)
+        num_requests = int(options["profile_num_requests"])
+        if num_requests <= 0 or self.profiler.active:
+            return
+
+        output_dir = Path(options["profile_output_dir"] or PROFILE_OUTPUT_DIR)
+        self.profiler.request(num_requests, output_dir)
+        self.generator.enable_ort_profiling(str(output_dir / "onnxruntime"))
+        # captured only once each time the setting is changed
+        opts.set("profile_num_requests", 0)
+
+    def _save_fallback_index_if_needed(self):
+        if self.options["upsampling_engine"] == UPSAMPLING_ENGINE_TYPE["ALWAYS_MODEL"]:
+            return
+        if not self.generator.fallback.updated:
+            return
+        if time.time() - self.fallback_index_saved_time < FALLBACK_INDEX_SAVE_INTERVAL:
+            return
+
+        try:
+            self.generator.fallback.save(FALLBACK_INDEX_PATH)
+        except OSError as e:
+            logger.error(f"Failed to save co-occurrence index: {e}")
+        self.fallback_index_saved_time = time.time()
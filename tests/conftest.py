@@ -0,0 +1,41 @@
+import sys
+import types
+from importlib.util import find_spec
+from typing import Any
+
+
+class Options:
+    """The options of webui with no values set, so the default values are used"""
+
+    def __init__(self):
+        self.data: dict[str, Any] = {}
+
+    def __getattr__(self, item: str):
+        if item != "data" and item in self.data:
+            return self.data[item]
+        raise AttributeError(item)
+
+
+def _add_module(name: str, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+# the generator and the analyzer import webui, which is replaced with minimal modules outside
+# of a webui checkout. Prompt attention and extra networks are not parsed
+if find_spec("modules") is None:
+    modules = _add_module("modules")
+    modules.options = _add_module("modules.options", Options=Options)
+    modules.shared = _add_module("modules.shared", opts=Options())
+    modules.extra_networks = _add_module(
+        "modules.extra_networks", parse_prompt=lambda prompt: (prompt, {})
+    )
+    modules.prompt_parser = _add_module(
+        "modules.prompt_parser", parse_prompt_attention=lambda text: [[text, 1.0]]
+    )
+
+if find_spec("gradio") is None:
+    # components are only created in the settings of webui
+    _add_module("gradio")
@@ -0,0 +1,27 @@
+import sys
+
+sys.path.append(".")
+
+from dart.alias_resolver import TagAliasResolver, normalize_tag
+
+
+def test_normalize_tag():
+    assert normalize_tag("Hatsune_Miku") == "hatsune miku"
+    assert normalize_tag("  long   hair ") == "long hair"
+
+
+def test_tag_alias_resolver():
+    resolver = TagAliasResolver(
+        ["1girl", "long hair", "hatsune miku", "kagamine rin", "vocaloid"]
+    )
+
+    assert resolver.resolve("Hatsune_Miku") == "hatsune miku"
+    assert resolver.resolve("hatsune mku") == "hatsune miku"
+    assert resolver.resolve("lng hair") == "long hair"
+    assert resolver.resolve("my original character") is None
+    assert resolver.resolve("") is None
+
+    assert resolver.resolve_tags(["Long_Hair", "unknown lora"], time_budget=1) == {
+        "Long_Hair": "long hair"
+    }
+    assert resolver.resolve_tags(["Long_Hair"], time_budget=-1) == {}
@@ -0,0 +1,67 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+import dart.benchmark
+from dart.benchmark import (
+    BenchmarkCase,
+    create_benchmark_model,
+    format_table,
+    get_benchmark_cases,
+    run_backend,
+)
+
+
+def test_benchmark_cases():
+    cases = get_benchmark_cases([1, 4], [32], [1, 4])
+
+    assert BenchmarkCase(1, 32, True, 1) in cases
+    assert BenchmarkCase(1, 32, True, 1, cfg_schedule=True, sampling=True) in cases
+    assert BenchmarkCase(4, 32, False, 1, sampling=True) in cases
+    # CFG is only used without batching and beam search
+    assert BenchmarkCase(4, 32, True, 1) not in cases
+    assert BenchmarkCase(1, 32, True, 4) not in cases
+    # sampling is only used without beam search
+    assert BenchmarkCase(1, 32, False, 4, sampling=True) not in cases
+    assert len(cases) == 10
+
+
+def test_run_backend(tmp_path: Path):
+    create_benchmark_model(tmp_path, vocab_size=64, hidden_size=64, num_layers=1)
+    cases = [
+        BenchmarkCase(2, 4, False, 1),
+        BenchmarkCase(1, 4, True, 1),
+        BenchmarkCase(1, 4, True, 1, cfg_schedule=True, sampling=True),
+        BenchmarkCase(2, 4, False, 1, sampling=True),
+    ]
+
+    result = run_backend("Original", tmp_path, None, cases, num_requests=2)
+    assert result.error is None
+    assert result.peak_rss_mb >= result.baseline_rss_mb
+    assert [case_result.case for case_result in result.cases] == cases
+    for case_result in result.cases:
+        assert case_result.p95_latency_ms >= case_result.p50_latency_ms
+        assert case_result.tokens_per_second > 0
+
+    table = format_table([result])
+    assert len(table.splitlines()) == 2 + len(cases)
+
+
+def test_backend_error(tmp_path: Path, monkeypatch):
+    create_benchmark_model(tmp_path, vocab_size=64, hidden_size=64, num_layers=1)
+    cases = [BenchmarkCase(1, 4, False, 1), BenchmarkCase(1, 4, False, 2)]
+
+    def run_case(model, case: BenchmarkCase, *args, **kwargs):
+        if case.num_beams > 1:
+            raise RuntimeError("not supported")
+        return original_run_case(model, case, *args, **kwargs)
+
+    original_run_case = dart.benchmark.run_case
+    monkeypatch.setattr(dart.benchmark, "run_case", run_case)
+
+    result = run_backend("Original", tmp_path, None, cases, num_requests=1)
+    assert result.error == "RuntimeError: not supported"
+    assert [case_result.case for case_result in result.cases] == cases[:1]
+    assert "RuntimeError" in format_table([result]).splitlines()[-1]
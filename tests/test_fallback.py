@@ -0,0 +1,49 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+from dart.fallback import CooccurrenceFallback, build_index, get_build_inputs
+
+VOCAB = {"1girl": 0, "solo": 1, "hat": 2, "hatsune miku": 3, "vocaloid": 4}
+
+
+def test_build_index(tmp_path: Path):
+    (tmp_path / "copyright.txt").write_text("vocaloid\nunknown copyright\n")
+    (tmp_path / "character.txt").write_text("hatsune miku\n")
+
+    inputs = get_build_inputs(tmp_path, VOCAB, num_inputs=10)
+    # only tags in the vocab
+    assert sorted(inputs) == [("", "hatsune miku"), ("vocaloid", "")]
+
+    prompts = []
+
+    def generate(copyright: str, character: str, general: str):
+        prompts.append((copyright, character, general))
+        input_ids = [VOCAB[tag] for tag in [copyright, character, general] if tag]
+        return input_ids, [VOCAB["1girl"], VOCAB["solo"]]
+
+    id_to_tag = {id: tag for tag, id in VOCAB.items()}
+    fallback = build_index(
+        inputs,
+        generate,
+        lambda ids: [id_to_tag[id] for id in ids],
+        num_general_inputs=1,
+        tokenizer_name="dart",
+    )
+
+    # the most frequent output tag is used as a general input
+    assert len(prompts) == 3
+    assert prompts[-1][2] in ["1girl", "solo"]
+    assert fallback.generate([VOCAB["vocaloid"]], num_tags=2, seed=0) != []
+
+    fallback.save(tmp_path / "cooccurrence.json")
+    assert (
+        CooccurrenceFallback.load(tmp_path / "cooccurrence.json", "dart").table
+        == fallback.table
+    )
+    # ids of another tokenizer are not used
+    assert (
+        CooccurrenceFallback.load(tmp_path / "cooccurrence.json", "other").table == {}
+    )
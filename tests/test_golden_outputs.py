@@ -0,0 +1,723 @@
+import sys
+
+sys.path.append(".")
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import (
+    DynamicCache,
+    LlamaConfig,
+    LlamaForCausalLM,
+    LogitsProcessorList,
+)
+
+from dart.analyzer import DartAnalyzer
+from dart.batch import batch_generate
+from dart.beam_search import beam_search_generate
+from dart.generator import DartGenerator
+from dart.logits_processor import (
+    GeneratorSamplingLogitsProcessor,
+    UnbatchedClassifierFreeGuidanceLogitsProcessor,
+)
+from dart.model_pool import ModelPool
+from dart.pruned_head import prune_output_vocab
+from dart.settings import MODEL_BACKEND_TYPE
+from dart.speculative import (
+    TagCooccurrenceDraft,
+    get_logits_processors,
+    speculative_generate,
+)
+from dart.tag_tokenizer import TagTokenizer
+from dart.utils import LRUCache, pad_input_ids_left
+
+# set DART_UPDATE_GOLDEN=1 to regenerate the golden outputs
+GOLDEN_PATH = Path(__file__).parent / "golden_outputs.json"
+UPDATE_GOLDEN = os.environ.get("DART_UPDATE_GOLDEN") == "1"
+
+# small enough that some outputs run out of tokens and end
+VOCAB_SIZE = 32
+EOS_TOKEN_ID = 2
+MAX_NEW_TOKENS = 24
+
+PROMPTS = {
+    "short": [1, 10, 11, 12],
+    "long": [1, 20, 3, 27, 5, 17, 30, 8, 29],
+}
+NEGATIVE_PROMPT = [1, 10, 25, 26]
+
+SAMPLING_CONFIGS = {
+    "greedy": dict(do_sample=False, temperature=1.0, top_p=1.0, top_k=0),
+    "normal": dict(do_sample=True, temperature=1.0, top_p=1.0, top_k=30),
+    "very_unvaried": dict(do_sample=True, temperature=0.85, top_p=0.9, top_k=20),
+    "very_varied": dict(do_sample=True, temperature=2.0, top_p=0.9, top_k=100),
+}
+SEEDS = [0, 1234]
+
+BAD_WORDS_IDS = [[13], [14]]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=VOCAB_SIZE,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            bos_token_id=1,
+            eos_token_id=EOS_TOKEN_ID,
+            pad_token_id=0,
+        )
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def golden():
+    outputs = (
+        json.loads(GOLDEN_PATH.read_text(encoding="utf-8"))
+        if GOLDEN_PATH.exists()
+        else {}
+    )
+    yield outputs
+
+    if UPDATE_GOLDEN:
+        # one output per line
+        lines = [
+            f"  {json.dumps(name)}: {json.dumps(output)}"
+            for name, output in sorted(outputs.items())
+        ]
+        GOLDEN_PATH.write_text("{\n" + ",\n".join(lines) + "\n}\n", encoding="utf-8")
+
+
+def check_golden(golden: dict, name: str, output_ids: torch.Tensor):
+    output = output_ids[0].tolist()
+    if UPDATE_GOLDEN:
+        golden[name] = output
+        return
+
+    assert name in golden, f"No golden output for {name}, run with DART_UPDATE_GOLDEN=1"
+    assert output == golden[name], f"Output of {name} has changed"
+
+
+def generate_reference(model, input_ids: torch.Tensor, seed: int, **kwargs):
+    """The reference path, the same arguments as DartGenerator.generate passes"""
+
+    torch.manual_seed(seed)
+    return model.generate(
+        input_ids,
+        max_new_tokens=MAX_NEW_TOKENS,
+        no_repeat_ngram_size=1,
+        pad_token_id=0,
+        eos_token_id=EOS_TOKEN_ID,
+        **kwargs,
+    )
+
+
+def get_processors(input_ids: torch.Tensor, config: dict, **kwargs):
+    return get_logits_processors(
+        prompt_length=input_ids.shape[1],
+        eos_token_id=EOS_TOKEN_ID,
+        temperature=config["temperature"] if config["do_sample"] else 1.0,
+        top_p=config["top_p"] if config["do_sample"] else 1.0,
+        top_k=config["top_k"] if config["do_sample"] else 0,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("config", SAMPLING_CONFIGS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_generate(model, golden, prompt: str, config: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+
+    output_ids = generate_reference(
+        model,
+        input_ids,
+        seed,
+        bad_words_ids=BAD_WORDS_IDS,
+        **SAMPLING_CONFIGS[config],
+    )
+    check_golden(golden, f"generate/{prompt}/{config}/{seed}", output_ids)
+
+
+@pytest.mark.skipif(UPDATE_GOLDEN, reason="compared with the outputs of test_generate")
+@pytest.mark.parametrize("config", SAMPLING_CONFIGS.keys())
+def test_batch_equals_generate(model, golden, config: str):
+    rows = [(prompt, seed) for prompt in PROMPTS for seed in SEEDS]
+    input_ids, attention_mask = pad_input_ids_left(
+        [torch.tensor([PROMPTS[prompt]]) for prompt, _seed in rows]
+    )
+    sampling_config = SAMPLING_CONFIGS[config]
+
+    output_ids = model.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=MAX_NEW_TOKENS,
+        no_repeat_ngram_size=1,
+        pad_token_id=0,
+        eos_token_id=EOS_TOKEN_ID,
+        bad_words_ids=BAD_WORDS_IDS,
+        logits_processor=LogitsProcessorList(
+            [
+                GeneratorSamplingLogitsProcessor(
+                    [torch.Generator().manual_seed(seed) for _prompt, seed in rows],
+                    temperature=sampling_config["temperature"],
+                    top_p=sampling_config["top_p"],
+                    top_k=sampling_config["top_k"],
+                )
+            ]
+            if sampling_config["do_sample"]
+            else []
+        ),
+        **sampling_config,
+    )
+
+    # each row is sampled with its own seed, as if it were generated alone
+    for (prompt, seed), output in zip(rows, output_ids):
+        generated = output[input_ids.shape[1] :].tolist()
+        if EOS_TOKEN_ID in generated:
+            generated = generated[: generated.index(EOS_TOKEN_ID) + 1]
+        assert (
+            PROMPTS[prompt] + generated == golden[f"generate/{prompt}/{config}/{seed}"]
+        )
+
+
+@pytest.mark.skipif(UPDATE_GOLDEN, reason="compared with the outputs of test_generate")
+@pytest.mark.parametrize("config", SAMPLING_CONFIGS.keys())
+def test_batch_generate_drops_finished_rows(model, golden, config: str):
+    rows = [(prompt, seed) for prompt in PROMPTS for seed in SEEDS]
+    # a short budget for some rows
+    budgets = [MAX_NEW_TOKENS if i % 2 == 0 else 3 for i in range(len(rows))]
+    input_ids, attention_mask = pad_input_ids_left(
+        [torch.tensor([PROMPTS[prompt]]) for prompt, _seed in rows]
+    )
+
+    batch_sizes = []
+    handle = model.register_forward_pre_hook(
+        lambda _module, args: batch_sizes.append(args[0].shape[0])
+    )
+    try:
+        generated_ids = batch_generate(
+            model,
+            input_ids,
+            attention_mask,
+            logits_processor=get_processors(
+                input_ids, SAMPLING_CONFIGS[config], bad_words_ids=BAD_WORDS_IDS
+            ),
+            eos_token_id=EOS_TOKEN_ID,
+            max_new_tokens=budgets,
+            do_sample=SAMPLING_CONFIGS[config]["do_sample"],
+            generators=[torch.Generator().manual_seed(seed) for _prompt, seed in rows],
+        )
+    finally:
+        handle.remove()
+
+    # each row is sampled with its own seed and cut by its own budget
+    for (prompt, seed), generated, budget in zip(rows, generated_ids, budgets):
+        expected = golden[f"generate/{prompt}/{config}/{seed}"][len(PROMPTS[prompt]) :]
+        assert generated == expected[:budget]
+
+    # rows out of the budget are not forwarded any more
+    assert batch_sizes[0] == len(rows)
+    assert batch_sizes[3] <= len(rows) // 2
+    assert batch_sizes == sorted(batch_sizes, reverse=True)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_speculative_greedy_equals_generate(model, golden, prompt: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+    config = SAMPLING_CONFIGS["greedy"]
+
+    reference_ids = generate_reference(model, input_ids, seed, **config)
+
+    # learned from the reference, so that drafts are both accepted and rejected
+    draft = TagCooccurrenceDraft()
+    draft.update(reference_ids[0, :-3].tolist())
+    draft.update(PROMPTS["long"])
+
+    torch.manual_seed(seed)
+    output_ids = speculative_generate(
+        model,
+        input_ids,
+        draft=draft,
+        logits_processor=get_processors(input_ids, config),
+        eos_token_id=EOS_TOKEN_ID,
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=False,
+    )
+
+    assert output_ids.tolist() == reference_ids.tolist()
+    check_golden(golden, f"speculative/{prompt}/greedy/{seed}", output_ids)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("config", ["normal", "very_varied"])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_speculative_sampling(model, golden, prompt: str, config: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+
+    draft = TagCooccurrenceDraft()
+    draft.update(PROMPTS["long"])
+
+    # follows the same distribution as generate, but not the same random numbers
+    torch.manual_seed(seed)
+    output_ids = speculative_generate(
+        model,
+        input_ids,
+        draft=draft,
+        logits_processor=get_processors(input_ids, SAMPLING_CONFIGS[config]),
+        eos_token_id=EOS_TOKEN_ID,
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=True,
+    )
+    check_golden(golden, f"speculative/{prompt}/{config}/{seed}", output_ids)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("config", ["greedy", "very_unvaried"])
+@pytest.mark.parametrize("num_beams", [2, 4])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_beam_search(
+    model, golden, prompt: str, config: str, num_beams: int, seed: int
+):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+
+    torch.manual_seed(seed)
+    output_ids = beam_search_generate(
+        model,
+        input_ids,
+        logits_processor=get_processors(input_ids, SAMPLING_CONFIGS[config]),
+        eos_token_id=EOS_TOKEN_ID,
+        max_new_tokens=MAX_NEW_TOKENS,
+        num_beams=num_beams,
+        do_sample=SAMPLING_CONFIGS[config]["do_sample"],
+    )
+    check_golden(
+        golden, f"beam_search/{prompt}/{config}/{num_beams}/{seed}", output_ids
+    )
+
+
+class TupleCacheModel(torch.nn.Module):
+    """Returns the states as tuples of (key, value) of each layer like ORT models"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+
+    def forward(self, input_ids, past_key_values=None, **kwargs):
+        cache = DynamicCache()
+        for layer_idx, (key, value) in enumerate(past_key_values or []):
+            cache.update(key, value, layer_idx)
+
+        out = self.model(input_ids, past_key_values=cache, **kwargs)
+        out.past_key_values = tuple(
+            (layer.keys, layer.values) for layer in out.past_key_values.layers
+        )
+        return out
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_beam_search_with_tuple_cache(model, golden, prompt: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+    config = SAMPLING_CONFIGS["very_unvaried"]
+
+    torch.manual_seed(seed)
+    output_ids = beam_search_generate(
+        TupleCacheModel(model),
+        input_ids,
+        logits_processor=get_processors(input_ids, config),
+        eos_token_id=EOS_TOKEN_ID,
+        max_new_tokens=MAX_NEW_TOKENS,
+        num_beams=4,
+        do_sample=True,
+    )
+
+    assert (
+        output_ids[0].tolist() == golden[f"beam_search/{prompt}/very_unvaried/4/{seed}"]
+    )
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("config", ["greedy", "normal"])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_cfg(model, golden, prompt: str, config: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+    negative_ids = torch.tensor([NEGATIVE_PROMPT])
+
+    prefix_cache = LRUCache(4)
+    outputs = []
+    # the second run reuses the prefilled negative prompt
+    for _ in range(2):
+        cfg_processor = UnbatchedClassifierFreeGuidanceLogitsProcessor(
+            guidance_scale=1.5,
+            model=model,
+            unconditional_ids=negative_ids,
+            prefix_cache=prefix_cache,
+        )
+        outputs.append(
+            generate_reference(
+                model,
+                input_ids,
+                seed,
+                logits_processor=LogitsProcessorList([cfg_processor]),
+                **SAMPLING_CONFIGS[config],
+            )
+        )
+
+    assert outputs[0].tolist() == outputs[1].tolist()
+    check_golden(golden, f"cfg/{prompt}/{config}/{seed}", outputs[0])
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_pruned_output_vocab(model, golden, prompt: str, seed: int):
+    input_ids = torch.tensor([PROMPTS[prompt]])
+    keep_ids = [EOS_TOKEN_ID, *range(8, 24)]
+
+    pruned_model = LlamaForCausalLM(model.config).eval()
+    pruned_model.load_state_dict(model.state_dict())
+    prune_output_vocab(pruned_model, keep_ids)
+
+    # the same as banning all the other tokens
+    reference_ids = generate_reference(
+        model,
+        input_ids,
+        seed,
+        bad_words_ids=[[id] for id in range(VOCAB_SIZE) if id not in keep_ids],
+        **SAMPLING_CONFIGS["normal"],
+    )
+    output_ids = generate_reference(
+        pruned_model, input_ids, seed, **SAMPLING_CONFIGS["normal"]
+    )
+
+    assert output_ids.tolist() == reference_ids.tolist()
+    check_golden(golden, f"pruned/{prompt}/normal/{seed}", output_ids)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS.keys())
+@pytest.mark.parametrize("config", ["greedy", "normal"])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_onnx_generate(
+    model, golden, tmp_path_factory, prompt: str, config: str, seed: int
+):
+    onnxruntime = pytest.importorskip("optimum.onnxruntime")
+
+    model_dir = tmp_path_factory.getbasetemp() / "onnx_model"
+    if not model_dir.exists():
+        model.save_pretrained(model_dir / "torch")
+        onnxruntime.ORTModelForCausalLM.from_pretrained(
+            model_dir / "torch", export=True
+        ).save_pretrained(model_dir)
+    onnx_model = onnxruntime.ORTModelForCausalLM.from_pretrained(model_dir)
+
+    input_ids = torch.tensor([PROMPTS[prompt]])
+    output_ids = generate_reference(
+        onnx_model,
+        input_ids,
+        seed,
+        bad_words_ids=BAD_WORDS_IDS,
+        **SAMPLING_CONFIGS[config],
+    )
+
+    # compared with the golden outputs of the original backend
+    assert output_ids[0].tolist() == golden[f"generate/{prompt}/{config}/{seed}"]
+
+
+def test_concurrent_sampling_with_generators(model):
+    input_ids = torch.tensor([PROMPTS["long"]])
+    config = SAMPLING_CONFIGS["normal"]
+
+    def sample(seed: int):
+        return speculative_generate(
+            model,
+            input_ids,
+            draft=TagCooccurrenceDraft(),
+            logits_processor=get_processors(input_ids, config),
+            eos_token_id=EOS_TOKEN_ID,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=True,
+            num_draft_tokens=0,
+            generator=torch.Generator().manual_seed(seed),
+        ).tolist()
+
+    expected = {seed: sample(seed) for seed in SEEDS}
+
+    # requests of the model pool do not share the global RNG
+    results: dict[int, list] = {}
+    threads = [
+        threading.Thread(target=lambda seed=seed: results.update({seed: sample(seed)}))
+        for seed in SEEDS
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == expected
+
+
+def test_concurrent_generate_with_generators(model):
+    input_ids = torch.tensor([PROMPTS["long"]])
+    config = SAMPLING_CONFIGS["normal"]
+
+    def sample(seed: int):
+        generator = torch.Generator().manual_seed(seed)
+        return model.generate(
+            input_ids,
+            max_new_tokens=MAX_NEW_TOKENS,
+            no_repeat_ngram_size=1,
+            logits_processor=LogitsProcessorList(
+                [
+                    GeneratorSamplingLogitsProcessor(
+                        [generator],
+                        temperature=config["temperature"],
+                        top_p=config["top_p"],
+                        top_k=config["top_k"],
+                    )
+                ]
+            ),
+            **config,
+        ).tolist()
+
+    expected = {seed: sample(seed) for seed in SEEDS}
+    # the global RNG is not used
+    torch.manual_seed(1234)
+    assert sample(SEEDS[0]) == expected[SEEDS[0]]
+
+    results: dict[int, list] = {}
+    threads = [
+        threading.Thread(target=lambda seed=seed: results.update({seed: sample(seed)}))
+        for seed in SEEDS
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == expected
+    assert len({str(ids) for ids in results.values()}) > 1
+
+
+# a tag tokenizer of the tiny model, ids 0, 1 and 2 are the pad, bos and eos tokens
+DART_SPECIAL_TOKENS = [
+    "<|pad|>",
+    "<|bos|>",
+    "<|eos|>",
+    "<|unknown|>",
+    "<rating>",
+    "</rating>",
+    "<copyright>",
+    "</copyright>",
+    "<character>",
+    "</character>",
+    "<general>",
+    "</general>",
+    "<|input_end|>",
+    "<|very_short|>",
+    "<|short|>",
+    "<|long|>",
+    "<|very_long|>",
+]
+DART_RATING_TOKENS = ["rating:sfw", "rating:general"]
+DART_TAGS = [
+    "1girl",
+    "solo",
+    "long hair",
+    "smile",
+    "hatsune miku",
+    "vocaloid",
+    "blue hair",
+    "twintails",
+    "hat",
+    "skirt",
+    "open mouth",
+    "blush",
+    "shirt",
+]
+
+IMAGE_PROMPTS = {
+    "short": "1girl, hatsune miku, vocaloid",
+    "long": "1girl, solo, long hair, twintails, smile, skirt, unknown tag",
+}
+NEGATIVE_IMAGE_PROMPT = "hat, blush"
+# the tiny model barely follows its prompts, a small scale hardly changes the outputs
+DART_CFG_SCALE = 3.0
+
+
+@pytest.fixture(scope="module")
+def dart_dir(model, tmp_path_factory) -> Path:
+    from tokenizers import Tokenizer, pre_tokenizers
+    from tokenizers.models import WordLevel
+
+    dart_dir = tmp_path_factory.mktemp("dart")
+    model.save_pretrained(dart_dir)
+
+    vocab = {
+        token: id
+        for id, token in enumerate(DART_SPECIAL_TOKENS + DART_RATING_TOKENS + DART_TAGS)
+    }
+    assert len(vocab) == VOCAB_SIZE
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<|unknown|>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(", ", behavior="removed")
+    tokenizer.add_special_tokens(DART_SPECIAL_TOKENS)
+    tokenizer.add_tokens(DART_RATING_TOKENS)
+    tokenizer.save(str(dart_dir / "tokenizer.json"))
+    (dart_dir / "tokenizer_config.json").write_text(
+        json.dumps(
+            {
+                "tokenizer_class": "PreTrainedTokenizerFast",
+                "pad_token": "<|pad|>",
+                "bos_token": "<|bos|>",
+                "eos_token": "<|eos|>",
+                "unk_token": "<|unknown|>",
+                "additional_special_tokens": DART_SPECIAL_TOKENS[4:],
+            }
+        )
+    )
+
+    tags_dir = dart_dir / "tags"
+    tags_dir.mkdir()
+    (tags_dir / "copyright.txt").write_text("vocaloid\n")
+    (tags_dir / "character.txt").write_text("hatsune miku\n")
+    (tags_dir / "quality.txt").write_text("")
+
+    return dart_dir
+
+
+@pytest.fixture
+def dart_generator(dart_dir: Path):
+    generator = DartGenerator(
+        str(dart_dir), str(dart_dir), MODEL_BACKEND_TYPE["ORIGINAL"]
+    )
+    # the same tokenizer with any version of transformers
+    generator.dart_tokenizer = TagTokenizer.from_pretrained(str(dart_dir))
+    generator.options["speculative_decoding"] = False
+    return generator
+
+
+@pytest.fixture
+def dart_prompts(dart_generator, dart_dir: Path) -> dict[str, str]:
+    analyzer = DartAnalyzer(
+        str(dart_dir),
+        dart_generator.get_vocab_list(),
+        dart_generator.get_special_vocab_list(),
+    )
+
+    def compose(image_prompt: str, general: str | None = None) -> str:
+        result = analyzer.analyze(image_prompt)
+        return dart_generator.compose_prompt(
+            rating=f"{result.rating_parent}, {result.rating_child}",
+            copyright=result.copyright,
+            character=result.character,
+            general=result.general if general is None else general,
+            length="<|short|>",
+        )
+
+    prompts = {
+        name: compose(image_prompt) for name, image_prompt in IMAGE_PROMPTS.items()
+    }
+    for name, image_prompt in IMAGE_PROMPTS.items():
+        prompts[f"{name}/negative"] = compose(
+            image_prompt, general=analyzer.analyze(NEGATIVE_IMAGE_PROMPT).general
+        )
+    return prompts
+
+
+def check_golden_tags(golden: dict, name: str, output: str):
+    if UPDATE_GOLDEN:
+        golden[name] = output
+        return
+
+    assert name in golden, f"No golden output for {name}, run with DART_UPDATE_GOLDEN=1"
+    assert output == golden[name], f"Output of {name} has changed"
+
+
+@pytest.mark.parametrize("prompt", IMAGE_PROMPTS.keys())
+@pytest.mark.parametrize("config", SAMPLING_CONFIGS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_dart_generator(
+    dart_generator, dart_prompts, golden, prompt: str, config: str, seed: int
+):
+    output = dart_generator.generate(
+        dart_prompts[prompt], seed=seed, **SAMPLING_CONFIGS[config]
+    )
+    check_golden_tags(golden, f"dart_generator/{prompt}/{config}/{seed}", output)
+
+
+@pytest.mark.skipif(
+    UPDATE_GOLDEN, reason="compared with the outputs of test_dart_generator"
+)
+@pytest.mark.parametrize("config", SAMPLING_CONFIGS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_dart_generator_paths(
+    dart_generator, dart_prompts, golden, config: str, seed: int
+):
+    expected = [
+        golden[f"dart_generator/{prompt}/{config}/{seed}"]
+        for prompt in IMAGE_PROMPTS.keys()
+    ]
+    prompts = [dart_prompts[prompt] for prompt in IMAGE_PROMPTS.keys()]
+
+    assert (
+        dart_generator.generate_batch(
+            prompts, seeds=[seed] * len(prompts), **SAMPLING_CONFIGS[config]
+        )
+        == expected
+    )
+
+    # sampled with a generator per request
+    dart_generator.model_pool = ModelPool(
+        2, create_replica=dart_generator.model_pool.create_replica
+    )
+    assert [
+        dart_generator.generate(prompt, seed=seed, **SAMPLING_CONFIGS[config])
+        for prompt in prompts
+    ] == expected
+
+    if not SAMPLING_CONFIGS[config]["do_sample"]:
+        dart_generator.options["speculative_decoding"] = True
+        assert [
+            dart_generator.generate(prompt, seed=seed, **SAMPLING_CONFIGS[config])
+            for prompt in prompts
+        ] == expected
+
+
+@pytest.mark.parametrize("prompt", IMAGE_PROMPTS.keys())
+@pytest.mark.parametrize("config", ["greedy", "normal"])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_dart_generator_cfg(
+    dart_generator, dart_prompts, golden, prompt: str, config: str, seed: int
+):
+    output = dart_generator.generate(
+        dart_prompts[prompt],
+        negative_prompt=dart_prompts[f"{prompt}/negative"],
+        cfg_scale=DART_CFG_SCALE,
+        seed=seed,
+        **SAMPLING_CONFIGS[config],
+    )
+    check_golden_tags(golden, f"dart_generator_cfg/{prompt}/{config}/{seed}", output)
+
+
+@pytest.mark.parametrize("prompt", IMAGE_PROMPTS.keys())
+@pytest.mark.parametrize("seed", SEEDS)
+def test_dart_generator_beam_search(
+    dart_generator, dart_prompts, golden, prompt: str, seed: int
+):
+    output = dart_generator.generate(
+        dart_prompts[prompt],
+        num_beams=2,
+        seed=seed,
+        **SAMPLING_CONFIGS["very_unvaried"],
+    )
+    check_golden_tags(golden, f"dart_generator_beam_search/{prompt}/{seed}", output)
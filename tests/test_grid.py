@@ -0,0 +1,38 @@
+import sys
+
+sys.path.append(".")
+
+from dart.grid import UpsamplingRequest, expand_axis_values, parse_grid_job
+
+
+def test_parse_grid_job():
+    assert parse_grid_job("3 out of 12") == (3, 12)
+    assert parse_grid_job("") is None
+    assert parse_grid_job("Batch 1 out of 2") is None
+
+
+def test_expand_seeds():
+    assert expand_axis_values("1, 3-5, 10-20 (+5)", "seed") == [1, 3, 4, 5, 10, 15, 20]
+    assert expand_axis_values("0-10 [3], 7", "seed") == [0, 5, 10, 7]
+    # decided randomly by the X/Y/Z plot
+    assert expand_axis_values("1, -1", "seed") is None
+
+
+def test_expand_texts():
+    assert expand_axis_values('cat, dog, "red, blue"', "text") == [
+        "cat",
+        "dog",
+        "red, blue",
+    ]
+    assert expand_axis_values("cat, dog", "order") == [
+        ("cat", "dog"),
+        ("dog", "cat"),
+    ]
+
+
+def test_request_key():
+    request = UpsamplingRequest("<|bos|>", None, 1, (1.0, 0.9, 20, 1, "", 1.5))
+    assert request == UpsamplingRequest("<|bos|>", None, 1, (1.0, 0.9, 20, 1, "", 1.5))
+    assert {request: "1girl"}[
+        UpsamplingRequest("<|bos|>", None, 1, (1.0, 0.9, 20, 1, "", 1.5))
+    ] == "1girl"
@@ -0,0 +1,103 @@
+import sys
+
+sys.path.append(".")
+
+import threading
+
+import pytest
+import torch
+
+from dart.model_pool import ModelPool, can_share_model
+
+
+class IOBindingModel:
+    use_io_binding = True
+
+
+def test_can_share_model():
+    assert can_share_model(torch.nn.Linear(2, 2))
+    assert not can_share_model(IOBindingModel())
+
+
+def test_shared_model():
+    model = torch.nn.Linear(2, 2)
+    pool = ModelPool(4, create_replica=lambda: pytest.fail("no replica is needed"))
+    pool.set_model(model)
+
+    with pool.checkout() as first, pool.checkout() as second:
+        assert first is model
+        assert second is model
+
+
+def test_replicas():
+    model = IOBindingModel()
+    created = []
+
+    def create_replica():
+        created.append(IOBindingModel())
+        return created[-1]
+
+    pool = ModelPool(2, create_replica=create_replica)
+    pool.set_model(model)
+
+    with pool.checkout() as first, pool.checkout() as second:
+        assert first is model
+        assert second is created[0]
+
+    # returned replicas are used again
+    with pool.checkout() as first, pool.checkout() as second:
+        assert {id(first), id(second)} == {id(model), id(created[0])}
+    assert len(created) == 1
+
+    # replicas of the old model are dropped
+    pool.set_model(IOBindingModel())
+    assert pool.idle_replicas == []
+
+
+def test_failed_replica():
+    def create_replica():
+        raise RuntimeError("out of memory")
+
+    pool = ModelPool(2, create_replica=create_replica)
+    pool.set_model(IOBindingModel())
+
+    with pool.checkout():
+        with pytest.raises(RuntimeError):
+            with pool.checkout():
+                pass
+    assert pool.num_replicas == 1
+
+
+def test_no_model():
+    pool = ModelPool(1, create_replica=IOBindingModel)
+
+    with pytest.raises(RuntimeError):
+        with pool.checkout():
+            pass
+
+
+def test_concurrency_limit():
+    pool = ModelPool(2, create_replica=lambda: None)
+    pool.set_model(torch.nn.Linear(2, 2))
+
+    lock = threading.Lock()
+    num_running = 0
+    max_running = 0
+
+    def run():
+        nonlocal num_running, max_running
+        with pool.checkout():
+            with lock:
+                num_running += 1
+                max_running = max(max_running, num_running)
+            threading.Event().wait(0.01)
+            with lock:
+                num_running -= 1
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_running == 2
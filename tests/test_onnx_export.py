@@ -0,0 +1,77 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from dart.onnx_export import (
+    export_onnx,
+    quantize_onnx,
+    register_exported_model,
+    validate_onnx,
+)
+from dart.snapshot import SnapshotResolver, get_snapshot_name
+
+
+@pytest.fixture
+def checkpoint_dir(tmp_path: Path) -> Path:
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=32,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            eos_token_id=2,
+        )
+    )
+    model.save_pretrained(tmp_path / "checkpoint")
+    return tmp_path / "checkpoint"
+
+
+def test_register_exported_model(tmp_path: Path, checkpoint_dir: Path):
+    output_dir = tmp_path / "onnx"
+    output_dir.mkdir()
+    (output_dir / "config.json").write_text("{}")
+    (output_dir / "model.onnx").write_bytes(b"onnx")
+
+    manifest_path = tmp_path / "snapshots.json"
+    register_exported_model(manifest_path, "my-dart", checkpoint_dir, output_dir)
+
+    snapshots = SnapshotResolver(manifest_path)
+    local_dir, files = snapshots.resolve(
+        get_snapshot_name("my-dart", "ONNX"), "my-dart", allow_patterns=[]
+    )
+    assert local_dir == output_dir
+    assert files == ["config.json", "model.onnx"]
+
+    local_dir, files = snapshots.resolve(
+        get_snapshot_name("my-dart", "Original"), "my-dart", allow_patterns=[]
+    )
+    assert local_dir == checkpoint_dir
+    assert "model.safetensors" in files
+
+    # not exported
+    assert get_snapshot_name("my-dart", "ONNX (Quantized)") not in snapshots.entries
+
+
+def test_export_and_validate(tmp_path: Path, checkpoint_dir: Path):
+    pytest.importorskip("optimum.exporters.onnx")
+    pytest.importorskip("onnxruntime.quantization")
+
+    output_dir = tmp_path / "onnx"
+    export_onnx(checkpoint_dir, output_dir)
+    quantize_onnx(output_dir)
+
+    result = validate_onnx(checkpoint_dir, output_dir, "model.onnx")
+    assert result.max_abs_diff < 1e-3
+    assert result.same_generation
+
+    result = validate_onnx(checkpoint_dir, output_dir, "model_quantized.onnx")
+    assert result.top1_agreement > 0.5
@@ -0,0 +1,36 @@
+import sys
+
+sys.path.append(".")
+
+import json
+from pathlib import Path
+
+import torch
+
+from dart.profiler import UpsamplingProfiler
+
+
+def test_profiles_only_captured_requests(tmp_path: Path):
+    profiler = UpsamplingProfiler()
+    profiler.request(2, tmp_path)
+
+    x = torch.randn(16, 16)
+    for _ in range(2):
+        with profiler.capture():
+            torch.mm(x, x)
+        # e.g. image generation between upsampling requests
+        torch.cumsum(x, dim=0)
+
+    assert not profiler.active
+    traces = list(tmp_path.glob("dart-profile-*.json"))
+    assert len(traces) == 1
+
+    names = {
+        event.get("name") for event in json.loads(traces[0].read_text())["traceEvents"]
+    }
+    assert "aten::mm" in names
+    assert "aten::cumsum" not in names
+
+    summary = next(tmp_path.glob("dart-profile-*.txt")).read_text()
+    assert summary.startswith("2 requests")
+    assert "aten::mm" in summary
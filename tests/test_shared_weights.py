@@ -0,0 +1,85 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from dart.shared_weights import (
+    get_memory_usage,
+    load_mmap_safetensors,
+    load_shared_torch_model,
+)
+
+
+@pytest.fixture
+def checkpoint_dir(tmp_path: Path) -> Path:
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=32,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            tie_word_embeddings=True,
+        )
+    )
+    model.save_pretrained(tmp_path / "checkpoint")
+    return tmp_path / "checkpoint"
+
+
+@torch.no_grad()
+def test_same_as_from_pretrained(checkpoint_dir: Path):
+    expected = AutoModelForCausalLM.from_pretrained(checkpoint_dir).eval()
+    model = load_shared_torch_model(checkpoint_dir)
+
+    assert not model.training
+    assert model.lm_head.weight is model.model.embed_tokens.weight
+
+    input_ids = torch.tensor([[1, 5, 7, 3]])
+    assert torch.equal(model(input_ids).logits, expected(input_ids).logits)
+
+
+def test_parameters_are_mapped(checkpoint_dir: Path):
+    model = load_shared_torch_model(checkpoint_dir)
+    (path,) = checkpoint_dir.glob("*.safetensors")
+
+    # no parameter is allocated for the model
+    storages = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    assert len(storages) == 1
+    assert next(model.parameters()).untyped_storage().nbytes() == path.stat().st_size
+    # buffers not in the checkpoint are computed
+    assert not any(buffer.is_meta for buffer in model.buffers())
+
+
+def test_half_precision_weights(checkpoint_dir: Path):
+    AutoModelForCausalLM.from_pretrained(checkpoint_dir).half().save_pretrained(
+        checkpoint_dir
+    )
+
+    with pytest.raises(ValueError, match="float32"):
+        load_shared_torch_model(checkpoint_dir)
+
+
+def test_mapped_tensors(checkpoint_dir: Path):
+    (path,) = checkpoint_dir.glob("*.safetensors")
+    tensors = load_mmap_safetensors(path)
+
+    # all tensors are views of the same file
+    storages = {tensor.untyped_storage().data_ptr() for tensor in tensors.values()}
+    assert len(storages) == 1
+    assert sum(tensor.nbytes for tensor in tensors.values()) <= path.stat().st_size
+
+
+def test_memory_usage():
+    if not Path("/proc/self/status").exists():
+        pytest.skip("only available on Linux")
+
+    usage = get_memory_usage()
+    assert usage is not None
+    assert usage.shared_mb + usage.private_mb <= usage.rss_mb + 1
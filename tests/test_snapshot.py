@@ -0,0 +1,167 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+import pytest
+
+import dart.snapshot
+from dart.snapshot import (
+    SnapshotError,
+    SnapshotResolver,
+    find_file,
+    get_onnx_patterns,
+)
+
+REPO_FILES = {
+    "config.json": "{}",
+    "tokenizer_config.json": "{}",
+    "onnx/model.onnx": "model",
+    "onnx/model_quantized.onnx": "quantized",
+    "README.md": "readme",
+}
+
+
+@pytest.fixture
+def downloads(tmp_path: Path, monkeypatch):
+    """Replaces the hub with a local directory and records download calls"""
+
+    repo_dir = tmp_path / "hub" / "snapshot"
+    for relative_path, content in REPO_FILES.items():
+        (repo_dir / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (repo_dir / relative_path).write_text(content)
+
+    calls = []
+
+    def snapshot_download(repo_id: str, allow_patterns: list[str]):
+        calls.append(repo_id)
+        return str(repo_dir)
+
+    monkeypatch.setattr(dart.snapshot, "snapshot_download", snapshot_download)
+    return repo_dir, calls
+
+
+def test_record_and_reuse(tmp_path: Path, downloads):
+    repo_dir, calls = downloads
+    manifest_path = tmp_path / "snapshots.json"
+
+    resolver = SnapshotResolver(manifest_path)
+    local_dir, files = resolver.resolve(
+        "onnx",
+        "p1atdev/dart",
+        allow_patterns=get_onnx_patterns("model_quantized.onnx"),
+    )
+    assert local_dir == repo_dir
+    assert files == [
+        "config.json",
+        "onnx/model_quantized.onnx",
+        "tokenizer_config.json",
+    ]
+    assert find_file(files, "model_quantized.onnx") == "onnx/model_quantized.onnx"
+    resolver.confirm("onnx")
+
+    # a new session loads the snapshot without downloading
+    local_dir, files = SnapshotResolver(manifest_path).resolve(
+        "onnx", "p1atdev/dart", allow_patterns=[]
+    )
+    assert local_dir == repo_dir
+    assert calls == ["p1atdev/dart"]
+
+
+def test_missing_files(tmp_path: Path, downloads):
+    repo_dir, calls = downloads
+    manifest_path = tmp_path / "snapshots.json"
+
+    resolver = SnapshotResolver(manifest_path)
+    resolver.resolve(
+        "onnx", "p1atdev/dart", allow_patterns=get_onnx_patterns("model.onnx")
+    )
+    resolver.confirm("onnx")
+    (repo_dir / "onnx" / "model.onnx").unlink()
+
+    resolver = SnapshotResolver(manifest_path)
+    assert resolver.verify("onnx") == ["onnx/model.onnx"]
+    with pytest.raises(SnapshotError, match="onnx/model.onnx"):
+        resolver.resolve("onnx", "p1atdev/dart", allow_patterns=[])
+    # fails instead of downloading again
+    assert calls == ["p1atdev/dart"]
+
+
+def test_modified_files(tmp_path: Path, downloads):
+    repo_dir, _calls = downloads
+    resolver = SnapshotResolver(tmp_path / "snapshots.json")
+    resolver.resolve("tokenizer", "p1atdev/dart", allow_patterns=["*.json"])
+
+    # the same size, only detected by hashes
+    (repo_dir / "config.json").write_text("[]")
+    assert resolver.verify("tokenizer") == []
+    assert resolver.verify("tokenizer", check_hashes=True) == ["config.json"]
+
+
+def test_required_patterns(tmp_path: Path, downloads):
+    resolver = SnapshotResolver(tmp_path / "snapshots.json")
+
+    with pytest.raises(SnapshotError, match="safetensors"):
+        resolver.resolve(
+            "original",
+            "p1atdev/dart",
+            allow_patterns=["*.json", "*.safetensors"],
+            required_patterns=[["*.safetensors", "pytorch_model*.bin"]],
+        )
+    assert not (tmp_path / "snapshots.json").exists()
+
+
+def test_unconfirmed_snapshot(tmp_path: Path, downloads):
+    _repo_dir, calls = downloads
+    manifest_path = tmp_path / "snapshots.json"
+
+    # e.g. loading the model failed
+    SnapshotResolver(manifest_path).resolve(
+        "original", "p1atdev/dart", allow_patterns=["*.json"]
+    )
+    assert not manifest_path.exists()
+
+    resolver = SnapshotResolver(manifest_path)
+    resolver.resolve("original", "p1atdev/dart", allow_patterns=["*.json"])
+    assert calls == ["p1atdev/dart", "p1atdev/dart"]
+    resolver.confirm("original")
+    assert "original" in SnapshotResolver(manifest_path).entries
+
+
+def test_broken_manifest(tmp_path: Path, downloads):
+    manifest_path = tmp_path / "snapshots.json"
+    manifest_path.write_text("{")
+
+    _local_dir, files = SnapshotResolver(manifest_path).resolve(
+        "tokenizer", "p1atdev/dart", allow_patterns=["tokenizer_config.json"]
+    )
+    assert files == ["tokenizer_config.json"]
+
+
+def test_local_model_dir(tmp_path: Path, downloads):
+    repo_dir, calls = downloads
+
+    local_dir, files = SnapshotResolver(tmp_path / "snapshots.json").resolve(
+        "original",
+        str(repo_dir),
+        allow_patterns=["*.json"],
+        required_patterns=[["config.json"]],
+    )
+    # not downloaded
+    assert calls == []
+    assert local_dir == repo_dir
+    assert files == ["config.json", "tokenizer_config.json"]
+
+
+def test_download_errors(tmp_path: Path, monkeypatch):
+    def snapshot_download(repo_id: str, allow_patterns: list[str]):
+        # e.g. HFValidationError of an invalid repository id
+        raise ValueError(f"Repo id must be in the form 'repo_name': '{repo_id}'")
+
+    monkeypatch.setattr(dart.snapshot, "snapshot_download", snapshot_download)
+
+    with pytest.raises(SnapshotError, match="not/a/repo"):
+        SnapshotResolver(tmp_path / "snapshots.json").resolve(
+            "original", "not/a/repo", allow_patterns=["*.json"]
+        )
@@ -0,0 +1,89 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+import torch
+
+from dart.speculative import (
+    MAX_FOLLOWING_TAGS,
+    TagCooccurrenceDraft,
+    verify_draft_token,
+)
+
+EOS_TOKEN_ID = 2
+
+
+def test_propose():
+    draft = TagCooccurrenceDraft()
+    draft.update([10, 11, 12, 13])
+    draft.update([10, 11, 14])
+    draft.update([10, 11, 14])
+
+    # the most frequent following tag first
+    assert draft.propose([5, 10], num_tokens=3) == [11, 14]
+    assert draft.propose([5, 10], num_tokens=1) == [11]
+    # tags in the context are not proposed again
+    assert draft.propose([14, 10], num_tokens=3) == [11, 12, 13]
+    assert draft.propose([5, 99], num_tokens=3) == []
+    assert draft.propose([], num_tokens=3) == []
+
+
+def test_rare_following_tags_are_forgotten():
+    draft = TagCooccurrenceDraft()
+    draft.update([0, 1])
+    draft.update([0, 1])
+    for next_id in range(2, MAX_FOLLOWING_TAGS + 3):
+        draft.update([0, next_id])
+
+    assert len(draft.table[0]) == MAX_FOLLOWING_TAGS
+    assert draft.table[0][1] == 2
+
+
+def test_save_and_load(tmp_path: Path):
+    draft = TagCooccurrenceDraft("dart")
+    draft.update([10, 11, 12])
+    draft.save(tmp_path / "draft.json")
+
+    loaded = TagCooccurrenceDraft.load(tmp_path / "draft.json", "dart")
+    assert loaded.table == draft.table
+    assert loaded.propose([10], num_tokens=2) == [11, 12]
+
+    # ids of another tokenizer are not used
+    assert TagCooccurrenceDraft.load(tmp_path / "draft.json", "other").table == {}
+    assert TagCooccurrenceDraft.load(tmp_path / "missing.json", "dart").table == {}
+
+
+def test_verify_draft_token():
+    # certainly accepted
+    probs = torch.tensor([0.0, 0.0, 0.0, 1.0])
+    assert verify_draft_token(probs, 3, EOS_TOKEN_ID) == (3, True)
+
+    # certainly rejected, and resampled without the draft
+    for seed in range(8):
+        probs = torch.tensor([0.0, 0.5, 0.0, 0.0, 0.5])
+        token_id, accepted = verify_draft_token(
+            probs, 3, EOS_TOKEN_ID, torch.Generator().manual_seed(seed)
+        )
+        assert not accepted
+        assert token_id in [1, 4]
+
+    # no other candidates
+    probs = torch.tensor([0.0, 0.0, 0.0, 0.0])
+    assert verify_draft_token(probs, 3, EOS_TOKEN_ID) == (EOS_TOKEN_ID, False)
+
+
+def test_verified_tokens_follow_target_distribution():
+    target = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    generator = torch.Generator().manual_seed(0)
+
+    counts = torch.zeros(4)
+    num_samples = 20000
+    for _ in range(num_samples):
+        token_id, _accepted = verify_draft_token(
+            target.clone(), 3, EOS_TOKEN_ID, generator
+        )
+        counts[token_id] += 1
+
+    assert torch.allclose(counts / num_samples, target, atol=0.02)
@@ -0,0 +1,82 @@
+import sys
+
+sys.path.append(".")
+
+from pathlib import Path
+
+from dart.tag_index import (
+    TAG_CATEGORY,
+    TagIndex,
+    build_tag_index,
+    load_tag_index,
+)
+
+
+def test_tag_index(tmp_path: Path):
+    path = build_tag_index(
+        tmp_path / "index.bin",
+        {
+            "VOCAB": ["1girl", "solo", "hatsune miku", "vocaloid", "star (sky)"],
+            "CHARACTER": ["hatsune miku", "kafka (honkai:star rail)"],
+            "COPYRIGHT": ["vocaloid"],
+        },
+    )
+    index = TagIndex(path)
+
+    assert len(index) == 6
+    assert index.has("1girl", "VOCAB")
+    assert index.has("star (sky)", "VOCAB")
+    assert index.has("hatsune miku", "VOCAB")
+    assert index.has("hatsune miku", "CHARACTER")
+    assert not index.has("hatsune miku", "COPYRIGHT")
+    assert index.has("kafka (honkai:star rail)", "CHARACTER")
+    assert not index.has("kafka (honkai:star rail)", "VOCAB")
+    assert index.get_category("umbrella") == 0
+
+    assert list(
+        index.iter_tags(
+            include=TAG_CATEGORY["VOCAB"],
+            exclude=TAG_CATEGORY["CHARACTER"] | TAG_CATEGORY["COPYRIGHT"],
+        )
+    ) == ["1girl", "solo", "star (sky)"]
+
+
+def test_load_tag_index_rebuilds_outdated_index(tmp_path: Path):
+    tag_file = tmp_path / "character.txt"
+    tag_file.write_text("hatsune miku\n\n", encoding="utf-8")
+
+    index = load_tag_index(tmp_path / "index.bin", ["1girl"], {"CHARACTER": tag_file})
+    assert index.has("hatsune miku", "CHARACTER")
+    index.close()
+
+    tag_file.write_text("hatsune miku\nkagamine rin\n", encoding="utf-8")
+
+    index = load_tag_index(tmp_path / "index.bin", ["1girl"], {"CHARACTER": tag_file})
+    assert index.has("kagamine rin", "CHARACTER")
+    assert index.has("1girl", "VOCAB")
+
+
+def test_load_tag_index_reuses_unchanged_tags(tmp_path: Path):
+    character_file = tmp_path / "character.txt"
+    character_file.write_text("hatsune miku\n", encoding="utf-8")
+    copyright_file = tmp_path / "copyright.txt"
+    copyright_file.write_text("vocaloid\n", encoding="utf-8")
+    tag_files = {"CHARACTER": character_file, "COPYRIGHT": copyright_file}
+
+    previous = load_tag_index(tmp_path / "index.bin", ["1girl"], tag_files)
+
+    # the previous index is used for unchanged files even if they are gone
+    character_file.unlink()
+    copyright_file.write_text("vocaloid\nutau\n", encoding="utf-8")
+
+    index = load_tag_index(
+        tmp_path / "index.bin",
+        ["1girl"],
+        tag_files,
+        previous=previous,
+        unchanged=["CHARACTER"],
+    )
+    assert index.has("hatsune miku", "CHARACTER")
+    assert index.has("utau", "COPYRIGHT")
+    assert previous.has("hatsune miku", "CHARACTER")
+    assert not previous.has("utau", "COPYRIGHT")
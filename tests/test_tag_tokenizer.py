@@ -0,0 +1,161 @@
+import sys
+
+sys.path.append(".")
+
+import json
+from pathlib import Path
+
+import pytest
+from tokenizers import Tokenizer, pre_tokenizers
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from dart.tag_tokenizer import (
+    TagTokenizer,
+    VerifiedTokenizers,
+    get_verification_texts,
+    verify_tag_tokenizer,
+)
+
+SPECIAL_TOKENS = [
+    "<|bos|>",
+    "<|eos|>",
+    "<|pad|>",
+    "<|unknown|>",
+    "<rating>",
+    "</rating>",
+    "<general>",
+    "</general>",
+    "<|long|>",
+    "<|input_end|>",
+]
+ADDED_TOKENS = ["rating:sfw", "rating:nsfw"]
+TAGS = ["1girl", "solo", "long hair", "looking at viewer", "hatsune miku", "^_^"]
+
+
+class DartLikeTokenizer(PreTrainedTokenizerFast):
+    """Decodes tags joined by commas like the remote tokenizer"""
+
+    def decode(self, token_ids, skip_special_tokens=False, **kwargs):
+        return ", ".join(
+            self.convert_ids_to_tokens(
+                token_ids, skip_special_tokens=skip_special_tokens
+            )
+        )
+
+
+@pytest.fixture
+def tokenizer_dir(tmp_path: Path) -> Path:
+    vocab = {
+        token: id for id, token in enumerate([*SPECIAL_TOKENS, *ADDED_TOKENS, *TAGS])
+    }
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<|unknown|>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(", ", behavior="removed")
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+    tokenizer.add_tokens(ADDED_TOKENS)
+    tokenizer.save(str(tmp_path / "tokenizer.json"))
+
+    (tmp_path / "tokenizer_config.json").write_text(
+        json.dumps(
+            {
+                "eos_token": "<|eos|>",
+                "pad_token": "<|pad|>",
+                "unk_token": "<|unknown|>",
+                "bos_token": "<|bos|>",
+                "additional_special_tokens": SPECIAL_TOKENS[4:],
+            }
+        )
+    )
+    return tmp_path
+
+
+@pytest.fixture
+def reference(tokenizer_dir: Path):
+    return DartLikeTokenizer.from_pretrained(str(tokenizer_dir))
+
+
+def test_same_as_reference(tokenizer_dir: Path, reference):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+
+    prompt = (
+        "<|bos|><rating>rating:sfw</rating><general><|long|>"
+        "1girl, hatsune miku, long hair, unknown tag<|input_end|>"
+    )
+    ids = tag_tokenizer.encode(prompt)
+    assert ids == reference(prompt).input_ids
+    assert tag_tokenizer.decode(ids, skip_special_tokens=True) == (
+        reference.decode(ids, skip_special_tokens=True)
+    )
+
+    texts = get_verification_texts(tag_tokenizer)
+    assert verify_tag_tokenizer(tag_tokenizer, reference, texts) == []
+
+
+def test_batch(tokenizer_dir: Path, reference):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+    prompts = ["<|bos|>1girl, solo<|input_end|>", "<|bos|>^_^<|input_end|>"]
+
+    encoded = tag_tokenizer(prompts, padding=True, return_tensors="pt")
+    for prompt, ids, mask in zip(prompts, encoded.input_ids, encoded.attention_mask):
+        assert ids[mask.bool()].tolist() == reference(prompt).input_ids
+    assert encoded.input_ids[1, -1].item() == tag_tokenizer.pad_token_id
+
+    assert tag_tokenizer.encode_plus(prompts[0]).input_ids[0].tolist() == (
+        reference(prompts[0]).input_ids
+    )
+
+
+def test_vocab(tokenizer_dir: Path, reference):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+
+    assert tag_tokenizer.vocab == reference.vocab
+    assert tag_tokenizer.get_added_vocab() == reference.get_added_vocab()
+    assert tag_tokenizer.eos_token_id == reference.eos_token_id
+    assert tag_tokenizer.all_special_ids == sorted(reference.all_special_ids)
+    assert tag_tokenizer.convert_tokens_to_ids("<|long|>") == (
+        reference.convert_tokens_to_ids("<|long|>")
+    )
+    assert tag_tokenizer.convert_ids_to_tokens([10, 11]) == (
+        reference.convert_ids_to_tokens([10, 11])
+    )
+
+
+def test_detects_mismatch(tokenizer_dir: Path, reference):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+    # e.g. the remote tokenizer splits tags differently
+    tag_tokenizer.separator = None
+
+    assert len(verify_tag_tokenizer(tag_tokenizer, reference)) > 0
+
+
+def test_unsupported_tokenizer(tokenizer_dir: Path):
+    tokenizer = json.loads((tokenizer_dir / "tokenizer.json").read_text())
+    tokenizer["pre_tokenizer"] = {"type": "Whitespace"}
+    (tokenizer_dir / "tokenizer.json").write_text(json.dumps(tokenizer))
+
+    with pytest.raises(ValueError):
+        TagTokenizer.from_pretrained(str(tokenizer_dir))
+
+
+def test_without_added_tokens(tokenizer_dir: Path, reference):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+    tag_tokenizer.added_tokens = {}
+
+    # tags are not wrapped in added tokens
+    texts = get_verification_texts(tag_tokenizer)
+    assert texts[0].startswith(sorted(tag_tokenizer.vocab)[0])
+
+
+def test_verified_tokenizers(tmp_path: Path, tokenizer_dir: Path):
+    tag_tokenizer = TagTokenizer.from_pretrained(str(tokenizer_dir))
+    path = tmp_path / "verified" / "verified_tokenizers.json"
+
+    VerifiedTokenizers(path).add(tag_tokenizer.files_hash)  # type: ignore
+    assert tag_tokenizer.files_hash in VerifiedTokenizers(path)
+
+    # verified again if the tokenizer files change
+    config = json.loads((tokenizer_dir / "tokenizer_config.json").read_text())
+    config["eos_token"] = "<|pad|>"
+    (tokenizer_dir / "tokenizer_config.json").write_text(json.dumps(config))
+    changed = TagTokenizer.from_pretrained(str(tokenizer_dir))
+    assert changed.files_hash not in VerifiedTokenizers(path)
@@ -0,0 +1,65 @@
+import sys
+
+sys.path.append(".")
+
+from dart.token_budget import (
+    MIN_OBSERVATIONS,
+    PROMPT_TEMPLATE_NUM_TOKENS,
+    LengthTokenBudget,
+    truncate_tags_to_budget,
+)
+
+
+def test_length_token_budget():
+    budget = LengthTokenBudget(default_max_new_tokens=128)
+
+    assert budget.get("<|short|>") == 128
+
+    for i in range(MIN_OBSERVATIONS):
+        budget.observe("<|short|>", 16 + i % 4, truncated=False)
+    assert budget.get("<|short|>") == 24  # 19 * 1.25
+    assert budget.get("<|long|>") == 128
+
+    # truncated outputs raise the budget
+    for _ in range(MIN_OBSERVATIONS):
+        budget.observe("<|short|>", 24, truncated=True)
+    assert budget.get("<|short|>") == 128
+
+
+def test_truncate_tags_to_budget():
+    counts = {"1girl": 900, "solo": 800, "long hair": 500, "hat": 40, "cat ears": 3}
+    general = ["1girl", "cat ears", "solo", "hat", "long hair"]
+
+    # fits in the budget
+    assert truncate_tags_to_budget(
+        ["hatsune miku"], ["vocaloid"], general, 100, counts
+    ) == (["hatsune miku"], ["vocaloid"], general)
+
+    # the rarest general tags are kept in the input order
+    assert truncate_tags_to_budget(
+        ["hatsune miku"], ["vocaloid"], general, PROMPT_TEMPLATE_NUM_TOKENS + 4, counts
+    ) == (["hatsune miku"], ["vocaloid"], ["cat ears", "hat"])
+
+    # characters first
+    assert truncate_tags_to_budget(
+        ["hatsune miku", "kagamine rin"], ["vocaloid"], general, 1, counts
+    ) == ([], [], [])
+    assert truncate_tags_to_budget(
+        ["hatsune miku", "kagamine rin"],
+        ["vocaloid"],
+        general,
+        PROMPT_TEMPLATE_NUM_TOKENS + 2,
+        counts,
+    ) == (["hatsune miku", "kagamine rin"], [], [])
+
+
+def test_truncate_tags_without_counts():
+    general = ["sky", "1girl", "cloud", "solo"]
+
+    # tags without counts are the rarest, ties keep the earlier tags
+    assert truncate_tags_to_budget(
+        [], [], general, PROMPT_TEMPLATE_NUM_TOKENS + 2, {"1girl": 900, "solo": 800}
+    ) == ([], [], ["sky", "cloud"])
+    assert truncate_tags_to_budget(
+        [], [], general, PROMPT_TEMPLATE_NUM_TOKENS + 3, {}
+    ) == ([], [], ["sky", "1girl", "cloud"])
@@ -10,6 +10,7 @@ from dart.utils import (
     _get_tag_pattern,
     escape_webui_special_symbols,
     unescape_webui_special_symbols,
+    LRUCache,
 )
 
 
@@ -115,3 +116,18 @@ def test_unescape_webui_special_symbols():
     ]
     for input, expected in test_cases:
         assert unescape_webui_special_symbols(input) == expected
+
+
+def test_lru_cache():
+    cache: LRUCache[str, int] = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    assert cache.get("a") == 1  # "b" becomes the least recently used
+    cache.put("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b") is None
+    assert len(cache) == 2